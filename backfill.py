@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Upload historical readings with their original timestamps.
+
+Replays readings from a file, e.g. logs or CSV exports of the time a host
+was offline. Each line holds a metric, a value and a UNIX timestamp, either
+comma or whitespace separated or as a JSON list like the lines of the spool.
+Empty lines, comments starting with '#' and lines that don't parse, like a
+CSV header, are skipped.
+
+  ./backfill.py [--rate=DATAPOINTS_PER_SECOND] [--checkpoint=FILE] FILE
+
+The file is read as a stream, so its size doesn't matter. Datapoints are
+packed into full datagrams and the upload is paced by a token bucket. With
+a checkpoint file an interrupted upload continues where it stopped. The API
+key and server are taken from config.py.
+"""
+
+import sys, os, json, time, logging
+import metricfire
+
+def is_blank(line):
+  """Tell whether a line is empty or a comment."""
+  line = line.strip()
+  return not line or line.startswith('#')
+
+def parse_line(line):
+  """Return the (metric, value, timestamp) tuple of a line, or None if it holds none."""
+  if is_blank(line):
+    return None
+  line = line.strip()
+  try:
+    if line.startswith('['):
+      metric, value, timestamp = json.loads(line)
+    else:
+      metric, value, timestamp = line.split(',') if ',' in line else line.split()
+    return (metric.strip(), float(value), int(float(timestamp)))
+  except (ValueError, TypeError, AttributeError):
+    # Not three fields, or JSON of another shape, like [1, 2, 3] or 42.
+    return None
+
+def read_datapoints(f, offset=0):
+  """Yield (offset, datapoint) for each datapoint in the file f from offset on.
+
+  offset is where the line after the datapoint starts, i.e. where to resume
+  once the datapoint has been uploaded. Lines are read one at a time. The
+  datapoint is None for lines that don't parse, blank lines and comments are
+  left out.
+  """
+  f.seek(offset)
+  for line in iter(f.readline, ''):
+    offset += len(line)
+    datapoint = parse_line(line)
+    if datapoint is not None or not is_blank(line):
+      yield offset, datapoint
+
+class TokenBucket:
+  """Allows rate tokens per second on average and bursts of up to burst tokens."""
+
+  def __init__(self, rate, burst, clock=time.time, sleep=time.sleep):
+    self.rate = float(rate)
+    self.burst = burst
+    self.tokens = burst
+    self._clock = clock
+    self._sleep = sleep
+    self._last = clock()
+
+  def take(self, n):
+    """Wait until n tokens are available and take them. n may exceed the burst size."""
+    now = self._clock()
+    self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+    self._last = now
+    self.tokens -= n
+    if self.tokens < 0:
+      # Go into debt and sleep it off, so large requests aren't starved.
+      self._sleep(-self.tokens / self.rate)
+
+class Backfill:
+  """Uploads the datapoints of a file with client.
+
+  batch datapoints are handed to client.send_many() at a time, which packs
+  them into as few datagrams as fit. rate limits the upload to that many
+  datapoints per second, None disables pacing. The offset of the first line
+  not uploaded yet is saved to checkpoint every checkpoint_interval seconds.
+  Progress is logged every progress_interval seconds. Lines that don't parse
+  are counted in skipped.
+  """
+
+  def __init__(self, client, path, checkpoint=None, rate=None, batch=1000,
+               checkpoint_interval=5.0, progress_interval=10.0, clock=time.time):
+    self.client = client
+    self.path = path
+    self.checkpoint = checkpoint
+    self.bucket = TokenBucket(rate, batch) if rate else None
+    self.batch = batch
+    self.checkpoint_interval = checkpoint_interval
+    self.progress_interval = progress_interval
+    self.sent = 0
+    self.skipped = 0
+    self.offset = 0
+    self._clock = clock
+
+  def load_checkpoint(self):
+    """Return the offset saved by a previous run, 0 if there is none."""
+    try:
+      return int(open(self.checkpoint).read())
+    except (IOError, ValueError, TypeError):
+      return 0
+
+  def save_checkpoint(self):
+    metricfire.atomicWrite(self.checkpoint, '%d\n' % self.offset)
+
+  def progress(self, started, size):
+    """Log how far the upload got and its throughput."""
+    elapsed = max(self._clock() - started, 1e-9)
+    throughput = self.sent / elapsed
+    done = float(self.offset - self._start_offset) / max(size - self._start_offset, 1)
+    eta = elapsed / done - elapsed if done else 0
+    logging.info("%.1f%% done, %d datapoints sent, %d lines skipped, %.0f datapoints/s, %.0fs left" % (
+      100.0 * self.offset / max(size, 1), self.sent, self.skipped, throughput, eta))
+
+  def _upload(self, datapoints, offset):
+    if self.bucket is not None:
+      self.bucket.take(len(datapoints))
+    if not self.client.send_many(datapoints):
+      raise IOError("Could not send datapoints, no metricfire server address known.")
+    self.sent += len(datapoints)
+    self.offset = offset
+
+  def run(self):
+    """Upload everything after the checkpoint. Returns the number of datapoints sent."""
+    if self.checkpoint:
+      self.offset = self.load_checkpoint()
+    self._start_offset = self.offset
+    size = os.path.getsize(self.path)
+    started = last_checkpoint = last_progress = self._clock()
+    f = open(self.path)
+    datapoints = []
+    offset = self.offset
+    try:
+      for offset, datapoint in read_datapoints(f, self.offset):
+        if datapoint is None:
+          self.skipped += 1
+          continue
+        datapoints.append(datapoint)
+        if len(datapoints) < self.batch:
+          continue
+        self._upload(datapoints, offset)
+        datapoints = []
+        now = self._clock()
+        if self.checkpoint and now - last_checkpoint >= self.checkpoint_interval:
+          self.save_checkpoint()
+          last_checkpoint = now
+        if now - last_progress >= self.progress_interval:
+          self.progress(started, size)
+          last_progress = now
+      if datapoints:
+        self._upload(datapoints, offset)
+      else:
+        # Skipped lines at the end of the file are done with, too.
+        self.offset = offset
+    finally:
+      f.close()
+      if self.checkpoint:
+        self.save_checkpoint()
+    self.progress(started, size)
+    return self.sent
+
+def main():
+  from config import config
+  logging.basicConfig(level=logging.ERROR if '--quiet' in sys.argv else logging.INFO)
+  options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+  args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+  if len(args) != 1:
+    sys.exit(__doc__)
+  client = metricfire.Client(config['api-key'], application='backfill', server=config.get('metricfire_server'),
+                             try_adns=config.get('metricfire_try_adns', False),
+                             dns_cache=config.get('metricfire_dns_cache'),
+                             dns_ttl=config.get('metricfire_dns_ttl', 300),
+                             compact=config.get('metricfire_compact', False))
+  if not client.wait(10):
+    sys.exit("Could not resolve the metricfire server.")
+  backfill = Backfill(client, args[0], checkpoint=options.get('checkpoint'),
+                      rate=float(options.get('rate', config.get('backfill_rate', 10000))))
+  try:
+    backfill.run()
+  except KeyboardInterrupt:
+    logging.info("Interrupted at offset %d." % backfill.offset)
+  client.close()
+
+if __name__ == '__main__':
+  main()
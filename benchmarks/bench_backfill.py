@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""
+Throughput of backfill.py against the local ingest server.
+
+Writes a CSV file of readings, uploads it without pacing and reports the
+datapoints per second and the messages lost on the way. The server runs in
+its own process, so it doesn't compete with the uploader for the GIL.
+
+  bench_backfill.py [DATAPOINTS]
+"""
+
+import sys, os, time, tempfile, multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metricfire
+from ingest import IngestServer
+from backfill import Backfill
+
+KEY = '00000000-0000-0000-0000-000000000000'
+
+def run_server(conn):
+  server = IngestServer([KEY], keep=False)
+  server.start()
+  conn.send(server.address[1])
+  conn.recv()
+  server.drain()
+  conn.send(server.stats())
+  server.stop()
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+  f = tempfile.NamedTemporaryFile(suffix='.csv')
+  for i in xrange(count):
+    f.write('sensor%d,%.4f,%d\n' % (i % 8, 20 + (i % 100) * 0.0625, 1334000000 + 60 * (i // 8)))
+  f.flush()
+
+  conn, server_conn = multiprocessing.Pipe()
+  server = multiprocessing.Process(target=run_server, args=(server_conn,))
+  server.start()
+  port = conn.recv()
+  client = metricfire.Client(KEY, application='bench', server='127.0.0.1:%d' % port, try_adns=False)
+
+  before = time.time()
+  sent = Backfill(client, f.name, progress_interval=3600).run()
+  elapsed = time.time() - before
+  conn.send('stop')
+  stats = conn.recv()
+  server.join()
+  print "%d datapoints in %.1fs: %.0f datapoints/s, %d messages, lost %d datapoints" % (
+    sent, elapsed, sent / elapsed, stats['messages'], sent - stats['datapoints'])
+
+if __name__ == '__main__':
+  main()
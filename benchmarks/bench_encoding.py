@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""
+Size and CPU cost of the JSON and the compact (version 3) message encodings.
+
+Splits a batch of datapoints into messages with Client._messages(), as
+send_many() does, and reports the bytes per datapoint, the datapoints per
+datagram and the CPU time per datapoint, including signing. Nothing is sent
+over the network.
+"""
+
+import sys, os, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metricfire
+
+KEY = '00000000-0000-0000-0000-000000000000'
+DURATION = 2.0
+
+def workloads():
+  # A poll of a few sensors, as main.py sends them.
+  yield 'one poll', [('outside', 12.5, 1334000000), ('inside', 21.0625, 1334000000)]
+  # A spool or backfill backlog of 40 sensors with long dotted names.
+  yield 'backlog', [('site%d.building%d.floor%d.room%d.temperature' % (i % 2, i % 3, i % 4, i % 40),
+                     18 + (i * 7 % 50) * 0.0625, 1334000000 + i // 40 * 60) for i in range(4000)]
+  # Internal metrics of the client.
+  client = metricfire.Client(KEY, application='bench', server='127.0.0.1:9', try_adns=False)
+  client.observe('digitemp', 0.5)
+  yield 'internal', client._internalDatapoints(1334000000)
+
+def measure(client, datapoints):
+  messages = [message for (batch, message) in client._messages(datapoints)]
+  count = 0
+  start = time.clock()
+  while time.clock() - start < DURATION:
+    for (batch, message) in client._messages(datapoints):
+      pass
+    count += 1
+  cpu = (time.clock() - start) / count / len(datapoints)
+  return sum(map(len, messages)), len(messages), cpu
+
+def main():
+  clients = [('json', metricfire.Client(KEY, application='/usr/local/bin/digitemp-metricfire', server='127.0.0.1:9', try_adns=False)),
+             ('compact', metricfire.Client(KEY, application='/usr/local/bin/digitemp-metricfire', server='127.0.0.1:9', try_adns=False, compact=True))]
+  for name, datapoints in workloads():
+    for encoding, client in clients:
+      size, messages, cpu = measure(client, datapoints)
+      print "%-9s %-8s %5d datapoints: %6.1f bytes/datapoint, %5.1f datapoints/datagram, %5.1f us/datapoint" % (
+        name, encoding, len(datapoints), float(size) / len(datapoints), float(len(datapoints)) / messages, cpu * 1e6)
+
+if __name__ == '__main__':
+  main()
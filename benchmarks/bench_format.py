@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+"""
+Messages formatted and signed per second by metricfire.Client._format().
+
+The legacy formatter rebuilds the body and header dicts and keys a new HMAC
+for every message, like _format() used to. Nothing is sent over the network.
+"""
+
+import sys, os, time, hmac, hashlib, binascii
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metricfire
+
+KEY = '00000000-0000-0000-0000-000000000000'
+DURATION = 2.0
+
+class LegacyState:
+  sequence = 0
+  sessionkey = os.urandom(16)
+
+def legacy_format(client, datapoints):
+  LegacyState.sequence += 1
+  sequence = LegacyState.sequence
+  sessionkey = LegacyState.sessionkey
+  body = {'h': client._hostname, 'a': client._application, 'm': []}
+  for (metric, value, timestamp) in datapoints:
+    body['m'].append((metric, value, timestamp))
+  body_json = metricfire.json.dumps(body)
+  header = {'v': client._protoversion, 'f': client._keyfingerprint, 's': binascii.hexlify(sessionkey), 'q': sequence}
+  auth = hmac.HMAC(client._key, digestmod = hashlib.sha256)
+  auth.update(sessionkey)
+  auth.update(str(sequence))
+  auth.update(body_json)
+  header['a'] = auth.hexdigest()
+  return metricfire.json.dumps(header) + "\n" + body_json
+
+def rate(format, datapoints):
+  count = 0
+  start = time.time()
+  while time.time() - start < DURATION:
+    for i in xrange(100):
+      format(datapoints)
+    count += 100
+  return count / (time.time() - start)
+
+def main():
+  client = metricfire.Client(KEY, application='bench', server='127.0.0.1:9', try_adns=False)
+  for size in (1, 10, 30):
+    datapoints = [('sensors.temperature.%d' % i, 21.5, 1334000000) for i in range(size)]
+    legacy = rate(lambda d: legacy_format(client, d), datapoints)
+    current = rate(client._format, datapoints)
+    print "%2d datapoints/message: legacy %8.0f msg/s, current %8.0f msg/s (%.0f datapoints/s)" % (
+      size, legacy, current, current * size)
+
+if __name__ == '__main__':
+  main()
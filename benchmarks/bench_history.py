@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+"""
+Cost of the in-memory reading history of history.py.
+
+Fills a day of readings taken every 60 and every 10 seconds and times a
+query for the latest reading and for the statistics over the last hour and
+the whole day. Also reports the memory a list of tuples would take instead.
+"""
+
+import sys, os, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from history import History
+
+DAY = 24 * 3600
+
+def main():
+  for interval in (60, 10):
+    history = History(DAY, interval)
+    now = 1334000000
+    samples = DAY // interval
+    history.add([('outside', 20 + (i % 100) * 0.0625, now - DAY + i * interval) for i in xrange(samples)])
+    ring = history.rings['outside']
+    as_tuples = sys.getsizeof([]) + samples * (8 + sys.getsizeof((0.0, 0.0)) + 2 * sys.getsizeof(0.0))
+    print "every %2ds, %d samples: %d bytes in arrays, about %d as a list of tuples" % (
+      interval, samples, ring.times.itemsize * (2 * ring.capacity + 3 * ring.blocks), as_tuples)
+    for name, window in (('latest', 0), ('last hour', 3600), ('whole day', DAY)):
+      runs = 2000
+      seconds = timeit.timeit(lambda: history.query('outside', window, now), number=runs)
+      print "  %-9s query: %6.1f us" % (name, seconds / runs * 1e6)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+Startup cost of a run, as paid every minute by cron with --once.
+
+Every case runs in a fresh interpreter and reports the median wall time and
+CPU time of the whole process over several runs. Like under cron, all but
+the first run find the .pyc files of the modules. Client init is timed from creating the
+client until a server address is known, with and without a DNS cache file.
+The client sends to the local ingest server under the name localhost, so the
+lookup doesn't need the network. Pass the host:port of a real server, e.g.
+udp-api.metricfire.com:6333, as the first argument to include a DNS query.
+
+Exits with status 1 if importing metricfire takes more than BUDGET of wall
+time on top of starting the interpreter.
+"""
+
+import sys, os, time, resource, subprocess, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from ingest import IngestServer
+
+KEY = '00000000-0000-0000-0000-000000000000'
+RUNS = 15
+# Seconds importing metricfire may add to a run, about 13 ms measured.
+BUDGET = 0.025
+
+CLIENT = """
+import time
+started = time.time()
+import metricfire
+client = metricfire.Client(%r, server=%r, try_adns=False, dns_cache=%r)
+client.wait(10)
+client._resolved()
+print time.time() - started
+"""
+
+def run(code):
+  """Run code in a new interpreter, returns its wall time, CPU time and output."""
+  before = resource.getrusage(resource.RUSAGE_CHILDREN)
+  # Like cron, whose environment doesn't have it, so the .pyc files get written.
+  env = dict(os.environ)
+  env.pop('PYTHONDONTWRITEBYTECODE', None)
+  started = time.time()
+  proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE, env=env)
+  out = proc.communicate()[0]
+  wall = time.time() - started
+  after = resource.getrusage(resource.RUSAGE_CHILDREN)
+  cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+  if proc.returncode != 0:
+    return None
+  return wall, cpu, out
+
+def median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+def report(name, code, runs=RUNS):
+  results = [run(code) for i in range(runs)]
+  if None in results:
+    print "%-28s failed" % name
+    return None
+  print "%-28s wall %6.1f ms  cpu %6.1f ms" % (
+    name, median(r[0] for r in results) * 1e3, median(r[1] for r in results) * 1e3)
+  return results
+
+def main():
+  ingest = None
+  if len(sys.argv) > 1:
+    server = sys.argv[1]
+  else:
+    ingest = IngestServer([KEY], keep=False)
+    ingest.start()
+    server = 'localhost:%d' % ingest.address[1]
+  interpreter = report('interpreter', 'pass')
+  imported = report('import metricfire', 'import metricfire')
+  if report('import main', 'import main') is None:
+    print "  (main needs config.py and its api key module)"
+  cache = tempfile.mktemp()
+  try:
+    for name, dns_cache in (('client init, no cache', None), ('client init, cached', cache)):
+      # The first run fills the cache.
+      run(CLIENT % (KEY, server, dns_cache))
+      results = report(name, CLIENT % (KEY, server, dns_cache))
+      if results is not None:
+        print "  %-26s until resolved %6.1f ms" % ('', median(float(r[2]) for r in results) * 1e3)
+  finally:
+    if os.path.exists(cache):
+      os.remove(cache)
+    if ingest is not None:
+      ingest.stop()
+  if interpreter is None or imported is None:
+    sys.exit(1)
+  cost = median(r[0] for r in imported) - median(r[0] for r in interpreter)
+  if cost > BUDGET:
+    print "import metricfire adds %.1f ms, over the budget of %.1f ms" % (cost * 1e3, BUDGET * 1e3)
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
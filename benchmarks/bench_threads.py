@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+Scaling of Client.send() with the number of sending threads.
+
+All threads share one client, either sending through its single socket or
+through a socket per thread. Messages go to a local UDP socket nobody reads,
+so the kernel drops them once its buffer is full and the server side costs
+nothing. Under CPython the GIL still serialises the Python code itself, so
+this shows what the client's own locking and socket sharing add on top.
+"""
+
+import sys, os, time, socket, threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metricfire
+
+KEY = '00000000-0000-0000-0000-000000000000'
+DURATION = 1.0
+
+def worker(client, deadline, counts):
+  count = 0
+  while time.time() < deadline:
+    for i in xrange(100):
+      client.send('bench.threads', 1.0)
+    count += 100
+  counts.append(count)
+
+def rate(port, threads, per_thread_sockets):
+  client = metricfire.Client(KEY, application='bench', server='127.0.0.1:%d' % port, try_adns=False,
+                             per_thread_sockets=per_thread_sockets)
+  counts = []
+  deadline = time.time() + DURATION
+  workers = [threading.Thread(target=worker, args=(client, deadline, counts)) for i in range(threads)]
+  for w in workers:
+    w.start()
+  for w in workers:
+    w.join()
+  return sum(counts) / DURATION
+
+def main():
+  sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sink.bind(('127.0.0.1', 0))
+  port = sink.getsockname()[1]
+  threads = 1
+  while threads <= 32:
+    shared = rate(port, threads, False)
+    own = rate(port, threads, True)
+    print "%2d threads: shared socket %8.0f msg/s, per-thread sockets %8.0f msg/s" % (threads, shared, own)
+    threads *= 2
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+Throughput of the metricfire client against the local ingest server.
+
+Drives Client.send(), a measure-decorated function and Timer from 1..N threads
+sharing the module-level client, and from several processes with a client
+each. Reports calls per second, the p99 latency of a single call and the
+messages lost between client and server. The server runs in its own process.
+
+  bench_throughput.py [SECONDS] [MAX_THREADS] [MAX_PROCESSES]
+"""
+
+import sys, os, time, threading, multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metricfire
+from ingest import IngestServer
+
+KEY = '00000000-0000-0000-0000-000000000000'
+# Only every SAMPLE-th call is timed, to keep the bookkeeping cheap.
+SAMPLE = 10
+
+def run_server(conn):
+  server = IngestServer([KEY], keep=False)
+  server.start()
+  conn.send(server.address[1])
+  # Wait until the clients are done.
+  conn.recv()
+  server.drain()
+  conn.send(server.stats())
+  server.stop()
+
+@metricfire.measure
+def measured():
+  pass
+
+def call_send():
+  metricfire.send('bench.send', 1.0)
+
+def call_timer():
+  with metricfire.Timer('bench.timer'):
+    pass
+
+CALLS = {'send': call_send, 'measure': measured, 'timer': call_timer}
+
+def loop(call, seconds, results):
+  count = 0
+  latencies = []
+  deadline = time.time() + seconds
+  while time.time() < deadline:
+    for i in xrange(SAMPLE - 1):
+      call()
+    before = time.time()
+    call()
+    latencies.append(time.time() - before)
+    count += SAMPLE
+  results.put((count, latencies))
+
+def run_threads(port, mode, threads, seconds, results):
+  metricfire.init(KEY, application='bench', server='127.0.0.1:%d' % port, try_adns=False)
+  workers = [threading.Thread(target=loop, args=(CALLS[mode], seconds, results)) for i in range(threads)]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+
+def run(mode, processes, threads, seconds):
+  conn, server_conn = multiprocessing.Pipe()
+  server = multiprocessing.Process(target=run_server, args=(server_conn,))
+  server.start()
+  port = conn.recv()
+
+  results = multiprocessing.Queue()
+  if processes == 1:
+    run_threads(port, mode, threads, seconds, results)
+  else:
+    clients = [multiprocessing.Process(target=run_threads, args=(port, mode, threads, seconds, results))
+               for i in range(processes)]
+    for client in clients:
+      client.start()
+
+  count = 0
+  latencies = []
+  for i in range(processes * threads):
+    (calls, sample) = results.get()
+    count += calls
+    latencies.extend(sample)
+  if processes > 1:
+    for client in clients:
+      client.join()
+
+  conn.send('stop')
+  stats = conn.recv()
+  server.join()
+
+  latencies.sort()
+  p99 = latencies[int(len(latencies) * 0.99)]
+  lost = count - stats['messages']
+  print "%-8s %2d proc x %2d threads: %9.0f calls/s, p99 %7.1f us, lost %d of %d (%.2f%%)" % (
+    mode, processes, threads, count / seconds, p99 * 1e6, lost, count, 100.0 * lost / count)
+
+def main():
+  seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+  max_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+  max_processes = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+  for mode in ('send', 'measure', 'timer'):
+    threads = 1
+    while threads <= max_threads:
+      run(mode, 1, threads, seconds)
+      threads *= 2
+    processes = 2
+    while processes <= max_processes:
+      run(mode, processes, 1, seconds)
+      processes *= 2
+
+if __name__ == '__main__':
+  main()
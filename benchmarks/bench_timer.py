@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+Per-call overhead of metricfire.Timer and metricfire.measure.
+
+measure is timed on every call, on one in 100 calls and with spans.
+
+Compares caller detection through inspect.stack(), as Timer.start() used to
+do, with the current implementation. Timings are recorded by an aggregating
+client, so no packets are sent while measuring.
+"""
+
+import sys, os, inspect, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metricfire
+
+KEY = '00000000-0000-0000-0000-000000000000'
+CALLS = 20000
+
+class InspectTimer(metricfire.Timer):
+  """Timer detecting the caller the old way."""
+  def start(self, metric=None, restart=False):
+    if metric is None:
+      metric = inspect.stack()[2 if restart else 1][3]
+    metricfire.Timer.start(self, metric, restart)
+
+def empty():
+  pass
+
+@metricfire.measure
+def measured():
+  pass
+
+@metricfire.measure(sample=100)
+def sampled():
+  pass
+
+@metricfire.measure(spans=True)
+def spans():
+  pass
+
+def timer_autodetect(timer_class):
+  timer = timer_class()
+  timer.start()
+  timer.stop()
+
+def timer_named():
+  timer = metricfire.Timer()
+  timer.start('named')
+  timer.stop()
+
+def timer_with():
+  with metricfire.Timer('with'):
+    pass
+
+def report(name, func, baseline=0.0):
+  per_call = min(timeit.repeat(func, number=CALLS, repeat=3)) / CALLS
+  print "%-32s %8.2f us/call" % (name, (per_call - baseline) * 1e6)
+  return per_call
+
+def main():
+  metricfire.init(KEY, application='bench', server='127.0.0.1:9', try_adns=False,
+                  aggregate=True, aggregate_interval=3600)
+  baseline = report('empty function call', empty)
+  report('measure decorator', measured, baseline)
+  report('measure decorator, 1 in 100', sampled, baseline)
+  report('measure decorator, spans', spans, baseline)
+  report('Timer, autodetect (inspect)', lambda: timer_autodetect(InspectTimer), baseline)
+  report('Timer, autodetect', lambda: timer_autodetect(metricfire.Timer), baseline)
+  report('Timer, named', timer_named, baseline)
+  report('Timer, with statement', timer_with, baseline)
+
+if __name__ == '__main__':
+  main()
@@ -6,8 +6,16 @@ from apikey import api_key
 config = {
     # The path to the digitemp binary
     'digitemp': '/usr/bin/digitemp_DS9097',
-    # Names for the sensor values returned by digitemp. You must specify
-    # exactly as many names as there are sensors.
+    # Names for the sensor values returned by digitemp. Readings of sensors
+    # without a name are logged and dropped. A sensor which doesn't need
+    # to be read every interval can be given as a dict with its own polling
+    # interval in seconds, e.g. {'name': 'attic', 'interval': 600}. Sensors
+    # are then read one at a time when they are due. digitemp readings are
+    # matched to the names by the ROM serial of their sensor: by the 'id' of a
+    # sensor given as a dict, e.g. {'name': 'outside', 'id': '10E45C570108007D'}
+    # as printed by digitemp -a -o %R, which keeps working when the file is
+    # recreated, or else in order to the ROM lines of 'configfile' which no
+    # 'id' claims.
     'sensors': ['outside', 'inside'],
     # You can either specify your API key here or place it into a file
     # called apikey.py in the same directory.
@@ -15,13 +23,108 @@ config = {
     'api-key': api_key,
     # The interval in seconds between sensor updates
     'interval': 60,
+    # Stamp each reading with the time it was 'read', or all readings of an
+    # update with the time of its 'tick', so the readings of many hosts line
+    # up.
+    'timestamps': 'read',
+    # Only upload a reading when it differs from the last uploaded one of its
+    # sensor by more than this many degrees, or when the sensor hasn't been
+    # uploaded for 'heartbeat' seconds. None uploads every reading.
+    'deadband': None,
+    'heartbeat': 600,
+    # Smooth the readings with an exponentially weighted moving average before
+    # comparing them, to ignore flicker in the last bit of the sensors. This
+    # is the weight of a new reading, e.g. 0.3. None disables smoothing.
+    'ewma_alpha': None,
+    # File keeping the state of the change detection between --once runs.
+    'deadband_state': None,
+    # If set, the numbers of sent and suppressed readings are uploaded as
+    # metrics starting with this prefix.
+    'deadband_metrics': None,
+    # Keep the readings of that many seconds in memory, e.g. 24*3600, for
+    # local queries. None keeps nothing.
+    'history': None,
+    # Answer queries for the kept readings over HTTP on this port of
+    # localhost, see history.py. None disables the server.
+    'history_port': None,
+    # What to do when reading the sensors takes longer than the interval:
+    # 'skip' the updates that were missed or 'catchup' by running them right
+    # away.
+    'missed_ticks': 'skip',
+    # If set, the lateness of each update, the number of overruns and skipped
+    # updates are uploaded as metrics starting with this prefix.
+    'scheduler_metrics': None,
+    # Keep a single digitemp process running in its loop mode instead of
+    # starting it for every update. This is ignored when running with --once.
+    'streaming': False,
+    # How the sensors are read: 'digitemp' runs the digitemp binary, 'w1'
+    # reads the files of the kernel w1_therm driver in 'w1_devices' without
+    # starting a process, all sensors at once. With 'w1', a sensor can be
+    # given as a dict with the 'id' of its device, e.g.
+    # {'name': 'outside', 'id': '28-000005e2fdc3'}, otherwise the sensors are
+    # matched in order to the devices no 'id' claims. Streaming and --async
+    # only work with digitemp.
+    'backend': 'digitemp',
+    'w1_devices': '/sys/bus/w1/devices',
     # The config file to be used by digitemp. It will be created if it doesn't
     # exist and defaults to digitemp.conf in the current directory.
     'configfile': 'digitemp.conf',
     # The serial port at which the sensors are connected.
     'port': '/dev/ttyS0',
-    # This can be used to disabled metricfire asynchronous dns support in case
-    # the module is not installed.
+    # Several 1-Wire buses can be read concurrently by listing them here. Each
+    # entry has its own backend, port, digitemp config file and sensor names and
+    # replaces the single bus described by the settings above, e.g.
+    #   'buses': [
+    #     {'port': '/dev/ttyS0', 'configfile': 'ttyS0.conf', 'sensors': ['outside', 'inside']},
+    #     {'port': '/dev/ttyUSB0', 'configfile': 'ttyUSB0.conf', 'sensors': ['attic']},
+    #   ],
+    'buses': [],
+    # The metricfire server as host:port, None for the default. Point this at
+    # ingest.py to test locally.
+    'metricfire_server': None,
+    # Send metrics through the relay daemon (relay.py) listening on this Unix
+    # socket instead of directly to metricfire. None sends directly.
+    'metricfire_relay': None,
+    # Use the adns module for asynchronous DNS lookups if it is installed.
+    # Otherwise, lookups are done by a background thread.
     'metricfire_try_adns': False,
+    # File keeping the resolved metricfire server addresses until their DNS
+    # TTL expires, e.g. '/tmp/metricfire-dns.json'. Runs started by cron with
+    # --once then send without waiting for a lookup.
+    'metricfire_dns_cache': None,
+    # Seconds after which the metricfire server is looked up again, and for
+    # which the DNS cache file above is trusted. With adns, the TTL of the DNS
+    # record is used instead.
+    'metricfire_dns_ttl': 300,
+    # How many seconds a --once run waits for the metricfire server to be
+    # resolved before uploading, unless 'spool' is set.
+    'resolve_wait': 5,
+    # Send messages in the compact encoding: compressed, with every metric name
+    # listed once per message. This cuts the bytes per reading several times
+    # when many are sent together, e.g. from the spool, but needs a server
+    # that speaks protocol version 3.
+    'metricfire_compact': False,
+    # Buffer metric data points in memory and send them in batches from a
+    # background thread. Readings taken before the metricfire server address
+    # has been resolved are then kept instead of being dropped.
+    'metricfire_buffered': False,
+    # Upload statistics about the metricfire client and the time digitemp
+    # takes as metricfire.internal.* metrics every that many seconds.
+    'metricfire_internal_interval': None,
+    # Directory in which readings are spooled until they have been uploaded.
+    # Readings taken while the network or DNS is down are then uploaded by a
+    # later run instead of being lost. None disables spooling.
+    'spool': None,
+    # The spool is capped at this many bytes, the oldest readings are dropped
+    # when it grows larger.
+    'spool_max_bytes': 10*1024*1024,
+    # Maximum number of spooled readings uploaded per second and the maximum
+    # number of seconds spent uploading the backlog per update. With --async,
+    # which must not block, a single batch of the backlog is uploaded per
+    # update instead.
+    'spool_rate': 1000,
+    'spool_drain_time': 20,
+    # Maximum number of datapoints per second uploaded by backfill.py.
+    'backfill_rate': 10000,
 }
 
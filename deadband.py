@@ -0,0 +1,68 @@
+"""
+Change detection for sensor readings.
+
+A reading is only uploaded when it differs from the last uploaded value of
+its sensor by more than the deadband, or when the sensor has been silent for
+the heartbeat interval. Optional exponential smoothing keeps the quantisation
+flicker of the sensors (0.0625 C for a DS18B20) from counting as a change.
+"""
+
+import json, time, logging
+from metricfire import atomicWrite
+
+class Deadband:
+  """Filters (metric, value, timestamp) datapoints per metric.
+
+  alpha is the weight of a new reading in the exponentially weighted moving
+  average, None disables smoothing. sent and suppressed count the datapoints
+  passed and dropped by filter().
+  """
+
+  def __init__(self, deadband, heartbeat=None, alpha=None):
+    self.deadband = deadband
+    self.heartbeat = heartbeat
+    self.alpha = alpha
+    self.sent = 0
+    self.suppressed = 0
+    # metric -> [smoothed value, last sent value, time last sent]
+    self.state = {}
+
+  def filter(self, datapoints, now=None):
+    """Return the datapoints worth uploading, with smoothed values if smoothing is enabled."""
+    if now is None:
+      now = time.time()
+    result = []
+    for (metric, value, timestamp) in datapoints:
+      at = now if timestamp is None else timestamp
+      state = self.state.get(metric)
+      if state is None:
+        self.state[metric] = [value, value, at]
+        result.append((metric, value, timestamp))
+        continue
+      if self.alpha is not None:
+        state[0] = self.alpha * value + (1 - self.alpha) * state[0]
+      else:
+        state[0] = value
+      if abs(state[0] - state[1]) > self.deadband or (self.heartbeat is not None and at - state[2] >= self.heartbeat):
+        state[1] = state[0]
+        state[2] = at
+        result.append((metric, state[0], timestamp))
+      else:
+        self.suppressed += 1
+    self.sent += len(result)
+    return result
+
+  def load(self, path):
+    """Restore the state saved by save(), e.g. by a previous --once run."""
+    try:
+      self.state = json.load(open(path))
+    except (IOError, ValueError), ex:
+      logging.debug("Not restoring deadband state from %s: %s" % (path, ex))
+
+  def save(self, path):
+    atomicWrite(path, json.dumps(self.state))
+
+  def datapoints(self, prefix, timestamp=None):
+    """Return the sent and suppressed counts as (metric, value, timestamp) tuples."""
+    return [(prefix + '.sent', self.sent, timestamp),
+            (prefix + '.suppressed', self.suppressed, timestamp)]
@@ -1,5 +1,5 @@
 import unittest
-import os
+import os, glob, subprocess, sys
 
 def test():
   if not os.path.isdir('tests/tmp'):
@@ -7,3 +7,8 @@ def test():
   tests = unittest.defaultTestLoader.discover('tests')
   runner = unittest.TextTestRunner()
   res = runner.run(tests)
+
+def bench():
+  for path in sorted(glob.glob('benchmarks/bench_*.py')):
+    print "== %s" % path
+    subprocess.call([sys.executable, path])
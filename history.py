@@ -0,0 +1,209 @@
+"""
+Recent readings kept in memory, for local dashboards and alerting scripts.
+
+Every sensor gets a ring buffer of its timestamps and values in two
+array('d'), so a stored reading costs 16 bytes and no Python object, plus
+the sum, min and max of blocks of readings, so a query over a window reads a
+number of blocks and readings in the order of the square root of the number
+stored. A small HTTP server on localhost answers queries for the latest
+reading and the min, max and average over a window:
+
+  GET /                       the latest reading of every sensor
+  GET /SENSOR?window=SECONDS  latest, count, min, max and avg of a sensor
+"""
+
+import time, json, math, bisect, threading, urlparse, BaseHTTPServer
+from array import array
+
+class Ring:
+  """Holds the last capacity (timestamp, value) pairs of a sensor.
+
+  The sum, min and max of every block of about sqrt(capacity) consecutive
+  samples are kept as well, so window() looks at whole blocks and only at the
+  single samples before the first of them.
+  """
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.times = array('d', [0.0]) * capacity
+    self.values = array('d', [0.0]) * capacity
+    # Index of the next slot to write and the number of slots in use.
+    self.head = 0
+    self.count = 0
+    # Number of samples ever appended. Sample n is in slot n % capacity and
+    # in block n // block, whose aggregates are in slot n // block % blocks.
+    self.total = 0
+    self.block = max(1, int(math.sqrt(capacity)))
+    # The blocks of the samples in the ring and the one being filled.
+    self.blocks = capacity // self.block + 2
+    self.sums = array('d', [0.0]) * self.blocks
+    self.mins = array('d', [0.0]) * self.blocks
+    self.maxs = array('d', [0.0]) * self.blocks
+    # Added to the timestamps once the clock has stepped backwards.
+    self.skew = 0.0
+
+  def append(self, timestamp, value):
+    timestamp += self.skew
+    if self.count and timestamp < self.times[self.head - 1]:
+      # The clock stepped backwards. Shift this and later timestamps to keep
+      # them sorted, so window() can still bisect them.
+      self.skew += self.times[self.head - 1] - timestamp
+      timestamp = self.times[self.head - 1]
+    self.times[self.head] = timestamp
+    self.values[self.head] = value
+    block = self.total // self.block % self.blocks
+    if self.total % self.block == 0:
+      self.sums[block] = self.mins[block] = self.maxs[block] = value
+    else:
+      self.sums[block] += value
+      if value < self.mins[block]:
+        self.mins[block] = value
+      if value > self.maxs[block]:
+        self.maxs[block] = value
+    self.total += 1
+    self.head = (self.head + 1) % self.capacity
+    self.count = min(self.count + 1, self.capacity)
+
+  def latest(self):
+    """Return the newest (timestamp, value) pair, or None if there is none."""
+    if not self.count:
+      return None
+    last = self.head - 1
+    return (self.times[last] - self.skew, self.values[last])
+
+  def _segments(self):
+    """Return the (start, end) index ranges holding the samples, oldest first."""
+    start = self.head - self.count
+    if start >= 0:
+      return [(start, self.head)]
+    return [(start + self.capacity, self.capacity), (0, self.head)]
+
+  def window(self, since):
+    """Return the count, min, max and average of the values stamped since then.
+
+    Timestamps only grow, so the first sample of the window is found by
+    bisection. The samples up to the next block boundary are read one by
+    one, the rest of the window from the aggregates of its blocks.
+    """
+    since += self.skew
+    first = self.total
+    oldest = self.total - self.count
+    for (start, end) in self._segments():
+      if self.times[end - 1] >= since:
+        slot = bisect.bisect_left(self.times, since, start, end)
+        first = oldest + (slot - self.head + self.count) % self.capacity
+        break
+    count = self.total - first
+    if not count:
+      return {'count': 0, 'min': None, 'max': None, 'avg': None}
+    edge = min(self.total, -(-first // self.block) * self.block)
+    values = _slices(self.values, first, edge)
+    first_block, end_block = edge // self.block, -(-self.total // self.block)
+    if edge == self.total:
+      end_block = first_block
+    sums = values + _slices(self.sums, first_block, end_block)
+    mins = values + _slices(self.mins, first_block, end_block)
+    maxs = values + _slices(self.maxs, first_block, end_block)
+    return {'count': count,
+            'min': min(min(part) for part in mins),
+            'max': max(max(part) for part in maxs),
+            'avg': sum(sum(part) for part in sums) / count}
+
+def _slices(items, first, end):
+  """Return the slices of an array holding its items first to end, with
+  indexes taken modulo its length."""
+  if first >= end:
+    return []
+  start = first % len(items)
+  stop = start + end - first
+  if stop <= len(items):
+    return [items[start:stop]]
+  return [items[start:], items[:stop - len(items)]]
+
+class History:
+  """Ring buffers of the readings of all sensors, keeping retention seconds of
+  readings taken every interval seconds."""
+
+  def __init__(self, retention, interval):
+    self.retention = retention
+    self.interval = interval
+    self.rings = {}
+    self.lock = threading.Lock()
+
+  def add(self, datapoints, now=None):
+    """Store (metric, value, timestamp) tuples. A timestamp of None means now."""
+    if now is None:
+      now = time.time()
+    self.lock.acquire()
+    try:
+      for (metric, value, timestamp) in datapoints:
+        ring = self.rings.get(metric)
+        if ring is None:
+          ring = self.rings[metric] = Ring(int(math.ceil(self.retention / float(self.interval))) + 1)
+        ring.append(now if timestamp is None else timestamp, value)
+    finally:
+      self.lock.release()
+
+  def latest(self):
+    """Return the newest (timestamp, value) pair of every sensor."""
+    self.lock.acquire()
+    try:
+      return dict((metric, ring.latest()) for (metric, ring) in self.rings.iteritems())
+    finally:
+      self.lock.release()
+
+  def query(self, metric, window=None, now=None):
+    """Return the latest reading of a sensor and the statistics of its readings
+    in the last window seconds, by default all retained ones. Returns None for
+    unknown sensors."""
+    if now is None:
+      now = time.time()
+    self.lock.acquire()
+    try:
+      ring = self.rings.get(metric)
+      if ring is None:
+        return None
+      result = ring.window(now - window if window is not None else float('-inf'))
+      result['time'], result['latest'] = ring.latest()
+      return result
+    finally:
+      self.lock.release()
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    metric = url.path.strip('/')
+    if not metric:
+      result = self.server.history.latest()
+    else:
+      params = urlparse.parse_qs(url.query)
+      try:
+        window = float(params['window'][0]) if 'window' in params else None
+      except ValueError:
+        self.send_error(400, "Invalid window")
+        return
+      result = self.server.history.query(metric, window)
+      if result is None:
+        self.send_error(404, "Unknown sensor")
+        return
+    body = json.dumps(result)
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class HistoryServer(BaseHTTPServer.HTTPServer):
+  """Answers queries for the readings in history over HTTP, from a background thread."""
+
+  def __init__(self, history, address=('127.0.0.1', 6334)):
+    BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+    self.history = history
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever, name='history')
+    thread.daemon = True
+    thread.start()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Local stand-in for the metricfire UDP ingest endpoint.
+
+It speaks the protocols produced by metricfire.Client, the JSON one and the
+compact one (version 3, see decode()): it parses the header and body of each
+message, checks the key fingerprint and HMAC, rejects
+replayed sequence numbers per session key and counts lost messages from the
+gaps in the sequence numbers. Used by the tests and benchmarks, and handy to
+see what a host sends:
+
+  ./ingest.py API-KEY [PORT]
+"""
+
+import sys, os, time, json, zlib, hmac, hashlib, binascii, socket, threading, logging
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import metricfire
+
+def _unb64(data):
+  return binascii.a2b_base64(data + '=' * (-len(data) % 4))
+
+def decode(message):
+  """Parse a message of any protocol version.
+
+  Returns a tuple of the key fingerprint in hex, the session key, the
+  sequence number, the HMAC in hex or None, the signed body and the list of
+  (metric, value, timestamp) datapoints. Raises ValueError, KeyError or
+  TypeError for malformed messages.
+  """
+  header_json, body = message.split('\n', 1)
+  header = json.loads(header_json)
+  if header.get('v') == 3:
+    # Binary fields are base64 encoded and the body is compressed JSON, whose
+    # datapoints refer to the metric names by their index in "n".
+    try:
+      decoded = json.loads(zlib.decompress(body))
+      fingerprint, sessionkey = binascii.hexlify(_unb64(header['f'])), _unb64(header['s'])
+      auth = binascii.hexlify(_unb64(header['a'])) if 'a' in header else None
+    except (zlib.error, binascii.Error), ex:
+      raise ValueError(str(ex))
+    names = decoded['n']
+    datapoints = [(names[index], value, timestamp) for (index, value, timestamp) in decoded['m']]
+  else:
+    decoded = json.loads(body)
+    fingerprint, sessionkey = header['f'], binascii.unhexlify(header['s'])
+    auth = header.get('a')
+    datapoints = [tuple(datapoint) for datapoint in decoded['m']]
+  return fingerprint, sessionkey, header['q'], auth, body, datapoints
+
+class IngestServer:
+  """Receives and verifies metricfire messages.
+
+  keys is a list of API keys in any encoding metricfire.Client accepts. If
+  keep is set, all received datapoints are kept in the datapoints list.
+  """
+
+  def __init__(self, keys, address=('127.0.0.1', 0), keep=True):
+    self.keys = {}
+    for key in keys:
+      rawkey = metricfire.parseKey(key)
+      self.keys[hashlib.md5(rawkey).hexdigest()] = rawkey
+    self.keep = keep
+    self.datapoints = []
+    self.counters = {'messages': 0, 'datapoints': 0, 'bytes': 0, 'malformed': 0,
+                     'unknown_key': 0, 'bad_auth': 0, 'replayed': 0}
+    # Per session key: [highest sequence number, messages received, seen set]
+    self.sessions = {}
+    self.lock = threading.Lock()
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
+    self.sock.bind(address)
+    self.address = self.sock.getsockname()
+    self._thread = None
+    self._running = False
+
+  def handle(self, message):
+    """Verify a single message and account its datapoints. Returns the list of datapoints, or None if the message was rejected."""
+    self.lock.acquire()
+    try:
+      self.counters['bytes'] += len(message)
+      try:
+        fingerprint, sessionkey, sequence, signature, body, datapoints = decode(message)
+      except (ValueError, KeyError, TypeError, IndexError):
+        self.counters['malformed'] += 1
+        return None
+
+      rawkey = self.keys.get(fingerprint)
+      if rawkey is None:
+        self.counters['unknown_key'] += 1
+        return None
+      if signature is not None:
+        auth = hmac.HMAC(rawkey, sessionkey + str(sequence) + body, hashlib.sha256)
+        if auth.hexdigest() != signature:
+          self.counters['bad_auth'] += 1
+          return None
+
+      session = self.sessions.setdefault(sessionkey, [0, 0, set()])
+      if sequence in session[2]:
+        self.counters['replayed'] += 1
+        return None
+      session[0] = max(session[0], sequence)
+      session[1] += 1
+      session[2].add(sequence)
+
+      self.counters['messages'] += 1
+      self.counters['datapoints'] += len(datapoints)
+      if self.keep:
+        self.datapoints.extend(datapoints)
+      return datapoints
+    finally:
+      self.lock.release()
+
+  def lost(self):
+    """Return the number of messages missing from the sequence numbers seen so far."""
+    self.lock.acquire()
+    try:
+      return sum(highest - received for (highest, received, seen) in self.sessions.itervalues())
+    finally:
+      self.lock.release()
+
+  def stats(self):
+    """Return the counters, the number of sessions and of lost messages."""
+    stats = dict(self.counters)
+    stats['sessions'] = len(self.sessions)
+    stats['lost'] = self.lost()
+    return stats
+
+  def _serve(self):
+    while self._running:
+      try:
+        message = self.sock.recv(65536)
+      except socket.timeout:
+        continue
+      self.handle(message)
+
+  def start(self):
+    """Start receiving messages in a background thread."""
+    self._running = True
+    self.sock.settimeout(0.1)
+    self._thread = threading.Thread(target=self._serve, name='ingest')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def drain(self, idle=0.2):
+    """Wait until no message has arrived for idle seconds."""
+    last = -1
+    while last != self.counters['bytes']:
+      last = self.counters['bytes']
+      time.sleep(idle)
+
+  def stop(self):
+    """Stop the background thread and close the socket."""
+    self._running = False
+    if self._thread is not None:
+      self._thread.join()
+    self.sock.close()
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+  port = int(sys.argv[2]) if len(sys.argv) > 2 else metricfire.Client._default_port
+  server = IngestServer([sys.argv[1]], ('0.0.0.0', port), keep=False)
+  logging.info("Listening on %s:%d" % server.address)
+  while True:
+    message = server.sock.recv(65536)
+    datapoints = server.handle(message)
+    if datapoints is None:
+      logging.warning("Rejected message: %s" % server.stats())
+    for datapoint in datapoints or []:
+      logging.info("%s %r %s" % datapoint)
+
+if __name__ == '__main__':
+  main()
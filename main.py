@@ -14,62 +14,467 @@ config object below.
 ## Supported command line switches:
   --once      : Run only once and exit after uploading the data.
   --quiet     : Don't output anything below ERROR level.
+  --async     : Read all buses from a single event loop, without threads.
 """
 
-import subprocess, time, logging, os, sys
+import subprocess, time, logging, os, sys, threading, Queue
 import metricfire
+from spool import Spool
+from scheduler import Scheduler, SensorSchedule, monotonic
+from deadband import Deadband
+from sensors import DigitempBackend, W1Backend, sensor_names, parse_reading
+# multiprocessing.pool, history and asyncore are imported where they are used.
+# They are slow to load and runs started by cron with --once rarely need them.
 
 from config import config
 
+# Thread pool used to poll several buses concurrently, see poll_buses().
+_pool = None
+# The spool of readings not uploaded yet, see get_spool().
+_spool = None
+# Change detection for the readings, see get_deadband().
+_deadband = None
+# Sensor backends by name, see get_backend().
+_backends = {}
+# Recent readings kept for local queries, see get_history().
+_history = None
+
+def get_buses():
+  """Return the list of configured 1-Wire buses.
+
+  Each bus is a dict with a 'port', a digitemp 'configfile' and its
+  'sensors', see sensor_names(). The optional 'backend' selects how the bus
+  is read, see get_backend(). Without config['buses'], the top level
+  settings describe the only bus.
+  """
+  if config.get('buses'):
+    return config['buses']
+  return [{'backend': config.get('backend', 'digitemp'),
+           'port': config.get('port', '/dev/ttyS0'),
+           'configfile': config.get('configfile', 'digitemp.conf'),
+           'sensors': config['sensors']}]
+
+def sensor_interval(sensor):
+  """Return the polling interval of a sensor."""
+  if isinstance(sensor, dict):
+    return sensor.get('interval', config['interval'])
+  return config['interval']
+
 def check_create_config_file():
-  """Check for the presence of the config file and create it, if it is missing."""
-  binary = config['digitemp']
-  port   = config.get('port', '/dev/ttyS0')
-  path   = config.get('configfile', 'digitemp.conf')
-  path   = os.path.abspath(path)
-  if not os.path.exists(path):
-    # create the config file using digitemp
-    logging.info("Creating config file %s" % path)
-    ret = subprocess.call([binary, '-i', '-c', path, '-q', '-s', port])
-    if ret:
-      logging.error("Error creating the config file")
+  """Check for the presence of the config files and create them, if they are missing."""
+  binary  = config['digitemp']
+  created = False
+  for bus in get_buses():
+    if bus.get('backend', 'digitemp') != 'digitemp':
+      continue
+    port = bus.get('port', '/dev/ttyS0')
+    path = os.path.abspath(bus.get('configfile', 'digitemp.conf'))
+    if not os.path.exists(path):
+      # create the config file using digitemp
+      logging.info("Creating config file %s" % path)
+      ret = subprocess.call([binary, '-i', '-c', path, '-q', '-s', port])
+      if ret:
+        logging.error("Error creating the config file")
+      else:
+        logging.info("Created the config file %s. Use '%s -c %s -a' to query the sensors and update the designated names in config.py." % (path, binary, path))
+      created = True
     else:
-      logging.info("Created the config file %s. Use '%s -c %s -a' to query the sensors and update the designated names in config.py." % (path, binary, path))
+      logging.debug("Using existing config file %s" % path)
+  if created:
     sys.exit()
+
+def get_backend(bus):
+  """Return the sensor backend of a bus.
+
+  'digitemp', the default, runs config['digitemp']. 'w1' reads the sysfs
+  files of the kernel w1_therm driver below config['w1_devices'].
+  """
+  name = bus.get('backend', 'digitemp')
+  if name not in _backends:
+    if name == 'digitemp':
+      _backends[name] = DigitempBackend(config['digitemp'])
+    elif name == 'w1':
+      _backends[name] = W1Backend(config.get('w1_devices', '/sys/bus/w1/devices'))
+    else:
+      raise ValueError("Unknown sensor backend: %s" % name)
+  return _backends[name]
+
+def digitemp_only():
+  """Tell whether all buses are read with digitemp, which streaming needs."""
+  return all(bus.get('backend', 'digitemp') == 'digitemp' for bus in get_buses())
+
+def get_readings(bus=None):
+  """Query the temperature sensors of a bus, by default the first one.
+
+  This returns a (name, temperature, timestamp) tuple for every sensor, see
+  Backend.readings(). If the bus can't be read, the error is logged and no
+  readings are returned, so the other buses are still uploaded."""
+  if bus is None:
+    bus = get_buses()[0]
+  before = time.time()
+  try:
+    readings = get_backend(bus).readings(bus)
+  except (EnvironmentError, subprocess.CalledProcessError), ex:
+    logging.error("Could not read the bus on %s: %s" % (bus.get('port', '/dev/ttyS0'), ex))
+    return []
+  metricfire.observe(bus.get('backend', 'digitemp'), time.time() - before)
+  return readings
+
+def get_reading(bus, sensor):
+  """Query a single sensor of a bus by its index, returns its (name,
+  temperature, timestamp), or None if it couldn't be read."""
+  before = time.time()
+  try:
+    reading = get_backend(bus).reading(bus, sensor)
+  except (EnvironmentError, subprocess.CalledProcessError), ex:
+    logging.error("Could not read sensor %d: %s" % (sensor, ex))
+    return None
+  metricfire.observe(bus.get('backend', 'digitemp'), time.time() - before)
+  return reading
+
+def poll_buses():
+  """Query all buses, concurrently if there is more than one.
+
+  This returns the merged readings of all buses, see get_readings().
+  """
+  global _pool
+  buses = get_buses()
+  if len(buses) == 1:
+    results = [get_readings(buses[0])]
   else:
-    logging.debug("Using existing config file %s" % path)
-    return
+    if _pool is None:
+      from multiprocessing.pool import ThreadPool
+      _pool = ThreadPool(len(buses))
+    results = _pool.map(get_readings, buses)
+  return [reading for readings in results for reading in readings]
 
-def get_temperatures():
-  """Query the temperatur sensor.
-  
-   This returns a list of temperatures converted to float values."""
-  # Config file path
-  path = config.get('configfile', 'digitemp.conf')
-  path = os.path.abspath('digitemp.conf')
-  args = [ '-a',                    # Query all sensors
-           '-c', path,              # config file path
-           '-q',                    # omit the banner
-           '-o %C',                 # show only the temperatur in Celsius
+def start_digitemp_stream(bus):
+  """Start digitemp in its loop mode for a bus and return the process."""
+  args = [ '-n', '0',                       # loop forever
+           '-d', str(config['interval']),   # delay between rounds
            ]
-  temp_str = subprocess.check_output([config['digitemp']] + args)
-  temps = map(float, temp_str.split())
-  return temps
+  logging.debug("Starting digitemp in streaming mode.")
+  return subprocess.Popen(get_backend(bus).command(bus) + args, stdout=subprocess.PIPE)
 
-def send_temperatures(values):
-  """Send a list of temperatures to the metricfire API.
+def stream_temperatures(bus=None):
+  """Query the temperature sensors of a bus continuously.
 
-  This maps the temperatures to names in the config['sensors'] list.
+  This starts digitemp once in its loop mode and yields a (timestamp,
+  readings) tuple for every complete round of readings, see get_readings().
+  The timestamp is when the round was complete. If digitemp exits, it is
+  restarted after a delay which doubles up to config['stream_max_backoff']
+  seconds while it keeps failing.
   """
-  for name, temp in zip(config['sensors'], values):
-    # Send the value
+  if bus is None:
+    bus = get_buses()[0]
+  backend = get_backend(bus)
+  count = backend.round_size(bus)
+  index = backend.sensor_index(bus)
+  min_backoff = config.get('stream_backoff', 1)
+  max_backoff = config.get('stream_max_backoff', 60)
+  backoff = min_backoff
+  while True:
+    proc = start_digitemp_stream(bus)
+    try:
+      readings = []
+      # Use readline() rather than iterating the file to avoid read-ahead
+      # buffering, which would delay the readings.
+      for line in iter(proc.stdout.readline, ''):
+        reading = parse_reading(line, index)
+        if reading is None:
+          continue
+        readings.append(reading)
+        if len(readings) == count:
+          yield time.time(), [reading for reading in readings if reading[0] is not None]
+          readings = []
+          backoff = min_backoff
+    finally:
+      if proc.poll() is None:
+        proc.terminate()
+      proc.wait()
+    logging.error("digitemp exited with status %s, restarting in %ss." % (proc.returncode, backoff))
+    time.sleep(backoff)
+    backoff = min(backoff * 2, max_backoff)
+
+def stream_buses():
+  """Query all buses continuously.
+
+  Every bus is read by its own streaming digitemp process and thread. This
+  yields a (timestamp, readings) tuple for each round of readings of any bus.
+  """
+  readings = Queue.Queue()
+  def reader(bus):
+    for round in stream_temperatures(bus):
+      readings.put(round)
+  for bus in get_buses():
+    thread = threading.Thread(target=reader, args=(bus,))
+    thread.daemon = True
+    thread.start()
+  while True:
+    # A timeout keeps the wait interruptible by ctrl-c.
+    try:
+      yield readings.get(timeout=3600)
+    except Queue.Empty:
+      pass
+
+# Defined by digitemp_reader_class() on first use, so runs without --async
+# don't import asyncore.
+_DigitempReader = None
+
+def digitemp_reader_class():
+  """Return the asyncore dispatcher class reading streaming digitemp processes."""
+  global _DigitempReader
+  if _DigitempReader is None:
+    import asyncore
+    class _DigitempReader(asyncore.file_dispatcher):
+      """Reads the output of a streaming digitemp process in an asyncore loop.
+
+      Every complete round of readings of the bus is sent right away, without
+      blocking the loop (see send_readings()). If digitemp
+      exits, restart() tells when the process should be started again, using the
+      same backoff as stream_temperatures().
+      """
+
+      def __init__(self, bus, map=None):
+        self.bus = bus
+        self.backoff = config.get('stream_backoff', 1)
+        self.restart_at = None
+        self._map = map
+        self._start()
+
+      def _start(self):
+        self.proc = start_digitemp_stream(self.bus)
+        self.pending = ''
+        self.readings = []
+        backend = get_backend(self.bus)
+        self.count = backend.round_size(self.bus)
+        self.index = backend.sensor_index(self.bus)
+        asyncore.file_dispatcher.__init__(self, self.proc.stdout.fileno(), self._map)
+        # file_dispatcher works on a duplicate of the descriptor.
+        self.proc.stdout.close()
+
+      def writable(self):
+        return False
+
+      def handle_read(self):
+        self.pending += self.recv(4096)
+        lines = self.pending.split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+          reading = parse_reading(line, self.index)
+          if reading is None:
+            continue
+          self.readings.append(reading)
+          if len(self.readings) == self.count:
+            send_readings([reading for reading in self.readings if reading[0] is not None], time.time(), block=False)
+            self.readings = []
+            self.backoff = config.get('stream_backoff', 1)
+
+      def handle_close(self):
+        self.close()
+        if self.proc.poll() is None:
+          self.proc.terminate()
+        self.proc.wait()
+        logging.error("digitemp exited with status %s, restarting in %ss." % (self.proc.returncode, self.backoff))
+        self.restart_at = time.time() + self.backoff
+        self.backoff = min(self.backoff * 2, config.get('stream_max_backoff', 60))
+
+      def restart(self, now):
+        """Start digitemp again if it has exited and its backoff has passed."""
+        if self.restart_at is not None and now >= self.restart_at:
+          self.restart_at = None
+          self._start()
+  return _DigitempReader
+
+def run_event_loop(map=None):
+  """Read all buses and upload their readings from a single asyncore loop."""
+  import asyncore
+  if map is None:
+    map = asyncore.socket_map
+  reader_class = digitemp_reader_class()
+  readers = [reader_class(bus, map) for bus in get_buses()]
+  while True:
+    if map:
+      asyncore.loop(timeout=1, map=map, count=1)
+    else:
+      # Everything has exited, wait for the next restart.
+      time.sleep(1)
+    now = time.time()
+    for reader in readers:
+      reader.restart(now)
+
+def send_readings(readings, timestamp=None, block=True):
+  """Send (name, temperature, timestamp) tuples to the metricfire API.
+
+  Each reading keeps the time it was read, unless config['timestamps'] is
+  'tick': then all are stamped with timestamp, the time of the poll, so the
+  readings of many hosts line up. All readings of one poll are sent
+  together, usually in a single datagram.
+
+  If config['history'] is set, all values are kept for local queries, see
+  get_history(). If config['deadband'] is set, only values that changed
+  noticeably or are due for a heartbeat are sent, see get_deadband(). If
+  config['spool'] is
+  set, the values are written to the spool first and then uploaded together
+  with any backlog, see drain_spool(), which doesn't wait unless block is set.
+  """
+  spool = get_spool()
+  if timestamp is None and spool is not None:
+    timestamp = time.time()
+  datapoints = []
+  for (name, temp, read) in readings:
     logging.debug("Sending temperature: %s" % temp)
-    metricfire.send(name, temp)
+    if read is None or config.get('timestamps', 'read') == 'tick':
+      # Spooled readings are uploaded later, so they need a time, too.
+      read = timestamp
+    datapoints.append((name, temp, read))
+  history = get_history()
+  if history is not None:
+    history.add(datapoints)
+  deadband = get_deadband()
+  if deadband is not None:
+    datapoints = filter_deadband(deadband, datapoints, timestamp)
+  if spool is not None:
+    spool.append(datapoints)
+    drain_spool(block)
+  else:
+    metricfire.send_many(datapoints)
+
+def get_history():
+  """Return the store of recent readings configured in config['history'], or None.
+
+  It is sized for readings of the sensor with the shortest interval. If
+  config['history_port'] is set, the readings can be queried over HTTP on
+  that port of localhost, see history.py.
+  """
+  global _history
+  if _history is None and config.get('history'):
+    from history import History, HistoryServer
+    interval = min(sensor_interval(sensor) for bus in get_buses() for sensor in bus['sensors'])
+    _history = History(config['history'], interval)
+    if config.get('history_port'):
+      HistoryServer(_history, ('127.0.0.1', config['history_port'])).start()
+  return _history
+
+def get_deadband():
+  """Return the change detection configured in config['deadband'], or None."""
+  global _deadband
+  if _deadband is None and config.get('deadband') is not None:
+    _deadband = Deadband(config['deadband'], config.get('heartbeat'), config.get('ewma_alpha'))
+    if config.get('deadband_state'):
+      _deadband.load(config['deadband_state'])
+  return _deadband
+
+def filter_deadband(deadband, datapoints, timestamp=None):
+  """Drop the readings which didn't change, and add the filter's statistics."""
+  datapoints = deadband.filter(datapoints)
+  logging.debug("Deadband: %d readings sent, %d suppressed so far." % (deadband.sent, deadband.suppressed))
+  if config.get('deadband_state'):
+    # Keep the state across --once runs.
+    deadband.save(config['deadband_state'])
+  if config.get('deadband_metrics'):
+    datapoints += deadband.datapoints(config['deadband_metrics'], timestamp)
+  return datapoints
+
+def get_spool():
+  """Return the spool configured in config['spool'], or None."""
+  global _spool
+  if _spool is None and config.get('spool'):
+    _spool = Spool(config['spool'], max_bytes=config.get('spool_max_bytes', 10*1024*1024))
+  return _spool
+
+def drain_spool(block=True):
+  """Upload the spooled readings in batches at a limited rate.
+
+  Unless block is set, e.g. in the event loop of --async, it neither waits
+  for the metricfire server to be resolved nor sleeps to limit the rate, and
+  uploads a single batch. The backlog then goes out one batch per round of
+  readings.
+  """
+  spool = get_spool()
+  # Readings can't be uploaded before the metricfire server is resolved.
+  if not metricfire.wait(config.get('spool_wait', 5) if block else 0):
+    logging.warning("Metricfire server not resolved, keeping %d bytes of readings spooled." % spool.pending())
+    return
+  if block:
+    sent = spool.drain(metricfire.send_many, rate=config.get('spool_rate', 1000),
+                       max_seconds=config.get('spool_drain_time', 20))
+  else:
+    # No time at all stops the drain after its first batch.
+    sent = spool.drain(metricfire.send_many, max_seconds=0)
+  logging.debug("Uploaded %d spooled readings." % sent)
 
-def send_receive():
-  """Wrap getting and sending the values once."""
-  values = get_temperatures()
-  send_temperatures(values)
+def send_receive(timestamp=None):
+  """Wrap getting and sending the values of all buses once."""
+  send_readings(poll_buses(), timestamp)
+
+def has_sensor_intervals():
+  """Tell whether any sensor has a polling interval of its own."""
+  for bus in get_buses():
+    for sensor in bus['sensors']:
+      if isinstance(sensor, dict) and 'interval' in sensor:
+        return True
+  return False
+
+def poll_sensors(bus, indexes):
+  """Read the sensors of a bus with the given indexes, one after the other.
+
+  Returns the readings, see get_readings(), and the time the bus was busy.
+  """
+  before = monotonic()
+  readings = [get_reading(bus, index) for index in indexes]
+  return [reading for reading in readings if reading is not None], monotonic() - before
+
+def run_per_sensor():
+  """Poll every sensor at its own interval.
+
+  A min-heap of due times picks the sensors to read next, so bus time is
+  spent where resolution is needed. Buses are read concurrently.
+  """
+  global _pool
+  buses = get_buses()
+  sensors = []
+  for bus_index, bus in enumerate(buses):
+    for index, sensor in enumerate(bus['sensors']):
+      sensors.append(((bus_index, index), sensor_interval(sensor)))
+  schedule = SensorSchedule(sensors, len(buses))
+  prefix = config.get('scheduler_metrics')
+  if len(buses) > 1 and _pool is None:
+    from multiprocessing.pool import ThreadPool
+    _pool = ThreadPool(len(buses))
+  while True:
+    delay = schedule.next_due() - monotonic()
+    if delay > 0:
+      time.sleep(delay)
+    due = {}
+    for (bus_index, index) in schedule.pop_due(monotonic()):
+      due.setdefault(bus_index, []).append(index)
+    jobs = [(buses[bus_index], indexes) for (bus_index, indexes) in sorted(due.items())]
+    if len(jobs) == 1:
+      results = [poll_sensors(*jobs[0])]
+    else:
+      results = _pool.map(lambda job: poll_sensors(*job), jobs)
+    readings = []
+    for (bus_index, indexes), (bus_readings, busy) in zip(sorted(due.items()), results):
+      schedule.add_busy(bus_index, busy)
+      readings.extend(bus_readings)
+    timestamp = time.time()
+    send_readings(readings, timestamp)
+    utilisation = schedule.utilisation()
+    logging.debug("Bus utilisation: %s" % ', '.join('%.0f%%' % (100 * u) for u in utilisation))
+    if prefix:
+      metricfire.send_many([('%s.bus%d.utilisation' % (prefix, i), u, timestamp) for i, u in enumerate(utilisation)])
+
+def run_scheduled():
+  """Poll all buses on every tick of the scheduler. With config['timestamps']
+  set to 'tick', the readings are stamped with the tick time so they line up
+  with those of other hosts."""
+  scheduler = Scheduler(config['interval'], policy=config.get('missed_ticks', 'skip'))
+  prefix = config.get('scheduler_metrics')
+  for tick in scheduler:
+    send_receive(tick)
+    if prefix:
+      metricfire.send_many(scheduler.datapoints(prefix, tick))
 
 def main():
   # setup logging
@@ -82,22 +487,56 @@ def main():
 
   # Make sure, a digitemp configfile exists
   check_create_config_file()
+  # Streaming and the event loop drive digitemp processes, other backends are polled.
+  use_async = '--async' in sys.argv and '--once' not in sys.argv
+  streaming = config.get('streaming', False) and '--once' not in sys.argv
+  if (use_async or streaming) and not digitemp_only():
+    logging.warning("Streaming and --async need digitemp on all buses, polling instead.")
+    use_async = streaming = False
   # Initialize metrifire API
   logging.debug("Initializing Metricfire API.")
-  metricfire.init(config['api-key'], try_adns=config.get('metricfire_try_adns', False))
-  while True:
-    before = time.time()
-    send_receive()
-    now = time.time()
+  if config.get('metricfire_relay'):
+    metricfire.init_relay(config['metricfire_relay'])
+  elif use_async:
+    metricfire.init_async(config['api-key'], server=config.get('metricfire_server'),
+                          try_adns=config.get('metricfire_try_adns', False),
+                          dns_cache=config.get('metricfire_dns_cache'),
+                          dns_ttl=config.get('metricfire_dns_ttl', 300),
+                          compact=config.get('metricfire_compact', False),
+                          internal_interval=config.get('metricfire_internal_interval'))
+  else:
+    metricfire.init(config['api-key'], server=config.get('metricfire_server'),
+                    try_adns=config.get('metricfire_try_adns', False),
+                    dns_cache=config.get('metricfire_dns_cache'),
+                    dns_ttl=config.get('metricfire_dns_ttl', 300),
+                    compact=config.get('metricfire_compact', False),
+                    buffered=config.get('metricfire_buffered', False),
+                    internal_interval=config.get('metricfire_internal_interval'))
 
-    if '--once' in sys.argv:
-      logging.debug("Exiting")
-      break
+  if use_async:
+    if streaming or has_sensor_intervals():
+      logging.warning("--async reads all sensors of a bus in every round, ignoring 'streaming' and the intervals of sensors.")
+    run_event_loop()
 
-    if now - before > config['interval']:
-      logging.info("Interval exceeded.")
-    else:
-      time.sleep(config['interval'] - (now - before))
+  if streaming:
+    for timestamp, readings in stream_buses():
+      send_readings(readings, timestamp)
+
+  if '--once' in sys.argv:
+    # Cron starts us at the interval boundary, stamp the readings with it
+    # if they are stamped by tick.
+    tick = time.time() // config['interval'] * config['interval']
+    readings = poll_buses()
+    # The server is resolved in the background while the sensors are read.
+    # Unless they are spooled, readings sent before that would be lost.
+    if get_spool() is None and not metricfire.wait(config.get('resolve_wait', 5)):
+      logging.error("Metricfire server not resolved, the readings can't be uploaded.")
+    send_readings(readings, tick)
+    logging.debug("Exiting")
+  elif has_sensor_intervals():
+    run_per_sensor()
+  else:
+    run_scheduled()
 
 if __name__ == '__main__':
   main()
@@ -9,12 +9,16 @@ import sys
 import hmac
 import time
 import types
+import errno
+import fcntl
+import atexit
 import socket
-import random
-import inspect
+import select
+import bisect
 import hashlib
 import binascii
 import warnings
+import itertools
 import threading
 
 try:
@@ -22,12 +26,386 @@ try:
 except ImportError:
    import json
 
-_adns_import_exception = None
-try:
-   import adns
-except ImportError, ex:
-   _adns_import_exception = ex
-   adns = None
+# adns is optional. Without it, DNS lookups run in a background thread, see
+# Resolver. It is only looked for when a Client wants it, see _loadAdns().
+adns = None
+_adns_probed = False
+
+def _loadAdns():
+   """Import adns on first use, so programs not using it don't pay for searching it. Returns the module, or None if it isn't installed."""
+   global adns, _adns_probed
+   if not _adns_probed:
+      _adns_probed = True
+      try:
+         import adns
+      except ImportError:
+         adns = None
+   return adns
+
+def _loadMonotonic():
+   """Return a function reading CLOCK_MONOTONIC in seconds, or time.time if there is none. Python 2 has no time.monotonic(), so clock_gettime() is called through ctypes."""
+   if hasattr(time, 'monotonic'):
+      return time.monotonic
+   try:
+      import ctypes
+      # Loaded by its soname: ctypes.util.find_library() would run ldconfig
+      # or gcc in a subprocess.
+      clock_gettime = ctypes.CDLL('librt.so.1', use_errno = True).clock_gettime
+   except (ImportError, OSError, AttributeError):
+      return time.time
+   class timespec(ctypes.Structure):
+      _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+   def monotonic():
+      t = timespec()
+      # 1 is CLOCK_MONOTONIC in linux/time.h.
+      if clock_gettime(1, ctypes.byref(t)) != 0:
+         error = ctypes.get_errno()
+         raise OSError(error, os.strerror(error))
+      return t.tv_sec + t.tv_nsec * 1e-9
+   return monotonic
+
+# The clock read by monotonic(). It is loaded on the first call, since ctypes
+# is slow to import, which programs that never time anything, like short cron
+# runs, would pay for nothing.
+_monotonic = None
+
+def monotonic():
+   """Return the time of a clock that never goes backwards, in seconds, so steps of the wall clock, e.g. by NTP, don't distort timings. Falls back to time.time() where there is none."""
+   global _monotonic
+   if _monotonic is None:
+      _monotonic = _loadMonotonic()
+   return _monotonic()
+
+def atomicWrite(path, data):
+   """Replace the file at path with data. It is written to a temporary file next to it first and renamed over path, so a crash never leaves a truncated file behind and readers never see a partial one. The temporary file is named after the process and thread, so concurrent writers don't clobber each other's. Raises IOError or OSError if writing fails."""
+   tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+   f = open(tmp, 'w')
+   try:
+      f.write(data)
+   finally:
+      f.close()
+   os.rename(tmp, path)
+
+def _b64(data):
+   """Base64 without padding or newline, for the binary fields of compact headers."""
+   return binascii.b2a_base64(data).rstrip('=\n')
+
+class Resolver:
+   """Resolves a host name in a background thread, so looking it up never blocks the caller. The addresses are re-resolved every ttl seconds, or sooner when refresh() is called, and published as an immutable tuple in the sockaddrs attribute."""
+
+   def __init__(self, host, port, ttl = 300, retry = 5, sockaddrs = (), expires = 0):
+      """sockaddrs are addresses known already, e.g. from a cache, which are used until the first lookup at the time expires. The expires attribute tells until when the current addresses are valid."""
+      self.sockaddrs = sockaddrs
+      self.expires   = expires
+      self._host     = host
+      self._port     = port
+      self._ttl      = ttl
+      self._retry    = retry
+      self._ready    = threading.Event()
+      # refresh() writes to the pipe to wake the thread up, see _sleep().
+      (self._wakeup_read, self._wakeup_write) = os.pipe()
+      fcntl.fcntl(self._wakeup_write, fcntl.F_SETFL, os.O_NONBLOCK)
+      # Set by stop(). The lock keeps the thread from closing the pipe while
+      # refresh() or stop() write to it.
+      self._stopped  = False
+      self._lock     = threading.Lock()
+      self._thread   = threading.Thread(target = self._resolveLoop, name = "metricfire-dns")
+      self._thread.daemon = True
+      if sockaddrs:
+         self._ready.set()
+      self._thread.start()
+
+   def _resolve(self):
+      """Look up the IPv4 UDP addresses of the host. Returns an empty tuple on failure."""
+      try:
+         infos = socket.getaddrinfo(self._host, self._port, socket.AF_INET, socket.SOCK_DGRAM)
+      except socket.error:
+         return ()
+      return tuple(sorted(set(sockaddr for (family, socktype, proto, canonname, sockaddr) in infos)))
+
+   def _sleep(self, delay):
+      """Sleep up to delay seconds, or until refresh() is called. This blocks in select() rather than in threading's waits, which poll in Python code; a daemon thread running Python code while the interpreter shuts down prints tracebacks, and polling wakes the CPU up."""
+      if select.select([self._wakeup_read], [], [], delay)[0]:
+         os.read(self._wakeup_read, 4096)
+
+   def _resolveLoop(self):
+      try:
+         self._lookups()
+      finally:
+         self._lock.acquire()
+         try:
+            self.close()
+         finally:
+            self._lock.release()
+
+   def _lookups(self):
+      if self.expires > time.time():
+         self._sleep(self.expires - time.time())
+      while not self._stopped:
+         started = time.time()
+         sockaddrs = self._resolve()
+         if sockaddrs:
+            # Replacing the attribute is atomic, readers see either the old or
+            # the new tuple. Keep the old addresses if the lookup failed.
+            self.sockaddrs = sockaddrs
+            # Set after the addresses, so whoever sees the new expiry time
+            # also sees the new addresses.
+            self.expires = started + self._ttl
+            self._ready.set()
+            delay = self._ttl
+         else:
+            delay = self._retry
+         self._sleep(delay)
+         if self._stopped:
+            break
+         # Don't hammer the DNS server if refresh() is called repeatedly.
+         time.sleep(max(0, started + self._retry - time.time()))
+
+   def refresh(self):
+      """Resolve the host again now, e.g. because sending to it failed."""
+      self._lock.acquire()
+      try:
+         if not self._stopped and self._wakeup_write is not None:
+            os.write(self._wakeup_write, 'x')
+      except OSError:
+         pass # The pipe is full, a refresh is pending anyway.
+      finally:
+         self._lock.release()
+
+   def stop(self):
+      """Let the thread exit. It closes the wakeup pipe when it does."""
+      self._lock.acquire()
+      try:
+         if not self._stopped:
+            self._stopped = True
+            if self._wakeup_write is not None:
+               os.write(self._wakeup_write, 'x')
+      except OSError:
+         pass # The pipe is full, the thread wakes up anyway.
+      finally:
+         self._lock.release()
+
+   def close(self):
+      """Close the wakeup pipe, e.g. in a forked child which starts its own Resolver. The thread of this one is gone there. Closing again does nothing: the descriptors may have been reused by then."""
+      if self._wakeup_read is None:
+         return
+      os.close(self._wakeup_read)
+      os.close(self._wakeup_write)
+      self._wakeup_read = self._wakeup_write = None
+
+   def wait(self, timeout = None):
+      """Wait until the host has been resolved at least once. Returns True if it has."""
+      self._ready.wait(timeout)
+      return self._ready.is_set()
+
+class EndpointPool:
+   """Connected UDP sockets to the resolved server addresses, and a consistent hash ring sharding metric names across them. Connecting a socket does the route lookup once instead of on every packet, and lets the kernel report ICMP port unreachable errors as ECONNREFUSED. Addresses that refuse messages are ejected from the ring for eject_time seconds; their metrics move to the next address on the ring meanwhile. Adding or removing an address only moves the metrics hashing next to it. With per_thread, every thread gets its own sockets."""
+
+   # Points per address on the hash ring. More points spread the metrics more
+   # evenly at the cost of a larger ring.
+   _replicas = 64
+
+   def __init__(self, eject_time = 30.0, per_thread = False):
+      self.sockaddrs  = ()
+      self.eject_time = eject_time
+      # Sorted hashes of the ring points and the address of each, replaced
+      # as a whole so readers never see a half built ring.
+      self._ring      = ([], [])
+      self._sockets   = {}
+      self._local     = threading.local() if per_thread else None
+      # Bumped whenever the addresses change, so threads know to close their
+      # sockets of addresses that went away, see socket().
+      self._generation = 0
+      # Ejected address -> time until which it is ejected.
+      self._ejected   = {}
+
+   def _hash(self, name):
+      return binascii.crc32(name) & 0xffffffff
+
+   def update(self, sockaddrs):
+      """Rebuild the ring if the resolved addresses have changed."""
+      if sockaddrs == self.sockaddrs:
+         return
+      points = sorted((self._hash("%s:%d-%d" % (sockaddr + (i,))), sockaddr) for sockaddr in sockaddrs for i in range(self._replicas))
+      self._ring = ([h for (h, sockaddr) in points], [sockaddr for (h, sockaddr) in points])
+      # Shared sockets of addresses that went away are closed once
+      # unreferenced, so a thread still sending through one doesn't fail.
+      # Per-thread ones are closed by their thread, see socket().
+      self._sockets = dict((sockaddr, sock) for (sockaddr, sock) in self._sockets.items() if sockaddr in sockaddrs)
+      self._ejected = dict((sockaddr, until) for (sockaddr, until) in self._ejected.items() if sockaddr in sockaddrs)
+      self.sockaddrs = sockaddrs
+      self._generation += 1
+
+   def pick(self, metric):
+      """Return the address a metric is sent to: the first address on the ring after its hash that isn't ejected. If all are ejected, ejection is ignored."""
+      (hashes, sockaddrs) = self._ring
+      start = bisect.bisect(hashes, self._hash(metric)) % len(hashes)
+      if not self._ejected:
+         return sockaddrs[start]
+      now = time.time()
+      for i in xrange(start, start + len(sockaddrs)):
+         sockaddr = sockaddrs[i % len(sockaddrs)]
+         if self._ejected.get(sockaddr, 0) <= now:
+            return sockaddr
+      return sockaddrs[start]
+
+   def shard(self, datapoints):
+      """Group (metric, value, timestamp) tuples by the address of their metric. Returns a list of (sockaddr, datapoints) tuples, keeping the order of the datapoints within each group."""
+      if len(self.sockaddrs) == 1:
+         return [(self.sockaddrs[0], datapoints)]
+      groups = {}
+      for datapoint in datapoints:
+         groups.setdefault(self.pick(datapoint[0]), []).append(datapoint)
+      return sorted(groups.items())
+
+   def eject(self, sockaddr):
+      """Take an address out of the ring for eject_time seconds. Returns another address to send to instead, or None if there is no live one."""
+      self._ejected[sockaddr] = time.time() + self.eject_time
+      now = time.time()
+      for other in self.sockaddrs:
+         if self._ejected.get(other, 0) <= now:
+            return other
+      return None
+
+   def ejected(self):
+      """Return the number of addresses currently ejected."""
+      now = time.time()
+      return len([until for until in self._ejected.values() if until > now])
+
+   def socket(self, sockaddr):
+      """Return the socket connected to an address, connecting it on first use."""
+      sockets = self._sockets
+      if self._local is not None:
+         sockets = getattr(self._local, 'sockets', None)
+         if sockets is None:
+            sockets = self._local.sockets = {}
+            self._local.generation = self._generation
+         elif self._local.generation != self._generation:
+            # The addresses have changed. Only this thread uses its sockets,
+            # so those of addresses that went away can be closed right away.
+            self._local.generation = self._generation
+            for other in sockets.keys():
+               if other not in self.sockaddrs:
+                  sockets.pop(other).close()
+      sock = sockets.get(sockaddr)
+      if sock is None:
+         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+         sock.connect(sockaddr)
+         sockets[sockaddr] = sock
+      return sock
+
+class Aggregator:
+   """Accumulates values per metric name in-process: count, sum, min, max and a fixed-bucket histogram. collect() turns them into a few datapoints per metric and starts over."""
+
+   # Upper bounds of the histogram buckets, four per power of two from 1us to
+   # about 150s. Percentiles are reported as the upper bound of the bucket
+   # they fall into, so they are accurate to within 19%.
+   _bounds = [1e-6 * 2 ** (i / 4.0) for i in range(109)]
+
+   _percentiles = ((0.5, 'p50'), (0.95, 'p95'), (0.99, 'p99'))
+
+   def __init__(self):
+      self._stats = {}
+      self._lock = threading.Lock()
+
+   def add(self, metric, value, weight = 1):
+      """Account a value for a metric. A weight above 1 accounts it as that many occurrences, e.g. for a value sampled from one in weight calls."""
+      bucket = bisect.bisect_left(self._bounds, value)
+      self._lock.acquire()
+      try:
+         stats = self._stats.get(metric)
+         if stats is None:
+            # [count, sum, min, max, histogram]
+            self._stats[metric] = [weight, value * weight, value, value, {bucket: weight}]
+         else:
+            stats[0] += weight
+            stats[1] += value * weight
+            if value < stats[2]:
+               stats[2] = value
+            if value > stats[3]:
+               stats[3] = value
+            stats[4][bucket] = stats[4].get(bucket, 0) + weight
+      finally:
+         self._lock.release()
+
+   def _copy(self, reset = False):
+      """Return a copy of the accumulated values, starting over if reset is set."""
+      self._lock.acquire()
+      if reset:
+         stats, self._stats = self._stats, {}
+      else:
+         stats = dict((metric, values[:4] + [dict(values[4])]) for metric, values in self._stats.iteritems())
+      self._lock.release()
+      return stats
+
+   def merge(self, other):
+      """Add the values accumulated by another Aggregator to this one's."""
+      for metric, (count, total, low, high, histogram) in other._copy().iteritems():
+         self._lock.acquire()
+         try:
+            stats = self._stats.get(metric)
+            if stats is None:
+               self._stats[metric] = [count, total, low, high, histogram]
+            else:
+               stats[0] += count
+               stats[1] += total
+               stats[2] = min(stats[2], low)
+               stats[3] = max(stats[3], high)
+               for (bucket, hits) in histogram.iteritems():
+                  stats[4][bucket] = stats[4].get(bucket, 0) + hits
+         finally:
+            self._lock.release()
+
+   def summary(self, reset = False):
+      """Return a dict mapping each metric to a dict of its count, avg, min, max, p50, p95 and p99. Starts over if reset is set."""
+      stats = self._copy(reset)
+      summary = {}
+      for metric, (count, total, low, high, histogram) in stats.iteritems():
+         values = {'count': count, 'avg': float(total) / count, 'min': low, 'max': high}
+         buckets = sorted(histogram.iteritems())
+         for (fraction, name) in self._percentiles:
+            rank = fraction * count
+            seen = 0
+            for (bucket, hits) in buckets:
+               seen += hits
+               if seen >= rank:
+                  break
+            # Clamp the bucket bound to the observed range.
+            bound = self._bounds[bucket] if bucket < len(self._bounds) else high
+            values[name] = min(max(bound, low), high)
+         summary[metric] = values
+      return summary
+
+   def take(self):
+      """Return a new Aggregator holding the accumulated values and start over, e.g. to merge() them back if sending them fails."""
+      taken = Aggregator()
+      taken._stats = self._copy(reset = True)
+      return taken
+
+   def collect(self, timestamp = None, reset = True):
+      """Return the accumulated values as a list of (metric, value, timestamp) tuples and reset them, unless reset is False. Every metric yields metric.count, .avg, .min, .max, .p50, .p95 and .p99."""
+      datapoints = []
+      for metric, values in self.summary(reset = reset).iteritems():
+         for name in ('count', 'avg', 'min', 'max', 'p50', 'p95', 'p99'):
+            datapoints.append(("%s.%s" % (metric, name), values[name], timestamp))
+      return datapoints
+
+def parseKey(key):
+   """Return the raw bytes of a key given as a UUID or in Base64 encoding. Raises ValueError if it is neither."""
+   # Attempt to parse the key as a UUID, then Base64 encoded bytes, then fail.
+   try:
+      # Remove dashes and check the key length.
+      rawkey = binascii.unhexlify(key.replace("-", ""))
+      assert len(rawkey) == 16
+   except (TypeError, AssertionError), ex:
+      # Key is not a valid UUID, test base64 decoding next.
+      try:
+         rawkey = binascii.a2b_base64(key)
+         assert len(rawkey) == 32 
+      except (binascii.Error, AssertionError), ex:
+         # Key is not a valid base64 key either!
+         raise ValueError("Unable to parse key in either UUID or Base64 encodings: %s" % key)
+   return rawkey
 
 # If the user wants to use the module-level interface, this will hold a
 # reference to a Client object. Otherwise, the user will use the Client
@@ -42,43 +420,72 @@ class Client:
    _default_server = "udp-api.metricfire.com:%d" % _default_port
 
    _protoversion = 2
+   # Version of the compact encoding, see _compactBody().
+   _compact_protoversion = 3
+
+   # Counters reported by stats().
+   _counter_names = ('packets', 'bytes', 'datapoints', 'errors', 'unresolved')
+
+   # Largest datagram we are willing to emit. 1400 bytes leaves room for IP,
+   # UDP and tunnel/VPN headers within a standard 1500 byte Ethernet MTU, so
+   # messages are never fragmented on the way.
+   _max_datagram = 1400
+
+   def __init__(self, key, application = None, server = None, authentication = True, encryption = None, try_adns = True, dns_ttl = 300, buffered = False, buffer_size = 4096, flush_interval = 1.0, flush_size = 50, aggregate = False, aggregate_interval = 10.0, internal_interval = None, per_thread_sockets = False, eject_time = 30.0, compact = False, dns_cache = None):
+      """In buffered mode, send() only appends to a bounded in-memory buffer of buffer_size datapoints and a background thread sends them in batches once flush_size datapoints are pending or flush_interval seconds have passed. Datapoints that cannot be sent yet, e.g. because DNS has not resolved, are kept until they can. When the buffer is full the oldest datapoints are dropped.
+
+With aggregate enabled, values passed to record(), which includes the timings of measure and Timer, are accumulated per metric and sent as summary datapoints every aggregate_interval seconds instead of one message each.
 
-   def __init__(self, key, application = None, server = None, authentication = True, encryption = None, try_adns = True):
+The client keeps statistics about itself, see stats(). If internal_interval is set, they are also sent as metricfire.internal.* metrics at that interval.
+
+Every thread signs its messages with its own session key and sequence numbers, so sending threads don't contend on a lock. With per_thread_sockets, every thread also sends through its own sockets.
+
+If the server name resolves to several addresses, metrics are sharded across them by a consistent hash of their names, each address is sent to through a connected socket, and addresses refusing messages are skipped for eject_time seconds, see EndpointPool.
+
+With compact enabled, messages use protocol version 3: a table of the metric names in the message, a zlib compressed body and base64 instead of hex in the header. Several times as many datapoints fit into a datagram, see _compactBody().
+
+dns_cache is the path of a file keeping the resolved server addresses for dns_ttl seconds, or the adns TTL, across processes. Short lived programs, e.g. run by cron every minute, then start sending right away instead of waiting for a lookup every time. The key isn't cached: parsing it takes microseconds."""
       self._host           = None
       self._port           = None
-      self._sockaddrs      = []
+      self._sockaddrs      = ()
+      # When the adns results expire.
       self._sockaddrs_age  = 0
-      self._sock           = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-      # Attempt to parse the key as a UUID, then Base64 encoded bytes, then fail.
-      try:
-         # Remove dashes and check the key length.
-         rawkey = binascii.unhexlify(key.replace("-", ""))
-         assert len(rawkey) == 16
-      except (TypeError, AssertionError), ex:
-         # Key is not a valid UUID, test base64 decoding next.
-         try:
-            rawkey = binascii.a2b_base64(key)
-            assert len(rawkey) == 32 
-         except (binascii.Error, AssertionError), ex:
-            # Key is not a valid base64 key either!
-            raise ValueError("Unable to parse key in either UUID or Base64 encodings: %s" % key)
+      self._resolver       = None
+      self._dns_cache      = dns_cache
+      # The addresses in the cache file and when they expire.
+      self._cached         = ((), 0)
 
-      self._key            = rawkey
+      self._key            = parseKey(key)
+      self._compact        = compact
+      if compact:
+         self._protoversion = self._compact_protoversion
+      # Running estimate of how many times smaller compact bodies are than
+      # the datapoints' JSON, see _messages().
+      self._compression    = 4.0
 
       self._authentication = authentication
       self._encryption     = encryption
       self._application    = application
-      self._sequence       = 0
-      self._sessionkey     = None
       self._keyfingerprint = hashlib.md5(self._key).hexdigest()
 
-      # This lock is used (very carefully) later in _format() when updating
-      # _sequence and _sessionkey. See _format() for more detail.
-      self._lock = threading.Lock()
+      # HMAC keyed with our key. Its inner and outer state is cloned for every
+      # session instead of hashing the key again for every message.
+      self._hmac           = hmac.HMAC(self._key, digestmod = hashlib.sha256)
+      # Per thread state: the session, see _format(), and the counters and
+      # timings, see _threadStats().
+      self._local          = threading.local()
+      self._per_thread_sockets = per_thread_sockets
+      # Sockets and sharding of metrics across the server addresses.
+      self._pool           = EndpointPool(eject_time, per_thread_sockets)
+      # Used to detect that we are running in a forked child, see _checkFork().
+      self._pid            = os.getpid()
+      self._dns_ttl        = dns_ttl
 
-      if try_adns and adns is None:
-         warnings.warn("Could not load python module 'adns'. (%s) This is not necessarily a problem, but Metricfire DNS lookups cannot be guaranteed to be non-blocking. You can disable this warning by using metricfire.init(..., try_adns = False)" % _adns_import_exception, RuntimeWarning, 3)
+      # Upper bound of the header length. Every field but the sequence number
+      # has a fixed width, so formatting a worst case header once is enough.
+      self._header_reserve = len(json.dumps({'v': self._protoversion, 'f': self._keyfingerprint, 's': '0' * 32, 'q': 2**32, 'a': '0' * 64})) + 1
+      if compact:
+         self._header_reserve = len('{"v":%d,"f":"%s","s":"%s","q":%d,"a":"%s"}' % (self._protoversion, '0' * 22, '0' * 22, 2**32, '0' * 43)) + 1
 
       # Get application (process) name, if the user didn't specify one.
       if self._application is None or len(self._application) == 0:
@@ -92,30 +499,300 @@ class Client:
       except Exception, ex:
          warnings.warn("Could not determine system hostname: %s" % ex, RuntimeWarning, 2)
          self._hostname = "unknown"
+
+      # The hostname and application don't change, so serialise them once.
+      # _format() only has to append the datapoints.
+      self._body_prefix = '{"h": %s, "a": %s, "m": ' % (json.dumps(self._hostname), json.dumps(self._application))
+
+      # Length of a body without any datapoints, used when packing batches.
+      self._body_reserve = len(self._body_prefix) + len('[]}')
+      self._compact_prefix = '{"h":%s,"a":%s,"n":' % (json.dumps(self._hostname), json.dumps(self._application))
       
-      if adns is not None:
+      if try_adns and _loadAdns() is not None:
          self._adns_resolver = adns.init()
       else:
          self._adns_resolver = None
       self._adns_query = None
       
+      # The send buffer and its flusher thread, if running in buffered mode.
+      self._buffer         = None
+      self._dropped        = 0
+      # Socket errors the flusher thread survived, see _flushFailed().
+      self._flush_errors   = 0
+      self._flush_interval = flush_interval
+      self._flush_size     = flush_size
+      self._flush_event    = threading.Event()
+      self._flush_thread   = None
+      self._closed         = False
+      self._aggregator     = None
+      self._aggregate_interval = aggregate_interval
+      self._aggregate_due  = time.time() + aggregate_interval
+      self._internal_interval = internal_interval
+      self._internal_due   = time.time() + (internal_interval or 0)
+      # Counters and timings of the client itself, kept per thread, see stats().
+      self._thread_stats   = []
+      self._retired_stats  = (dict.fromkeys(self._counter_names, 0), Aggregator())
+      self._stats_lock     = threading.Lock()
+      if buffered:
+         import collections
+         self._buffer = collections.deque(maxlen = buffer_size)
+      if aggregate:
+         self._aggregator = Aggregator()
+      if buffered or aggregate or internal_interval:
+         self._startFlushThread()
+         # Don't lose whatever is still buffered when the interpreter exits.
+         atexit.register(self.close)
+
       # Check if we were given an IP address instead of a hostname.
       try:
          socket.inet_aton(self._host)
-         self._sockaddrs = [(self._host, self._port)]
+         self._sockaddrs = ((self._host, self._port),)
       except socket.error: 
          # Otherwise, fire off an asynchronous DNS query now to resolve it.
-         # We do this so _send() doesn't have to block.
-         self._queryDNS()
+         # We do this so _send() doesn't have to block. Fresh addresses from
+         # the cache put the query off until they expire.
+         (sockaddrs, expires) = self._cached = self._loadDNSCache()
+         if self._adns_resolver is None:
+            self._resolver = Resolver(self._host, self._port, ttl = dns_ttl, sockaddrs = sockaddrs, expires = expires)
+         elif sockaddrs:
+            self._sockaddrs = sockaddrs
+            self._sockaddrs_age = expires
+         else:
+            self._queryDNS()
+
+   def _startFlushThread(self):
+      self._flush_thread = threading.Thread(target = self._flushLoop, name = "metricfire-flush")
+      self._flush_thread.daemon = True
+      self._flush_thread.start()
+
+   def _checkFork(self):
+      """Re-initialise per-process state if we are running in a process forked after the client was created."""
+      if os.getpid() != self._pid:
+         self._afterFork()
+
+   def _afterFork(self):
+      """Give a forked child its own sessions, socket and background threads. Otherwise it would reuse the parent's session keys and sequence numbers, which the server would reject as replays. Whatever the parent had buffered or aggregated is left for the parent to send. Every method that buffers or aggregates checks for a fork first, so the child's own datapoints are never among what is cleared here."""
+      self._pid = os.getpid()
+      self._local = threading.local()
+      self._pool = EndpointPool(self._pool.eject_time, self._per_thread_sockets)
+      # Locks held by parent threads at fork time would never be released in
+      # the child, so replace everything guarded by one.
+      self._thread_stats = []
+      self._retired_stats = (dict.fromkeys(self._counter_names, 0), Aggregator())
+      self._stats_lock = threading.Lock()
+      self._dropped = 0
+      self._flush_errors = 0
+      if self._buffer is not None:
+         self._buffer.clear()
+      if self._aggregator is not None:
+         self._aggregator = Aggregator()
+      # Threads don't survive a fork.
+      self._flush_event = threading.Event()
+      if self._flush_thread is not None:
+         self._startFlushThread()
+      if self._resolver is not None:
+         self._resolver.close()
+         self._resolver = Resolver(self._host, self._port, ttl = self._dns_ttl, sockaddrs = self._resolver.sockaddrs)
 
    def __del__(self):
       # Attempt to flush the buffer, if any exists.
-      # TODO
-      pass
+      if getattr(self, '_flush_thread', None) is not None:
+         self.flush()
+
+   def _flushLoop(self):
+      """Body of the flusher thread. Drains the buffer whenever enough datapoints are pending or flush_interval has passed, sends aggregates every aggregate_interval and internal statistics every internal_interval."""
+      while not self._closed:
+         now = time.time()
+         timeout = self._flush_interval if self._buffer is not None else 60
+         if self._aggregator is not None:
+            timeout = min(timeout, self._aggregate_due - now)
+         if self._internal_interval:
+            timeout = min(timeout, self._internal_due - now)
+         self._flush_event.wait(max(0, timeout))
+         self._flush_event.clear()
+         now = time.time()
+         if self._aggregator is not None and now >= self._aggregate_due:
+            self._aggregate_due += self._aggregate_interval
+            try:
+               self._flushAggregates()
+            except socket.error, ex:
+               # Keep the thread alive, the aggregates go out next time.
+               self._flushFailed(ex)
+         if self._internal_interval and now >= self._internal_due:
+            self._internal_due += self._internal_interval
+            try:
+               self.send_many(self._internalDatapoints(now))
+            except socket.error, ex:
+               # The next ones report the same counters, nothing to keep.
+               self._flushFailed(ex)
+         self._flushBuffer()
+
+   def _flushAggregates(self):
+      """Send the aggregates. If that raises socket.error, they are merged back into the aggregator to be sent with the next ones."""
+      if self._aggregator is not None:
+         taken = self._aggregator.take()
+         datapoints = taken.collect(time.time(), reset = False)
+         if datapoints:
+            try:
+               self.send_many(datapoints)
+            except socket.error:
+               self._aggregator.merge(taken)
+               raise
+
+   def _flushFailed(self, ex):
+      """Count and report a socket error of the flusher thread, see stats()."""
+      self._flush_errors += 1
+      warnings.warn("metricfire flush failed: %s" % ex, RuntimeWarning, 2)
+
+   def _enqueue(self, datapoints):
+      for (metric, value, timestamp) in datapoints:
+         # Record the time of the measurement, not the time of the flush.
+         if timestamp is None:
+            timestamp = time.time()
+         if len(self._buffer) == self._buffer.maxlen:
+            # The deque discards the oldest entry on append.
+            self._dropped += 1
+         self._buffer.append((metric, value, timestamp))
+      if len(self._buffer) >= self._flush_size:
+         self._flush_event.set()
+
+   def flush(self):
+      """Send all aggregated and buffered datapoints. Returns False if they have to stay buffered because no server address is known yet or sending failed."""
+      # A forked child must not send what its parent buffered, e.g. when it
+      # exits through the inherited atexit handler.
+      self._checkFork()
+      self._flushAggregates()
+      return self._flushBuffer()
+
+   def _flushBuffer(self):
+      if self._buffer is None:
+         return True
+      if not self._resolved():
+         return False
+
+      datapoints = []
+      try:
+         while True:
+            datapoints.append(self._buffer.popleft())
+      except IndexError:
+         pass
+
+      unsent = []
+      for (sockaddr, group) in self._pool.shard(datapoints):
+         if unsent:
+            unsent.extend(group)
+            continue
+         done = 0
+         for (batch, message) in self._messages(group):
+            try:
+               self._send(message, sockaddr)
+            except socket.error:
+               unsent = group[done:]
+               break
+            done += len(batch)
+      if not unsent:
+         return True
+      # Put back what fits, oldest first, in front of anything sent meanwhile.
+      unsent.sort(key = lambda datapoint: datapoint[2])
+      room = self._buffer.maxlen - len(self._buffer)
+      self._dropped += max(0, len(unsent) - room)
+      if room > 0:
+         self._buffer.extendleft(reversed(unsent[max(0, len(unsent) - room):]))
+      return False
+
+   def close(self):
+      """Flush the buffer and stop the flusher and resolver threads."""
+      self._checkFork()
+      if self._closed:
+         return
+      self._closed = True
+      if self._resolver is not None:
+         self._resolver.stop()
+      if self._flush_thread is not None:
+         self._flush_event.set()
+         self._flush_thread.join(self._flush_interval)
+      self.flush()
+
+   def dropped(self):
+      """Number of buffered datapoints dropped because the buffer was full."""
+      return self._dropped
+
+   def observe(self, name, seconds):
+      """Add a timing to the client's own statistics, e.g. of the code producing the metrics. See stats()."""
+      self._threadStats()[1].add(name, seconds)
+
+   def _threadStats(self):
+      """Return the counters and timings of the calling thread. Every thread only updates its own, so sending threads don't contend for a lock or race on a shared counter. stats() adds them up."""
+      stats = getattr(self._local, 'stats', None)
+      if stats is None:
+         stats = self._local.stats = (dict.fromkeys(self._counter_names, 0), Aggregator())
+         self._stats_lock.acquire()
+         try:
+            self._thread_stats.append((threading.current_thread(), stats))
+         finally:
+            self._stats_lock.release()
+      return stats
+
+   def stats(self):
+      """Return statistics about the client since it was created: the number of packets, bytes and datapoints sent, socket errors, messages dropped for lack of a server address ('unresolved') or a full buffer ('dropped'), socket errors the background flusher survived ('flush_errors'), the buffer depth, the known server addresses, how many of them are ejected and a summary of the 'format' and 'send' timings and any observe()d ones, in seconds."""
+      counters = dict.fromkeys(self._counter_names, 0)
+      timings = Aggregator()
+      self._stats_lock.acquire()
+      try:
+         # Fold the statistics of threads which have exited into one entry,
+         # so they don't pile up.
+         (retired_counters, retired_timings) = self._retired_stats
+         live = []
+         for (thread, (thread_counters, thread_timings)) in self._thread_stats:
+            if thread.is_alive():
+               live.append((thread, (thread_counters, thread_timings)))
+               continue
+            for name in self._counter_names:
+               retired_counters[name] += thread_counters[name]
+            retired_timings.merge(thread_timings)
+         self._thread_stats = live
+         for (thread_counters, thread_timings) in [self._retired_stats] + [stats for (thread, stats) in live]:
+            for name in self._counter_names:
+               counters[name] += thread_counters[name]
+            timings.merge(thread_timings)
+      finally:
+         self._stats_lock.release()
+      stats = counters
+      stats['dropped'] = self._dropped
+      stats['flush_errors'] = self._flush_errors
+      stats['buffered'] = len(self._buffer) if self._buffer is not None else 0
+      stats['sockaddrs'] = list(self._sockaddrs)
+      stats['ejected'] = self._pool.ejected()
+      stats['timings'] = timings.summary()
+      return stats
+
+   def _internalDatapoints(self, timestamp):
+      """Turn stats() into metricfire.internal.* datapoints."""
+      stats = self.stats()
+      datapoints = []
+      for name in ('packets', 'bytes', 'datapoints', 'errors', 'unresolved', 'dropped', 'flush_errors', 'buffered'):
+         datapoints.append(("metricfire.internal." + name, stats[name], timestamp))
+      datapoints.append(("metricfire.internal.sockaddrs", len(stats['sockaddrs']), timestamp))
+      datapoints.append(("metricfire.internal.ejected", stats['ejected'], timestamp))
+      for timing, values in stats['timings'].iteritems():
+         for name in ('count', 'avg', 'p50', 'p99', 'max'):
+            datapoints.append(("metricfire.internal.%s.%s" % (timing, name), values[name], timestamp))
+      return datapoints
 
    def _generateSessionKey(self):
       return os.urandom(16)
 
+   def _newSession(self):
+      """Start a new session. Returns a tuple of the session key, the constant start of every header in this session and the HMAC state after hashing the session key."""
+      sessionkey = self._generateSessionKey()
+      if self._compact:
+         header_prefix = '{"v":%d,"f":"%s","s":"%s","q":' % (self._protoversion, _b64(binascii.unhexlify(self._keyfingerprint)), _b64(sessionkey))
+      else:
+         header_prefix = '{"v": %d, "f": "%s", "s": "%s", "q": ' % (self._protoversion, self._keyfingerprint, binascii.hexlify(sessionkey))
+      auth = self._hmac.copy()
+      auth.update(sessionkey)
+      return (sessionkey, header_prefix, auth)
+
    def _parseHostPort(self, hostport):
       """Returns a (host, port) tuple from a colon-separated host and port string, with an optional port."""
 
@@ -128,107 +805,442 @@ class Client:
          raise ValueError("Invalid host:port spec: %s" % hostport)
 
    def _queryDNS(self):
-      """Async dns query""" # TODO
+      """Start an asynchronous DNS query through adns. Without adns, the Resolver thread takes care of this."""
       if self._adns_resolver is not None:
          self._adns_query = self._adns_resolver.submit(self._host, 1)
-      else:
-         for (family, socktype, proto, canonname, sockaddr) in socket.getaddrinfo(self._host, self._port):
-            self._sockaddrs.append(sockaddr)
-
-   def _format(self, datapoints):
-     
-      # Locking is used very carefully here because threads can interfere with
-      # the modification of sequence numbers and session keys.
-
-      # Using locking here doesn't break the non-blocking sending contract
-      # because:
-      # * Reading/writing basic types does not block
-      # * Calling os.urandom() does not block as it reads from /dev/urandom
-      #   which, on UNIX-like systems, is a non-blocking entropy source.
-      #   In comparison, /dev/random can block while waiting for entropy.
-      # See http://docs.python.org/library/os.html#os.urandom and urandom (4)
-      # Also, not using "with self.lock:" syntax for python2.5 compatibility :(
-      self._lock.acquire()
-      self._sequence += 1
-      if self._sessionkey is None or self._sequence >= 2**32:
-         self._sequence = 1
-         self._sessionkey = os.urandom(16)
-      sequence = self._sequence
-      sessionkey = self._sessionkey
-      self._lock.release()
+      elif self._resolver is not None:
+         self._resolver.refresh()
 
-      # TODO Pre-fragmentation for multiple messages?
+   def _format(self, datapoints, body = None):
+      """Return a complete message of the datapoints. body is their serialisation, if the caller already has it."""
+      before = time.time()
+      # Every thread uses its own session, so threads never interfere with
+      # each other's sequence numbers and no locking is needed. Replay
+      # protection still holds because the server tracks sequence numbers per
+      # session key, and session keys are random.
 
-      body = {'h': self._hostname, 'a': self._application, 'm': []}
-      for (metric, value, timestamp) in datapoints:
-         body['m'].append((metric, value, timestamp))
+      # Starting a session doesn't break the non-blocking sending contract
+      # because calling os.urandom() does not block as it reads from
+      # /dev/urandom which, on UNIX-like systems, is a non-blocking entropy
+      # source. In comparison, /dev/random can block while waiting for entropy.
+      # See http://docs.python.org/library/os.html#os.urandom and urandom (4)
+      session = getattr(self._local, 'session', None)
+      if session is None or session[0] >= 2**32 - 1:
+         # [sequence, sessionkey, header prefix, HMAC state]
+         session = self._local.session = [0] + list(self._newSession())
+      session[0] += 1
+      (sequence, sessionkey, header_prefix, session_auth) = session
 
-      body_json = json.dumps(body)
+      if body is not None:
+         body_json = body
+      elif self._compact:
+         body_json = self._compactBody(datapoints)
+      else:
+         body_json = self._body_prefix + json.dumps(datapoints) + "}"
 
       if self._encryption:
          # TODO Body crypto!
          pass
 
-         # TODO Compress body?
-
-      header = {'v': self._protoversion, 'f': self._keyfingerprint, 's': binascii.hexlify(sessionkey), 'q': sequence}
-
-      if self._authentication:
+      if self._authentication and self._compact:
+         auth = session_auth.copy()
+         auth.update(str(sequence))
+         auth.update(body_json)
+         header_json = '%s%d,"a":"%s"}' % (header_prefix, sequence, _b64(auth.digest()))
+      elif self._authentication:
          # Calculate a HMAC for the body, including a session key and a sequence
-         # number to prevent replay attacks.
-         auth = hmac.HMAC(self._key, digestmod = hashlib.sha256)
-         auth.update(sessionkey)
+         # number to prevent replay attacks. The session key has already been
+         # hashed into session_auth.
+         auth = session_auth.copy()
          auth.update(str(sequence))
          auth.update(body_json)
-         header['a'] = auth.hexdigest()
-  
-      header_json = json.dumps(header)
+         header_json = '%s%d, "a": "%s"}' % (header_prefix, sequence, auth.hexdigest())
+      else:
+         header_json = '%s%d}' % (header_prefix, sequence)
+
+      (counters, timings) = self._threadStats()
+      timings.add('format', time.time() - before)
+      counters['datapoints'] += len(datapoints)
 
       # Return a complete message.
       return header_json + "\n" + body_json
 
+   def _compactBody(self, datapoints):
+      """Serialise datapoints for protocol version 3. Every metric name is listed once in "n" and the datapoints refer to it by its index there, like {"h": host, "a": application, "n": ["a.b", "a.c"], "m": [[0, 1.5, ts], [1, 2, ts], [0, 1.6, ts]]}. The JSON is zlib compressed, which takes care of the common prefixes of names and timestamps. Every message stands alone, so a lost datagram doesn't affect the others."""
+      import zlib
+      index = {}
+      names = []
+      rows = []
+      for (metric, value, timestamp) in datapoints:
+         i = index.get(metric)
+         if i is None:
+            i = index[metric] = len(names)
+            names.append(metric)
+         rows.append((i, value, timestamp))
+      return zlib.compress('%s%s,"m":%s}' % (self._compact_prefix, json.dumps(names, separators = (',', ':')), json.dumps(rows, separators = (',', ':'))))
+
+   def _messages(self, datapoints):
+      """Yield (batch, message) tuples of datapoints split into messages that each fit into a single datagram, in order."""
+      if not self._compact:
+         for batch in self._pack(datapoints):
+            yield (batch, self._format(batch))
+         return
+      # The compressed size isn't known before compressing. Pack as much JSON
+      # as the recent compression ratio should fit into a datagram.
+      limit = self._max_datagram - self._header_reserve
+      batch = []
+      used = 0
+      for datapoint in datapoints:
+         size = len(json.dumps(datapoint)) + 2
+         if batch and used + size > limit * self._compression * 0.9:
+            for message in self._compactMessages(batch, used):
+               yield message
+            batch = []
+            used = 0
+         batch.append(datapoint)
+         used += size
+      if batch:
+         for message in self._compactMessages(batch):
+            yield message
+
+   def _compactMessages(self, batch, used = None):
+      """Yield (batch, message) tuples for a batch of datapoints, split if its compressed body turns out too large. The split happens before signing, so no sequence numbers are wasted. used is the length of the batch's datapoints as JSON, if the batch is full, to update the estimate of the compression ratio."""
+      limit = self._max_datagram - self._header_reserve
+      pending = [batch]
+      while pending:
+         batch = pending.pop()
+         body = self._compactBody(batch)
+         if used is not None:
+            # Racing threads may lose an update here, which is harmless.
+            self._compression = 0.5 * self._compression + 0.5 * float(used) / len(body)
+            used = None
+         if len(body) > limit and len(batch) > 1:
+            half = len(batch) // 2
+            pending.append(batch[half:])
+            pending.append(batch[:half])
+            continue
+         yield (batch, self._format(batch, body))
+
+   def _pack(self, datapoints):
+      """Split a list of (metric, value, timestamp) tuples into batches whose formatted messages fit into a single datagram. A datapoint that is too large on its own still gets a message of its own."""
+      budget = self._max_datagram - self._header_reserve - self._body_reserve
+      batch = []
+      used = 0
+      for datapoint in datapoints:
+         # Each datapoint is serialised as a JSON list, separated by ", ".
+         size = len(json.dumps(datapoint)) + (2 if batch else 0)
+         if batch and used + size > budget:
+            yield batch
+            batch = []
+            used = 0
+            size -= 2
+         batch.append(datapoint)
+         used += size
+      if batch:
+         yield batch
+
    def send(self, metric, value, timestamp = None):
       """Send a metric and a value to Metricfire without blocking. If a UNIX timestamp is supplied, the value will be recorded as happening at that time. Otherwise, the current time is assumed."""
+      self._checkFork()
+      if self._buffer is not None:
+         self._enqueue([(metric, value, timestamp)])
+         return
+      if not self._resolved():
+         self._threadStats()[0]['unresolved'] += 1
+         return
       message = self._format([(metric, value, timestamp)])
-      self._send(message)
+      self._send(message, self._pool.pick(metric))
 
-   def _send(self, content):
-      """The meat of sending a metric message. Checks for DNS query results and chooses a random socket to send it to.""" # TODO
+   def send_many(self, datapoints):
+      """Send a list of (metric, value, timestamp) tuples without blocking. As many datapoints as fit are packed into each datagram, so a large batch is split across several messages. A timestamp of None means the current time. Returns False if messages were dropped because no server address is known yet."""
+      self._checkFork()
+      if self._buffer is not None:
+         self._enqueue(datapoints)
+         return True
+      if not self._resolved():
+         self._threadStats()[0]['unresolved'] += len(list(self._pack(datapoints)))
+         return not datapoints
+      for (sockaddr, group) in self._pool.shard(datapoints):
+         for (batch, message) in self._messages(group):
+            self._send(message, sockaddr)
+      return True
+
+   def _loadDNSCache(self):
+      """Return the cached addresses of the server and when they expire, or ((), 0) if there are none or they have expired."""
+      if self._dns_cache is None:
+         return ((), 0)
+      try:
+         f = open(self._dns_cache)
+         try:
+            cache = json.load(f)
+         finally:
+            f.close()
+         if cache['server'] == '%s:%d' % (self._host, self._port) and cache['expires'] > time.time():
+            return (tuple((str(addr), port) for (addr, port) in cache['sockaddrs']), cache['expires'])
+      except (IOError, ValueError, KeyError, TypeError):
+         pass
+      return ((), 0)
+
+   def _saveDNSCache(self, sockaddrs, expires):
+      """Write the addresses to the cache file, if there is one. Failures are ignored, the cache is only an optimisation."""
+      self._cached = (sockaddrs, expires)
+      if self._dns_cache is None:
+         return
+      try:
+         atomicWrite(self._dns_cache, json.dumps({'server': '%s:%d' % (self._host, self._port), 'sockaddrs': sockaddrs, 'expires': expires}))
+      except (IOError, OSError), ex:
+         warnings.warn("Could not write DNS cache %s: %s" % (self._dns_cache, ex), RuntimeWarning, 2)
+
+   def _resolved(self):
+      """Checks for DNS query results and returns True once at least one server address is known."""
+
+      if self._resolver is not None:
+         # Pick up the latest addresses published by the resolver thread.
+         self._sockaddrs = self._resolver.sockaddrs
+         # Write the cache after every successful lookup.
+         if self._sockaddrs and self._resolver.expires > self._cached[1]:
+            self._saveDNSCache(self._sockaddrs, self._resolver.expires)
 
       # If we previously started a DNS query....
-      if self._adns_query is not None:
+      elif self._adns_query is not None:
          # ... check it for results.
          try:
             (status, cname, expires, rrs) = self._adns_query.check()
-            # TODO Check status, or just use the length of the rrs?
+            # Keep the previous addresses if the query failed.
             if len(rrs) > 0:
-               for addr in rrs:
-                  self._sockaddrs.append((addr, self._port))
+               self._sockaddrs = tuple((addr, self._port) for addr in rrs)
+               self._sockaddrs_age = expires
+               self._saveDNSCache(self._sockaddrs, expires)
+            else:
+               self._sockaddrs_age = time.time() + 5
    
             self._adns_query = None
          except adns.NotReady:
             pass # Check it next time.
-            # TODO Try to buffer the content to send next time.
-            #print "Not sent." # XXX
-      else:
-         # TODO Repeat the DNS query after the expires time.
-         pass
+      elif self._adns_resolver is not None and time.time() >= self._sockaddrs_age:
+         # Repeat the DNS query after the expires time.
+         self._queryDNS()
+
+      self._pool.update(self._sockaddrs)
+      return len(self._sockaddrs) > 0
+
+   def wait(self, timeout = None):
+      """Wait up to timeout seconds, or for as long as it takes if timeout is None, until a server address is known. Returns True if one is."""
+      if self._resolver is not None:
+         self._resolver.wait(timeout)
+      elif self._adns_resolver is not None:
+         deadline = None if timeout is None else time.time() + timeout
+         while not self._resolved() and (deadline is None or time.time() < deadline):
+            time.sleep(0.05)
+      return self._resolved()
 
-      if len(self._sockaddrs) > 0:
-         before = time.time()
-         # Pick a sockaddr at random.
-         self._sock.sendto(content, random.choice(self._sockaddrs))
-         after = time.time()
-         #print "Send to (%s, %d) took %fs" % (self._sockaddrs, self._port, after - before) # TODO
+   def record(self, metric, value, weight = 1):
+      """Report a value, typically a timing, for a metric. In aggregate mode this only updates in-process statistics, with the value counted weight times. Otherwise it is the same as send(), and a weight above 1 is sent alongside as metric.count, so the server still sees how often the value occurred."""
+      self._checkFork()
+      if self._aggregator is not None:
+         self._aggregator.add(metric, value, weight)
+      elif weight == 1:
+         self.send(metric, value)
       else:
-         pass
-         # TODO buffer
+         self.send_many([(metric, value, None), (metric + '.count', weight, None)])
+
+   def _send(self, content, sockaddr):
+      """The meat of sending a metric message, to the server address picked by the EndpointPool. If the address refuses it, it is ejected and the message goes to another address, or is dropped if there is none left. Raises socket.error if sending fails otherwise."""
+      before = time.time()
+      while True:
+         try:
+            self._pool.socket(sockaddr).send(content)
+            break
+         except socket.error, ex:
+            self._threadStats()[0]['errors'] += 1
+            if ex.args[0] == errno.ECONNREFUSED:
+               # Nobody listens there. Connected sockets report the ICMP
+               # error of an earlier message on a later one.
+               sockaddr = self._pool.eject(sockaddr)
+               if sockaddr is not None:
+                  continue
+            # The address might be stale, look it up again.
+            self._queryDNS()
+            if ex.args[0] == errno.ECONNREFUSED:
+               # Drop the message, as an unconnected socket would have sent
+               # it into the void, rather than failing the caller.
+               return
+            raise
+      after = time.time()
+      (counters, timings) = self._threadStats()
+      timings.add('send', after - before)
+      counters['packets'] += 1
+      counters['bytes'] += len(content)
+
+# Defined by _dispatcherClass() on first use, so programs without an event loop
+# don't import asyncore.
+_DatagramDispatcher = None
+
+def _dispatcherClass():
+   global _DatagramDispatcher
+   if _DatagramDispatcher is None:
+      import asyncore
+      class _DatagramDispatcher(asyncore.dispatcher):
+         """Writes the messages queued by an AsyncClient whenever its socket is writable."""
+
+         def __init__(self, client, map = None):
+            asyncore.dispatcher.__init__(self, map = map)
+            self._client = client
+            self.set_socket(client._sock, map)
+
+         def readable(self):
+            return False
+
+         def writable(self):
+            return len(self._client._outgoing) > 0
+
+         def handle_write(self):
+            outgoing = self._client._outgoing
+            while outgoing:
+               (content, sockaddr) = outgoing[0]
+               try:
+                  self.socket.sendto(content, sockaddr)
+               except socket.error, ex:
+                  if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                     # Try again when the socket is writable.
+                     return
+                  # Drop the message rather than retrying it forever.
+                  outgoing.popleft()
+                  self._client._threadStats()[0]['errors'] += 1
+                  self._client._queryDNS()
+                  continue
+               outgoing.popleft()
+               counters = self._client._threadStats()[0]
+               counters['packets'] += 1
+               counters['bytes'] += len(content)
+
+         def handle_connect(self):
+            pass
+
+         def handle_error(self):
+            # Never let metric reporting take down the application's event loop.
+            pass
+
+   return _DatagramDispatcher
+
+class AsyncClient(Client):
+   """A Client for applications running an asyncore event loop. The socket is non-blocking and messages are written by the event loop when the socket is writable, so send() never makes a syscall. Pass the asyncore socket map in map if the application doesn't use the default one. The message format is the same as Client's. Unless adns is used or the server is given as an IP address, DNS lookups still happen in the Resolver thread, since the standard library has no non-blocking resolver."""
+
+   def __init__(self, key, map = None, max_queue = 4096, **kwargs):
+      Client.__init__(self, key, **kwargs)
+      self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self._sock.setblocking(0)
+      import collections
+      self._outgoing = collections.deque(maxlen = max_queue)
+      self._map = map
+      self._dispatcher = _dispatcherClass()(self, map)
+
+   def _afterFork(self):
+      self._dispatcher.del_channel()
+      Client._afterFork(self)
+      self._sock.close()
+      self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self._sock.setblocking(0)
+      self._outgoing.clear()
+      self._dispatcher = _dispatcherClass()(self, self._map)
+
+   def _send(self, content, sockaddr):
+      """Queue a message for the event loop."""
+      if len(self._outgoing) == self._outgoing.maxlen:
+         self._dropped += 1
+      self._outgoing.append((content, sockaddr))
+
+class RelayClient:
+   """Sends unsigned datapoints to a local relay daemon (see relay.py) over a Unix datagram socket. The relay batches, signs and forwards them upstream, so each call costs one local syscall and no key, DNS lookup or session is needed. Safe to use across fork()."""
+
+   # Largest datagram the relay reads, see Relay.serve_forever(). Anything
+   # longer would be truncated and the whole batch lost.
+   _max_datagram = 65536
+
+   def __init__(self, path):
+      self._path     = path
+      self._sock     = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      self._sock.setblocking(0)
+      self._counters = {'packets': 0, 'bytes': 0, 'datapoints': 0, 'errors': 0, 'dropped': 0}
+      self._timings  = Aggregator()
+
+   def _relay(self, data):
+      try:
+         self._sock.sendto(data, self._path)
+      except socket.error:
+         # The relay is not running or can't keep up.
+         self._counters['errors'] += 1
+         return False
+      self._counters['packets'] += 1
+      self._counters['bytes'] += len(data)
+      return True
+
+   def send(self, metric, value, timestamp = None):
+      """Send a metric and a value through the relay. See Client.send()."""
+      return self.send_many([(metric, value, timestamp)])
+
+   def send_many(self, datapoints):
+      """Send a list of (metric, value, timestamp) tuples through the relay. See Client.send_many(). As many datapoints as fit are packed into each datagram. Returns False if a datagram couldn't be sent or a datapoint was dropped because it doesn't fit into a datagram on its own."""
+      # The relay may forward them later, so record the time now.
+      now = time.time()
+      prefix, suffix = '{"d": [', ']}'
+      room = self._max_datagram - len(prefix) - len(suffix)
+      sent = True
+      batch, size = [], 0
+      for (metric, value, timestamp) in datapoints:
+         encoded = json.dumps((metric, value, now if timestamp is None else timestamp))
+         if len(encoded) > room:
+            self._counters['dropped'] += 1
+            sent = False
+            continue
+         # Every datapoint after the first is preceded by a ', '.
+         if batch and size + 2 + len(encoded) > room:
+            sent = self._relay(prefix + ', '.join(batch) + suffix) and sent
+            batch, size = [], 0
+         size += len(encoded) + (2 if batch else 0)
+         batch.append(encoded)
+         self._counters['datapoints'] += 1
+      if batch:
+         sent = self._relay(prefix + ', '.join(batch) + suffix) and sent
+      return sent
+
+   def record(self, metric, value, weight = 1):
+      """Report a value, typically a timing, for a metric. The relay aggregates these. See Client.record()."""
+      self._relay(json.dumps({'r': [(metric, value, weight)]}))
+
+   def wait(self, timeout = None):
+      return True
+
+   def flush(self):
+      return True
+
+   def close(self):
+      self._sock.close()
+
+   def observe(self, name, seconds):
+      self._timings.add(name, seconds)
+
+   def stats(self):
+      """Return the number of datagrams, bytes and datapoints passed to the relay, the errors doing so, the datapoints dropped for being too large and a summary of observe()d timings."""
+      stats = dict(self._counters)
+      stats['timings'] = self._timings.summary()
+      return stats
 
 def init(*args, **kwargs):
    """Initialise the metricfire module by providing your secret key, an optional name/label for this application, and an optional hostname to send metric data to. See help(metricfire.Client) for supported arguments."""
    global _module_client
    _module_client = Client(*args, **kwargs)
 
+def init_async(*args, **kwargs):
+   """Initialise the metricfire module with an AsyncClient, for applications running an asyncore event loop. Takes the same arguments as init(), see help(metricfire.AsyncClient)."""
+   global _module_client
+   _module_client = AsyncClient(*args, **kwargs)
+
+def init_relay(path):
+   """Initialise the metricfire module to send everything through the relay daemon listening on the Unix socket at path. See help(metricfire.RelayClient)."""
+   global _module_client
+   _module_client = RelayClient(path)
+
 def send(metric, value, timestamp = None):
    """Send a metric and a value to Metricfire without blocking. If a UNIX timestamp is supplied, the value will be recorded as happening at that time. Otherwise, the current time is assumed."""
    global _module_client
@@ -237,8 +1249,58 @@ def send(metric, value, timestamp = None):
    else:
       _module_client.send(metric, value, timestamp)
 
-def measure(prefix = None):
-   """Decorate a function whose calling frequency and running times should be reported to Metricfire. Optionally set a prefix for the resulting metric name. The metric name takes the form of: [prefix.][module.][class.]function"""
+def send_many(datapoints):
+   """Send a list of (metric, value, timestamp) tuples to Metricfire without blocking, packed into as few messages as possible. See Client.send_many()."""
+   global _module_client
+   if _module_client is None:
+      warnings.warn("metricfire.send_many() called without metricfire.init() being called first. Either call metricfire.init(), or use a metricfire.Client() object. Metric messages dropped.", RuntimeWarning, 2)
+   else:
+      return _module_client.send_many(datapoints)
+   return False
+
+def record(metric, value, weight = 1):
+   """Report a value, typically a timing, for a metric. Aggregated in-process if the module-level client was initialised with aggregate = True. See Client.record()."""
+   global _module_client
+   if _module_client is None:
+      warnings.warn("metricfire.record() called without metricfire.init() being called first. Either call metricfire.init(), or use a metricfire.Client() object. Metric message dropped.", RuntimeWarning, 2)
+   else:
+      _module_client.record(metric, value, weight)
+
+def wait(timeout = None):
+   """Wait up to timeout seconds until the module-level client knows a server address. See Client.wait()."""
+   global _module_client
+   if _module_client is None:
+      return False
+   return _module_client.wait(timeout)
+
+def observe(name, seconds):
+   """Add a timing to the module-level client's own statistics. See Client.observe()."""
+   global _module_client
+   if _module_client is not None:
+      _module_client.observe(name, seconds)
+
+def stats():
+   """Return statistics about the module-level client. See Client.stats()."""
+   global _module_client
+   if _module_client is None:
+      return None
+   return _module_client.stats()
+
+def flush():
+   """Send everything the module-level client has buffered. See Client.flush()."""
+   global _module_client
+   if _module_client is not None:
+      return _module_client.flush()
+   return True
+
+# Per thread stack of the measured calls being timed. Each entry holds the
+# time spent in timed calls nested in it so far, see measure().
+_spans = threading.local()
+
+def measure(prefix = None, sample = 1, spans = False):
+   """Decorate a function whose calling frequency and running times should be reported to Metricfire. Optionally set a prefix for the resulting metric name. The metric name takes the form of: [prefix.][module.][class.]function
+
+With sample = N, only one in N calls is timed and reported, which keeps the overhead on hot functions down. The call is counted N times in aggregate mode and otherwise sent with a metric.count of N, see Client.record(). With spans enabled, the time spent in the function itself, without the measured functions it calls, is reported as metric.self next to the total. Nested measured calls are timed whenever their caller is, so the self time stays exact even if they are sampled."""
    
    # If the prefix is actually a function, we're being called in argless mode.
    # (Like: @metricfire.measure, instead of @metricfire.measure(...))
@@ -257,6 +1319,8 @@ def measure(prefix = None):
       # cannot itself be reassigned.
       # Better solutions welcomed!
       state = {'metric': None}
+      # Numbers the calls for sampling. Thread-safe, unlike incrementing an int.
+      calls = itertools.count(1)
 
       def call_func(*args, **kwargs):
 
@@ -285,13 +1349,30 @@ def measure(prefix = None):
             # it is available on the next call.
             state['metric'] = ".".join(metric)
 
+         timed = sample == 1 or next(calls) % sample == 0
+         stack = getattr(_spans, 'stack', None)
+         if stack is None:
+            stack = _spans.stack = []
+         if not timed and not stack:
+            return func(*args, **kwargs)
+
          # Call the user's function and record how long it takes to complete.
-         before = time.time()
-         result = func(*args, **kwargs)
-         duration = time.time() - before
+         stack.append(0.0)
+         before = monotonic()
+         try:
+            result = func(*args, **kwargs)
+         finally:
+            duration = monotonic() - before
+            children = stack.pop()
+            # Account our time to the caller's nested time.
+            if stack:
+               stack[-1] += duration
 
          # Tell Metricfire all about it.
-         send(state['metric'], duration)
+         if timed:
+            record(state['metric'], duration, sample)
+            if spans:
+               record(state['metric'] + '.self', duration - children, sample)
 
          return result
       return call_func
@@ -304,6 +1385,17 @@ def measure(prefix = None):
       # Otherwise, return the outer decorator function.
       return decorator
 
+def _callerName(depth):
+   """Return the name of the function depth frames up the stack from the caller of _callerName()."""
+   # sys._getframe() only touches the frame we need. inspect.stack() builds
+   # the whole stack and reads the source of every frame, which can take
+   # milliseconds. Fall back to it on interpreters without sys._getframe().
+   try:
+      return sys._getframe(depth + 1).f_code.co_name
+   except AttributeError:
+      import inspect
+      return inspect.stack()[depth + 1][3]
+
 class Timer:
    """A simple helper class for basic timing. Accepts an optional prefix that will appear at the beginning of all metric names. Can also be used with 'with' syntax."""
 
@@ -328,11 +1420,10 @@ class Timer:
          # Alter the frame we look at based on the restart arg because
          # start() is called from restart() and might hide the real caller.
          frame = 2 if restart else 1
-         caller = inspect.stack()[frame][3]
-         metric_pieces.append(caller)
+         metric_pieces.append(_callerName(frame))
 
       self._metric = ".".join(metric_pieces)
-      self._start_time = time.time()
+      self._start_time = monotonic()
 
    def restart(self, metric = None):
       """Restart a running timer. Sends a timing report and immediately starts timing again."""
@@ -342,7 +1433,7 @@ class Timer:
    def stop(self):
       """If previously start()ed or restart()ed, stop() stops timing and sends a report."""
       if self._start_time is not None:
-         send(self._metric, time.time() - self._start_time)
+         record(self._metric, monotonic() - self._start_time)
          self._start_time = None
 
    def cancel(self):
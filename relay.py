@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+Local relay for metricfire datapoints.
+
+Processes on this host send unsigned datapoints to the relay over a Unix
+datagram socket, using metricfire.init_relay(). The relay aggregates timings,
+batches everything and signs and forwards it upstream with a single client,
+so the upstream packet rate doesn't grow with the number of processes.
+
+  ./relay.py [SOCKET]
+
+The API key and server are taken from config.py.
+"""
+
+import sys, os, json, socket, logging
+import metricfire
+
+def _is_number(value):
+  return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+def is_datapoint(datapoint):
+  """Tell whether datapoint is a [metric, value, timestamp] list, the timestamp may be None."""
+  return (isinstance(datapoint, list) and len(datapoint) == 3 and isinstance(datapoint[0], basestring)
+          and _is_number(datapoint[1]) and (datapoint[2] is None or _is_number(datapoint[2])))
+
+def is_record(record):
+  """Tell whether record is a [metric, value] or [metric, value, weight] list."""
+  return (isinstance(record, list) and len(record) in (2, 3) and isinstance(record[0], basestring)
+          and all(_is_number(value) for value in record[1:]))
+
+class Relay:
+  """Receives datagrams from metricfire.RelayClient and forwards them with client."""
+
+  def __init__(self, path, client):
+    self.path = path
+    self.client = client
+    if os.path.exists(path):
+      os.remove(path)
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
+    self.sock.bind(path)
+
+  def handle(self, data):
+    """Forward the contents of a single datagram.
+
+    Malformed datapoints and records are skipped, so no process on the host
+    can take the relay down for the others.
+    """
+    try:
+      message = json.loads(data)
+      datapoints = message.get('d', [])
+      records = message.get('r', [])
+      if not isinstance(datapoints, list) or not isinstance(records, list):
+        raise TypeError("'d' and 'r' must be lists")
+    except (ValueError, TypeError, AttributeError):
+      logging.warning("Ignoring malformed datagram: %r" % data[:100])
+      return
+    valid = [tuple(datapoint) for datapoint in datapoints if is_datapoint(datapoint)]
+    if len(valid) < len(datapoints):
+      logging.warning("Ignoring %d malformed datapoints: %r" % (len(datapoints) - len(valid), data[:100]))
+    if valid:
+      self.client.send_many(valid)
+    for record in records:
+      # (metric, value) or (metric, value, weight)
+      if not is_record(record):
+        logging.warning("Ignoring malformed record: %r" % (record,))
+        continue
+      self.client.record(*record)
+
+  def serve_forever(self):
+    while True:
+      self.handle(self.sock.recv(metricfire.RelayClient._max_datagram))
+
+  def close(self):
+    self.sock.close()
+    os.remove(self.path)
+
+def main():
+  from config import config
+  logging.basicConfig(level=logging.ERROR if '--quiet' in sys.argv else logging.INFO)
+  args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+  path = args[0] if args else config.get('metricfire_relay') or '/tmp/metricfire.sock'
+  client = metricfire.Client(config['api-key'], application='relay', server=config.get('metricfire_server'),
+                             try_adns=config.get('metricfire_try_adns', False), compact=config.get('metricfire_compact', False),
+                             dns_cache=config.get('metricfire_dns_cache'),
+                             dns_ttl=config.get('metricfire_dns_ttl', 300),
+                             buffered=True, aggregate=True,
+                             internal_interval=config.get('metricfire_internal_interval'))
+  relay = Relay(path, client)
+  logging.info("Relaying from %s" % path)
+  try:
+    relay.serve_forever()
+  finally:
+    relay.close()
+    client.close()
+
+if __name__ == '__main__':
+  main()
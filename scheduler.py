@@ -0,0 +1,120 @@
+"""
+Drift-free scheduling of the polling loop.
+
+Ticks are aligned to multiples of the interval on the wall clock, so readings
+of many hosts share the same timestamps. Waiting is done against a monotonic
+clock, so wall clock steps, e.g. by NTP, don't stretch or shorten intervals.
+"""
+
+import time, math, heapq, logging
+# Python 2 has no time.monotonic(), metricfire has a clock_gettime() based one.
+from metricfire import monotonic
+
+class Scheduler:
+  """Yields the wall clock time of each tick when it is due.
+
+  policy decides what happens to ticks missed because an iteration overran:
+  'skip' drops them and continues with the next future tick, 'catchup' runs
+  them right away, each with its own timestamp. overruns counts the
+  iterations that ran past the next tick, skipped the dropped ticks and
+  lateness holds how late the last tick started, in seconds.
+  """
+
+  def __init__(self, interval, policy='skip', resync=1.0, clock=monotonic, wallclock=time.time, sleep=time.sleep):
+    if policy not in ('skip', 'catchup'):
+      raise ValueError("Unknown missed tick policy: %s" % policy)
+    self.interval = interval
+    self.policy = policy
+    self.resync = resync
+    self.overruns = 0
+    self.skipped = 0
+    self.lateness = 0.0
+    self._clock = clock
+    self._wallclock = wallclock
+    self._sleep = sleep
+    self._align()
+
+  def _align(self):
+    """Anchor the next tick to the next interval boundary of the wall clock."""
+    now = self._wallclock()
+    self._next_wall = math.ceil(now / self.interval) * self.interval
+    self._next = self._clock() + (self._next_wall - now)
+
+  def __iter__(self):
+    while True:
+      delay = self._next - self._clock()
+      if delay > 0:
+        self._sleep(delay)
+      now = self._clock()
+      self.lateness = max(0.0, now - self._next)
+      tick = self._next_wall
+
+      # If the wall clock was stepped, realign to its interval boundaries.
+      wall = self._wallclock()
+      offset = wall - (self._next_wall + self.lateness)
+      if abs(offset) > self.resync:
+        logging.warning("Wall clock jumped by %.1fs, realigning ticks." % offset)
+        tick = math.floor(wall / self.interval) * self.interval
+        self._next_wall = tick + self.interval
+        self._next = now + (self._next_wall - wall)
+      else:
+        self._next += self.interval
+        self._next_wall += self.interval
+
+      yield tick
+
+      # Deal with the ticks that passed while the caller was busy.
+      now = self._clock()
+      if now > self._next:
+        self.overruns += 1
+        logging.info("Interval exceeded.")
+        if self.policy == 'skip':
+          missed = int((now - self._next) // self.interval) + 1
+          self.skipped += missed
+          self._next += missed * self.interval
+          self._next_wall += missed * self.interval
+
+  def datapoints(self, prefix, timestamp=None):
+    """Return the scheduler statistics as (metric, value, timestamp) tuples."""
+    return [(prefix + '.lateness', self.lateness, timestamp),
+            (prefix + '.overruns', self.overruns, timestamp),
+            (prefix + '.skipped', self.skipped, timestamp)]
+
+class SensorSchedule:
+  """Keeps track of when each sensor is due, for sensors with different intervals.
+
+  sensors is a list of (key, interval) tuples. The due times live in a
+  min-heap, so finding the next due sensors doesn't depend on how many there
+  are. Sensors that fall behind skip the readings they missed. The time each
+  of the buses spends reading is accounted with add_busy().
+  """
+
+  def __init__(self, sensors, buses=1, clock=monotonic):
+    self._clock = clock
+    self._started = clock()
+    self._heap = [(self._started, i, key, interval) for i, (key, interval) in enumerate(sensors)]
+    heapq.heapify(self._heap)
+    self._busy = [0.0] * buses
+
+  def next_due(self):
+    """Return the time the next sensor is due, on the monotonic clock."""
+    return self._heap[0][0]
+
+  def pop_due(self, now):
+    """Return the keys of all sensors due at now and schedule their next reading."""
+    due = []
+    while self._heap[0][0] <= now:
+      (at, order, key, interval) = self._heap[0]
+      due.append(key)
+      # Skip the readings we are too late for.
+      at += interval * (int((now - at) // interval) + 1)
+      heapq.heapreplace(self._heap, (at, order, key, interval))
+    return due
+
+  def add_busy(self, bus, seconds):
+    self._busy[bus] += seconds
+
+  def utilisation(self):
+    """Return the fraction of time each bus was busy reading so far."""
+    elapsed = max(self._clock() - self._started, 1e-9)
+    return [busy / elapsed for busy in self._busy]
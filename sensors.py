@@ -0,0 +1,308 @@
+"""
+Sensor backends.
+
+A backend reads the temperatures of the sensors of one bus. DigitempBackend
+runs the digitemp binary; W1Backend reads the sysfs interface of the Linux
+w1_therm driver without starting any process.
+"""
+
+import os, time, logging, subprocess
+
+def sensor_names(sensors):
+  """Return the names of a list of sensors.
+
+  A sensor is either given by its name or as a dict with a 'name' and an
+  optional polling 'interval' in seconds.
+  """
+  return [sensor['name'] if isinstance(sensor, dict) else sensor for sensor in sensors]
+
+class Backend:
+  """Interface of a sensor backend.
+
+  A bus is a dict from the configuration, see main.get_buses(). Its
+  'sensors' are either names or dicts with a 'name' and further settings.
+  """
+
+  def readings(self, bus):
+    """Return a (name, temperature, timestamp) tuple for every sensor of the
+    bus that could be read, in Celsius.
+
+    The name is found by the sensor the value came from, not its position,
+    and the timestamp is when the sensor was read.
+    """
+    raise NotImplementedError
+
+  def reading(self, bus, index):
+    """Return the (name, temperature, timestamp) tuple of the sensor with the
+    given index. Raises IOError if it can't be read."""
+    raise NotImplementedError
+
+def crc8(data):
+  """Dallas/Maxim 1-Wire CRC8 of a sequence of byte values."""
+  crc = 0
+  for byte in data:
+    for i in range(8):
+      mix = (crc ^ byte) & 1
+      crc >>= 1
+      if mix:
+        crc ^= 0x8c
+      byte >>= 1
+  return crc
+
+def read_roms(path):
+  """Return the ROM serials listed in a digitemp config file, ordered by
+  sensor number and formatted like digitemp's %R does."""
+  roms = {}
+  for line in open(path):
+    # ROM 0 0x10 0xE4 0x5C 0x57 0x01 0x08 0x00 0x7D
+    fields = line.split()
+    if len(fields) == 10 and fields[0] == 'ROM':
+      roms[int(fields[1])] = ''.join('%02X' % int(byte, 16) for byte in fields[2:])
+  return [roms[number] for number in sorted(roms)]
+
+def sensor_roms(sensors, roms, path):
+  """Return the ROM serial of each of the sensors of a digitemp bus, or None.
+
+  A sensor with an 'id' has that serial. The others take, in order, the
+  serials of roms which no 'id' claims, so a sensor found by its serial
+  doesn't shift the position of the others.
+  """
+  claimed = set()
+  for sensor in sensors:
+    if isinstance(sensor, dict) and 'id' in sensor:
+      rom = sensor['id'].upper()
+      if rom in claimed:
+        logging.warning("%s: more than one sensor has the id %s." % (path, rom))
+      claimed.add(rom)
+  unclaimed = iter([rom for rom in roms if rom not in claimed])
+  result = []
+  for sensor in sensors:
+    if isinstance(sensor, dict) and 'id' in sensor:
+      result.append(sensor['id'].upper())
+    else:
+      rom = next(unclaimed, None)
+      if rom is None:
+        logging.warning("%s: no ROM line left for sensor %r." % (path, sensor))
+      result.append(rom)
+  return result
+
+def parse_reading(line, index):
+  """Parse a line of digitemp output into a (name, temperature, timestamp)
+  tuple using the sensor index of its bus, see DigitempBackend.sensor_index().
+  The name is None for sensors without one. Returns None for lines which
+  aren't readings."""
+  try:
+    rom, timestamp, temp = line.split()
+    reading = (index.get(rom), float(temp), int(timestamp))
+  except ValueError:
+    logging.warning("Ignoring unexpected digitemp output: %r" % line)
+    return None
+  if rom not in index:
+    logging.warning("Ignoring reading of unknown sensor %s, give its 'id' in config.py." % rom)
+  return reading
+
+class DigitempBackend(Backend):
+  """Reads the sensors of a bus by running the digitemp binary.
+
+  Readings are labelled by the ROM serial digitemp prints with them, see
+  sensor_index(), and stamped with the time digitemp read them. A bus has
+  the digitemp 'configfile' listing the ROM serials of its sensors.
+  """
+
+  def __init__(self, binary='/usr/bin/digitemp_DS9097'):
+    self.binary = binary
+    # Names of the sensors by ROM serial and digitemp's numbers for them, per
+    # config file and sensor list, see sensor_index() and sensor_numbers().
+    self._indexes = {}
+    self._numbers = {}
+
+  def command(self, bus, sensor=None):
+    """Build the digitemp command line to query all sensors of a bus once, or
+    only the one with the given number."""
+    path = os.path.abspath(bus.get('configfile', 'digitemp.conf'))
+    if sensor is None:
+      query = ['-a']                  # Query all sensors
+    else:
+      query = ['-t', str(sensor)]     # Query a single sensor
+    args = query + [
+             '-c', path,              # config file path
+             '-q',                    # omit the banner
+             '-o', '%R %N %C',        # ROM serial, time of the reading and the temperature in Celsius
+             ]
+    return [self.binary] + args
+
+  def roms(self, bus):
+    """Return the ROM serials of the config file of the bus, see read_roms()."""
+    path = os.path.abspath(bus.get('configfile', 'digitemp.conf'))
+    try:
+      return read_roms(path)
+    except IOError, ex:
+      logging.error("Could not read the ROM serials from %s: %s" % (path, ex))
+      return []
+
+  def sensor_index(self, bus):
+    """Return a dict from the ROM serial of each sensor of the bus to its name.
+
+    A sensor given as a dict with an 'id', its ROM serial as printed by
+    'digitemp -a -o %R', is found by that. The others are matched, in order,
+    to the ROM lines of the bus's config file no 'id' claims. The index is
+    built once per bus, so labelling a reading is a dict lookup.
+    """
+    path = os.path.abspath(bus.get('configfile', 'digitemp.conf'))
+    key = (path, repr(bus['sensors']))
+    if key not in self._indexes:
+      roms = self.roms(bus)
+      if len(roms) > len(bus['sensors']):
+        logging.warning("%s lists %d sensors but only %d are configured, ignoring the others." % (path, len(roms), len(bus['sensors'])))
+      # Sensors without a name map to None, their readings are dropped.
+      index = dict.fromkeys(roms)
+      for rom, name in zip(sensor_roms(bus['sensors'], roms, path), sensor_names(bus['sensors'])):
+        if rom is not None:
+          index[rom] = name
+      self._indexes[key] = index
+    return self._indexes[key]
+
+  def sensor_numbers(self, bus):
+    """Return digitemp's number of each sensor of the bus, for reading it
+    alone with -t.
+
+    The sensors are matched to the ROM lines of the config file like in
+    sensor_index(). The number is None for sensors without a ROM line.
+    """
+    path = os.path.abspath(bus.get('configfile', 'digitemp.conf'))
+    key = (path, repr(bus['sensors']))
+    if key not in self._numbers:
+      roms = self.roms(bus)
+      numbers = []
+      for rom in sensor_roms(bus['sensors'], roms, path):
+        numbers.append(roms.index(rom) if rom in roms else None)
+      self._numbers[key] = numbers
+    return self._numbers[key]
+
+  def round_size(self, bus):
+    """Return the number of readings digitemp takes per round on the bus, one
+    for every sensor in its config file."""
+    try:
+      return len(read_roms(os.path.abspath(bus.get('configfile', 'digitemp.conf')))) or len(bus['sensors'])
+    except IOError:
+      return len(bus['sensors'])
+
+  def readings(self, bus, sensor=None):
+    output = subprocess.check_output(self.command(bus, sensor))
+    index = self.sensor_index(bus)
+    readings = [parse_reading(line, index) for line in output.splitlines()]
+    return [reading for reading in readings if reading is not None and reading[0] is not None]
+
+  def reading(self, bus, index):
+    number = self.sensor_numbers(bus)[index]
+    if number is None:
+      raise IOError("Sensor %d is not in the digitemp config file." % index)
+    readings = self.readings(bus, number)
+    if not readings:
+      raise IOError("No reading of sensor %d from digitemp." % index)
+    return readings[0]
+
+class W1Backend(Backend):
+  """Reads DS18x20 sensors through /sys/bus/w1/devices.
+
+  The sensors of a bus are matched to devices by their 'id' (like
+  '28-000005e2fdc3') if given, the others in order to the remaining devices,
+  sorted by name. All sensors of a bus are read in parallel, and where the kernel
+  supports it, their conversions are started together through
+  therm_bulk_read first.
+  """
+
+  def __init__(self, root='/sys/bus/w1/devices', threads=8):
+    self.root = root
+    from multiprocessing.pool import ThreadPool
+    self.pool = ThreadPool(threads)
+
+  # Family codes of the devices the w1_therm driver reads: DS18S20, DS1822,
+  # DS18B20, DS1825 and DS28EA00.
+  families = ('10', '22', '28', '3b', '42')
+
+  def devices(self):
+    """Return the names of the temperature sensor devices, sorted. Other
+    devices on the bus, e.g. ID chips or switches, are left out."""
+    return sorted(name for name in os.listdir(self.root)
+                  if '-' in name and name.split('-', 1)[0].lower() in self.families)
+
+  def device_ids(self, bus):
+    """Return the device of every sensor of the bus. Sensors without an 'id'
+    take, in order, the devices no 'id' claims, or None when there are none
+    left."""
+    claimed = set()
+    for sensor in bus['sensors']:
+      if isinstance(sensor, dict) and 'id' in sensor:
+        if sensor['id'] in claimed:
+          logging.warning("More than one w1 sensor has the id %s." % sensor['id'])
+        claimed.add(sensor['id'])
+    unclaimed = None
+    ids = []
+    for index, sensor in enumerate(bus['sensors']):
+      if isinstance(sensor, dict) and 'id' in sensor:
+        ids.append(sensor['id'])
+      else:
+        if unclaimed is None:
+          unclaimed = iter([name for name in self.devices() if name not in claimed])
+        device = next(unclaimed, None)
+        if device is None:
+          logging.warning("No w1 device left for sensor %d." % index)
+        ids.append(device)
+    return ids
+
+  def trigger(self):
+    """Start a conversion on all sensors at once, if the kernel supports it."""
+    for name in os.listdir(self.root):
+      path = os.path.join(self.root, name, 'therm_bulk_read')
+      if name.startswith('w1_bus_master') and os.path.exists(path):
+        try:
+          f = open(path, 'w')
+          f.write('trigger\n')
+          f.close()
+        except IOError, ex:
+          logging.debug("Could not trigger bulk conversion on %s: %s" % (name, ex))
+
+  def read_device(self, device):
+    """Read and check a single device, returns its temperature.
+
+    Raises IOError if the reading fails its CRC check.
+    """
+    lines = open(os.path.join(self.root, device, 'w1_slave')).read().splitlines()
+    # 72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+    # 72 01 4b 46 7f ff 0e 10 57 t=23125
+    try:
+      data = [int(byte, 16) for byte in lines[0].split(':')[0].split()]
+      valid = len(data) == 9 and crc8(data[:8]) == data[8] and lines[0].endswith('YES')
+      millicelsius = int(lines[1].rsplit('t=', 1)[1])
+    except (IndexError, ValueError):
+      valid = False
+    if not valid:
+      raise IOError("Invalid reading from w1 device %s: %r" % (device, lines))
+    return millicelsius / 1000.0
+
+  def _read_stamped(self, device):
+    """Return the temperature of a device and when it was read, or None if
+    it couldn't be read. Failed CRC checks happen now and then on 1-Wire,
+    they must not cost the readings of the other sensors."""
+    if device is None:
+      return None
+    try:
+      return (self.read_device(device), time.time())
+    except IOError, ex:
+      logging.warning("Skipping w1 device %s: %s" % (device, ex))
+      return None
+
+  def readings(self, bus):
+    """Return the readings of the sensors of the bus, leaving out those
+    which couldn't be read."""
+    self.trigger()
+    results = self.pool.map(self._read_stamped, self.device_ids(bus))
+    return [(name, result[0], result[1]) for (name, result) in zip(sensor_names(bus['sensors']), results)
+            if result is not None]
+
+  def reading(self, bus, index):
+    device = self.device_ids(bus)[index]
+    if device is None:
+      raise IOError("No w1 device for sensor %d." % index)
+    return (sensor_names(bus['sensors'])[index], self.read_device(device), time.time())
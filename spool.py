@@ -0,0 +1,145 @@
+"""
+Append-only on-disk spool for readings that have not been uploaded yet.
+
+Readings are appended as JSON lines to segment files in a spool directory. A
+cursor file records how far the oldest segment has been uploaded, so a later
+run continues where the previous one stopped. When the spool grows beyond its
+size cap, the oldest segments are removed.
+"""
+
+import os, json, time, fcntl, socket, logging
+from metricfire import atomicWrite
+
+class Spool:
+  """A directory of segment files holding (metric, value, timestamp) tuples."""
+
+  def __init__(self, path, max_bytes=10*1024*1024, segment_bytes=256*1024):
+    self.path = os.path.abspath(path)
+    self.max_bytes = max_bytes
+    self.segment_bytes = segment_bytes
+    self.dropped = 0
+    if not os.path.isdir(self.path):
+      os.makedirs(self.path)
+
+  def _segments(self):
+    """Return the segment file names, oldest first."""
+    return sorted(name for name in os.listdir(self.path) if name.startswith('segment-'))
+
+  def _lock(self):
+    """Lock the spool against concurrent runs, e.g. overlapping cron jobs."""
+    lock = open(os.path.join(self.path, 'lock'), 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+  def _read_cursor(self):
+    try:
+      name, offset = open(os.path.join(self.path, 'cursor')).read().split()
+      return name, int(offset)
+    except (IOError, ValueError):
+      return None, 0
+
+  def _write_cursor(self, name, offset):
+    atomicWrite(os.path.join(self.path, 'cursor'), '%s %d\n' % (name, offset))
+
+  def append(self, datapoints):
+    """Append a list of (metric, value, timestamp) tuples to the spool."""
+    data = ''.join(json.dumps(datapoint) + '\n' for datapoint in datapoints)
+    lock = self._lock()
+    try:
+      segments = self._segments()
+      if segments and os.path.getsize(os.path.join(self.path, segments[-1])) < self.segment_bytes:
+        name = segments[-1]
+      else:
+        # Segment names sort in the order they were created.
+        name = 'segment-%017.6f' % time.time()
+        segments.append(name)
+      f = open(os.path.join(self.path, name), 'a')
+      f.write(data)
+      f.close()
+      self._compact(segments)
+    finally:
+      lock.close()
+
+  def _compact(self, segments):
+    """Remove the oldest segments while the spool exceeds its size cap."""
+    sizes = [os.path.getsize(os.path.join(self.path, name)) for name in segments]
+    total = sum(sizes)
+    cursor, offset = self._read_cursor()
+    while total > self.max_bytes and len(segments) > 1:
+      name = segments.pop(0)
+      size = sizes.pop(0)
+      lost = open(os.path.join(self.path, name)).read()
+      if name == cursor:
+        lost = lost[offset:]
+      self.dropped += lost.count('\n')
+      logging.warning("Spool exceeds %d bytes, dropping %s" % (self.max_bytes, name))
+      os.remove(os.path.join(self.path, name))
+      total -= size
+
+  def pending(self):
+    """Return the number of bytes not uploaded yet."""
+    cursor, offset = self._read_cursor()
+    total = 0
+    for name in self._segments():
+      total += os.path.getsize(os.path.join(self.path, name))
+      if name == cursor:
+        total -= offset
+    return total
+
+  def drain(self, send, batch_size=200, rate=None, max_seconds=None):
+    """Upload spooled readings, oldest first.
+
+    send is called with lists of up to batch_size datapoints and must return
+    True once they have been sent. The spool only advances past a batch after
+    that. A socket.error from send, e.g. while the network is down, counts as
+    a failed batch and stops the drain, so a later drain retries it. rate limits the upload to that many datapoints per second and
+    max_seconds bounds the time spent. Returns the number of datapoints sent.
+    """
+    started = time.time()
+    sent = 0
+    lock = self._lock()
+    try:
+      cursor, offset = self._read_cursor()
+      for name in self._segments():
+        if name != cursor:
+          offset = 0
+        f = open(os.path.join(self.path, name))
+        try:
+          f.seek(offset)
+          done = False
+          while not done:
+            batch = []
+            while len(batch) < batch_size:
+              line = f.readline()
+              if not line.endswith('\n'):
+                # End of the segment or a partially written last line.
+                done = True
+                break
+              offset += len(line)
+              try:
+                batch.append(tuple(json.loads(line)))
+              except ValueError:
+                logging.warning("Skipping corrupt spool entry: %r" % line)
+            if batch:
+              try:
+                if not send(batch):
+                  return sent
+              except socket.error, ex:
+                logging.warning("Could not upload spooled readings: %s" % ex)
+                return sent
+              sent += len(batch)
+            self._write_cursor(name, offset)
+            # An exhausted segment is removed below even when out of time.
+            if batch and max_seconds is not None and time.time() - started >= max_seconds:
+              return sent
+            if rate:
+              # Sleep until the average rate is back at the limit.
+              time.sleep(max(0, started + float(sent) / rate - time.time()))
+        finally:
+          f.close()
+        # Keep the last segment, it is still being appended to.
+        if name != self._segments()[-1]:
+          os.remove(os.path.join(self.path, name))
+      return sent
+    finally:
+      lock.close()
@@ -0,0 +1,104 @@
+import unittest, sys, os
+
+sys.path.append(os.getcwd())
+import metricfire
+from ingest import IngestServer
+from backfill import Backfill, TokenBucket, parse_line
+
+KEY = '00000000-0000-0000-0000-000000000000'
+
+class FakeClock:
+  def __init__(self):
+    self.now = 1000.0
+    self.slept = []
+
+  def __call__(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.slept.append(seconds)
+    self.now += seconds
+
+class TestBackfill(unittest.TestCase):
+  def setUp(self):
+    self.path = os.path.abspath('tests/tmp/backfill.csv')
+    self.checkpoint = self.path + '.checkpoint'
+    f = open(self.path, 'w')
+    f.write('metric,value,timestamp\n')
+    for i in range(250):
+      f.write('outside,%s,%d\n' % (i * 0.5, 1334000000 + 60 * i))
+    f.close()
+    self.server = IngestServer([KEY])
+    self.server.start()
+    self.client = metricfire.Client(KEY, application='test', server='127.0.0.1:%d' % self.server.address[1], try_adns=False)
+
+  def tearDown(self):
+    self.server.stop()
+    for path in (self.path, self.checkpoint):
+      if os.path.exists(path):
+        os.remove(path)
+
+  def test_parse_line(self):
+    self.assertEqual(parse_line('outside,17.5,1334000000\n'), ('outside', 17.5, 1334000000))
+    self.assertEqual(parse_line('outside 17.5 1334000000.0'), ('outside', 17.5, 1334000000))
+    self.assertEqual(parse_line('["outside", 17.5, 1334000000]'), ('outside', 17.5, 1334000000))
+    self.assertEqual(parse_line('metric,value,timestamp'), None)
+    self.assertEqual(parse_line('# comment'), None)
+    # JSON which isn't a metric, value and timestamp
+    for line in ('[1, 2, 3]', '["a", null, 1]', '[1, 2]', '42', '"a"', '{"a": 1}'):
+      self.assertEqual(parse_line(line), None)
+
+  def test_skip_malformed(self):
+    f = open(self.path, 'a')
+    f.write('[1, 2, 3]\n["a", null, 1]\n\n42\n# done\n')
+    f.close()
+    backfill = Backfill(self.client, self.path, batch=100)
+    self.assertEqual(backfill.run(), 250)
+    # The CSV header and the three malformed lines
+    self.assertEqual(backfill.skipped, 4)
+
+  def test_upload(self):
+    sent = Backfill(self.client, self.path, self.checkpoint, batch=100).run()
+    self.assertEqual(sent, 250)
+    self.server.drain(0.05)
+    self.assertEqual(self.server.datapoints[:2], [('outside', 0, 1334000000), ('outside', 0.5, 1334000060)])
+    self.assertEqual(len(self.server.datapoints), 250)
+    # Datapoints are packed into full datagrams
+    self.assertTrue(self.server.stats()['messages'] < 25)
+    # Everything is done, a second run sends nothing
+    self.assertEqual(int(open(self.checkpoint).read()), os.path.getsize(self.path))
+    self.assertEqual(Backfill(self.client, self.path, self.checkpoint).run(), 0)
+
+  def test_resume(self):
+    backfill = Backfill(self.client, self.path, self.checkpoint, batch=100)
+    send_many = self.client.send_many
+    calls = []
+    def failing(datapoints):
+      calls.append(len(datapoints))
+      if len(calls) == 2:
+        raise IOError("network down")
+      return send_many(datapoints)
+    self.client.send_many = failing
+    self.assertRaises(IOError, backfill.run)
+    # Only the first batch made it, the checkpoint is right after it
+    self.assertEqual(backfill.sent, 100)
+    self.client.send_many = send_many
+    self.assertEqual(Backfill(self.client, self.path, self.checkpoint, batch=100).run(), 150)
+    self.server.drain(0.05)
+    self.assertEqual([value for (metric, value, timestamp) in self.server.datapoints], [i * 0.5 for i in range(250)])
+
+  def test_token_bucket(self):
+    clock = FakeClock()
+    bucket = TokenBucket(100, 50, clock, clock.sleep)
+    # The burst is available right away
+    bucket.take(50)
+    self.assertEqual(clock.slept, [])
+    # After that, tokens come in at the rate
+    bucket.take(100)
+    self.assertEqual(clock.slept, [1.0])
+    clock.now += 0.25
+    bucket.take(25)
+    self.assertEqual(clock.slept, [1.0])
+
+if __name__ == '__main__':
+  unittest.main()
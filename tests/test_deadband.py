@@ -0,0 +1,43 @@
+import unittest, sys, os
+
+sys.path.append(os.getcwd())
+from deadband import Deadband
+
+class TestDeadband(unittest.TestCase):
+  def test_deadband(self):
+    deadband = Deadband(0.5)
+    values = [20.0, 20.1, 20.4, 20.6, 20.7, 19.9]
+    sent = []
+    for i, value in enumerate(values):
+      sent.extend(v for (m, v, t) in deadband.filter([('t', value, i)]))
+    self.assertEqual(sent, [20.0, 20.6, 19.9])
+    self.assertEqual((deadband.sent, deadband.suppressed), (3, 3))
+
+  def test_heartbeat(self):
+    deadband = Deadband(1.0, heartbeat=60)
+    sent = []
+    for t in range(0, 200, 10):
+      sent.extend(t for (m, v, ts) in deadband.filter([('t', 20.0, t)]))
+    self.assertEqual(sent, [0, 60, 120, 180])
+
+  def test_ewma_flicker(self):
+    deadband = Deadband(0.1, alpha=0.2)
+    sent = []
+    for i in range(50):
+      # Quantisation flicker between two adjacent steps
+      sent.extend(deadband.filter([('t', 20.0 + 0.0625 * (i % 2), i)]))
+    self.assertEqual(len(sent), 1)
+    # A real change still gets through
+    for i in range(50, 60):
+      sent.extend(deadband.filter([('t', 21.0, i)]))
+    self.assertTrue(len(sent) > 1)
+
+  def test_state(self):
+    path = os.path.abspath('tests/tmp/deadband.json')
+    deadband = Deadband(0.5)
+    deadband.filter([('t', 20.0, 0)])
+    deadband.save(path)
+    restored = Deadband(0.5)
+    restored.load(path)
+    os.remove(path)
+    self.assertEqual(restored.filter([('t', 20.2, 10)]), [])
@@ -0,0 +1,78 @@
+import unittest, sys, os, json, urllib2
+
+sys.path.append(os.getcwd())
+from history import Ring, History, HistoryServer
+
+class TestRing(unittest.TestCase):
+  def test_wraparound(self):
+    ring = Ring(4)
+    self.assertEqual(ring.latest(), None)
+    self.assertEqual(ring.window(0)['count'], 0)
+    for i in range(6):
+      ring.append(100 + i, i * 1.5)
+    # Only the last four readings are kept
+    self.assertEqual(ring.latest(), (105, 7.5))
+    self.assertEqual(ring.window(0), {'count': 4, 'min': 3.0, 'max': 7.5, 'avg': 5.25})
+    self.assertEqual(ring.window(104), {'count': 2, 'min': 6.0, 'max': 7.5, 'avg': 6.75})
+    self.assertEqual(ring.window(106)['count'], 0)
+
+  def test_blocks(self):
+    # Windows starting anywhere agree with the samples themselves
+    ring = Ring(10)
+    for i in range(37):
+      ring.append(100 + i, (i * 7) % 11)
+      kept = [(100 + j, (j * 7) % 11) for j in range(max(0, i - 9), i + 1)]
+      for since in range(95, 100 + i + 2):
+        values = [value for (timestamp, value) in kept if timestamp >= since]
+        expected = {'count': len(values), 'min': min(values or [None]), 'max': max(values or [None]),
+                    'avg': sum(values) / float(len(values)) if values else None}
+        self.assertEqual(ring.window(since), expected)
+
+  def test_clock_steps_back(self):
+    ring = Ring(10)
+    for i in range(5):
+      ring.append(1000 + i, i)
+    # The clock steps back by an hour
+    for i in range(3):
+      ring.append(-2600 + i, 10 + i)
+    self.assertEqual(ring.latest(), (-2598, 12))
+    self.assertEqual(ring.window(-2599), {'count': 2, 'min': 11.0, 'max': 12.0, 'avg': 11.5})
+    # Windows reaching back before the step count the time the clock repeated once
+    self.assertEqual(ring.window(-2600 - 2)['count'], 6)
+    self.assertEqual(ring.window(0)['count'], 0)
+
+class TestHistory(unittest.TestCase):
+  def setUp(self):
+    self.history = History(retention=600, interval=60)
+    self.history.add([('outside', 10.0 + i, 1334000000 + 60 * i) for i in range(20)])
+    self.history.add([('inside', 21.5, None)], now=1334001140)
+
+  def test_retention(self):
+    # 600 seconds of readings every 60 seconds, both ends included
+    self.assertEqual(self.history.rings['outside'].capacity, 11)
+    result = self.history.query('outside', now=1334001140)
+    self.assertEqual(result['count'], 11)
+    self.assertEqual(result['min'], 19.0)
+
+  def test_query(self):
+    result = self.history.query('outside', window=120, now=1334001140)
+    self.assertEqual(result, {'count': 3, 'min': 27.0, 'max': 29.0, 'avg': 28.0,
+                              'latest': 29.0, 'time': 1334001140})
+    self.assertEqual(self.history.query('attic'), None)
+    self.assertEqual(self.history.latest(), {'outside': (1334001140, 29.0), 'inside': (1334001140, 21.5)})
+
+  def test_server(self):
+    server = HistoryServer(self.history, ('127.0.0.1', 0))
+    server.start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    try:
+      self.assertEqual(json.load(urllib2.urlopen(url + '/'))['inside'], [1334001140, 21.5])
+      result = json.load(urllib2.urlopen(url + '/outside'))
+      self.assertEqual((result['latest'], result['count']), (29.0, 11))
+      self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + '/attic')
+    finally:
+      server.shutdown()
+      server.server_close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,155 @@
+import unittest, sys, os, json, threading
+
+sys.path.append(os.getcwd())
+import metricfire
+from ingest import IngestServer
+
+KEY = '00000000-0000-0000-0000-000000000000'
+OTHER_KEY = '11111111-1111-1111-1111-111111111111'
+
+class TestIngestServer(unittest.TestCase):
+  def setUp(self):
+    self.server = IngestServer([KEY])
+    self.server.start()
+    self.client = metricfire.Client(KEY, application='test', server='127.0.0.1:%d' % self.server.address[1], try_adns=False)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_roundtrip(self):
+    self.client.send('a', 1, 1334000000)
+    self.client.send_many([('b', 2.5, 1334000001), ('c', 3, 1334000002)])
+    self.server.drain(0.05)
+    self.assertEqual(self.server.datapoints, [('a', 1, 1334000000), ('b', 2.5, 1334000001), ('c', 3, 1334000002)])
+    stats = self.server.stats()
+    self.assertEqual(stats['messages'], 2)
+    self.assertEqual(stats['lost'], 0)
+    self.assertEqual(stats['sessions'], 1)
+
+  def test_threads(self):
+    def send():
+      for i in range(50):
+        self.client.send('a', i, 1334000000)
+    threads = [threading.Thread(target=send) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.server.drain(0.05)
+    stats = self.server.stats()
+    # Every thread has its own session
+    self.assertEqual(stats['sessions'], 4)
+    self.assertEqual(stats['messages'], 200)
+    self.assertEqual(stats['replayed'], 0)
+    self.assertEqual(stats['lost'], 0)
+
+  def test_rejects(self):
+    message = self.client._format([('a', 1, None)])
+    self.assertIsNotNone(self.server.handle(message))
+    # Replayed message
+    self.assertIsNone(self.server.handle(message))
+    # Tampered body
+    self.assertIsNone(self.server.handle(message.replace('"a", 1', '"a", 2')))
+    # Unknown key
+    other = metricfire.Client(OTHER_KEY, application='test', server='127.0.0.1:1', try_adns=False)
+    self.assertIsNone(self.server.handle(other._format([('a', 1, None)])))
+    self.assertIsNone(self.server.handle('garbage'))
+    stats = self.server.stats()
+    self.assertEqual((stats['replayed'], stats['bad_auth'], stats['unknown_key'], stats['malformed']), (1, 1, 1, 1))
+
+  def test_loss(self):
+    messages = [self.client._format([('a', i, None)]) for i in range(5)]
+    for message in messages[:2] + messages[3:]:
+      self.server.handle(message)
+    self.assertEqual(self.server.lost(), 1)
+
+class TestCompact(unittest.TestCase):
+  def setUp(self):
+    self.server = IngestServer([KEY])
+    self.server.start()
+    address = '127.0.0.1:%d' % self.server.address[1]
+    self.client = metricfire.Client(KEY, application='test', server=address, try_adns=False, compact=True)
+    self.json_client = metricfire.Client(KEY, application='test', server=address, try_adns=False)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_roundtrip(self):
+    datapoints = [('site.building%d.floor2.room%d.temperature' % (i % 3, i % 20), 20 + i * 0.0625, 1334000000 + i // 20 * 60)
+                  for i in range(1000)]
+    self.client.send('a', 1, 1334000000)
+    self.client.send_many(datapoints)
+    self.server.drain(0.05)
+    self.assertEqual(self.server.datapoints, [('a', 1, 1334000000)] + datapoints)
+    stats = self.server.stats()
+    self.assertEqual((stats['lost'], stats['bad_auth'], stats['malformed']), (0, 0, 0))
+    compact_messages = stats['messages'] - 1
+    self.assertTrue(stats['bytes'] <= self.client._max_datagram * stats['messages'])
+    # Several times as many datapoints fit into a datagram
+    self.json_client.send_many(datapoints)
+    self.server.drain(0.05)
+    self.assertTrue(self.server.stats()['messages'] - stats['messages'] > 3 * compact_messages)
+
+  def test_compression_estimate(self):
+    batch = [('site.building%d.temperature' % (i % 3), i, 1334000000 + i) for i in range(50)]
+    used = sum(len(json.dumps(datapoint)) + 2 for datapoint in batch)
+    body = self.client._compactBody(batch)
+    list(self.client._compactMessages(batch, used))
+    # The ratio isn't truncated to a whole number
+    self.assertAlmostEqual(self.client._compression, 0.5 * 4.0 + 0.5 * float(used) / len(body))
+    # A compressed body is a fraction of the size of the JSON
+    self.assertTrue(0 < 1 / self.client._compression < 1)
+
+  def test_rejects_tampered(self):
+    message = self.client._format([('a', 1, None)])
+    header, body = message.split('\n', 1)
+    self.assertIsNone(self.server.handle(header + '\n' + body[:-1] + chr(ord(body[-1]) ^ 1)))
+    self.assertIsNone(self.server.handle(header + '\nnot zlib'))
+    self.assertIsNotNone(self.server.handle(message))
+    stats = self.server.stats()
+    # The checksum of the compressed body catches the tampering before the HMAC does
+    self.assertEqual((stats['malformed'], stats['messages']), (2, 1))
+
+class TestFork(unittest.TestCase):
+  def test_fork_rekeys(self):
+    server = IngestServer([KEY])
+    server.start()
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:%d' % server.address[1], try_adns=False)
+    client.send('parent', 1)
+    pid = os.fork()
+    if pid == 0:
+      try:
+        client.send('child', 1)
+        client.send('child', 2)
+      finally:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    client.send('parent', 2)
+    server.drain(0.05)
+    server.stop()
+    stats = server.stats()
+    # The child used a session of its own, nothing was rejected as a replay
+    self.assertEqual(stats['messages'], 4)
+    self.assertEqual(stats['replayed'], 0)
+    self.assertEqual(stats['sessions'], 2)
+
+  def test_fork_buffered(self):
+    server = IngestServer([KEY])
+    server.start()
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:%d' % server.address[1], try_adns=False, buffered=True, flush_interval=60)
+    client.send('parent', 1)
+    pid = os.fork()
+    if pid == 0:
+      try:
+        for i in range(5):
+          client.send('child', i)
+        client.flush()
+      finally:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    client.flush()
+    server.drain(0.05)
+    server.stop()
+    # The child sent its own datapoints, but not the ones its parent buffered
+    self.assertEqual(sorted((m, v) for (m, v, t) in server.datapoints), [('child', i) for i in range(5)] + [('parent', 1)])
+    self.assertEqual(server.stats()['replayed'], 0)
@@ -1,11 +1,11 @@
-import unittest, sys, os, mock
+import unittest, sys, os, mock, shutil, subprocess, time, asyncore
 
 import logging
 
 logging.basicConfig(level=logging.ERROR)
 
 sys.path.append(os.getcwd())
-import main
+import main, sensors
 
 class TestMain(unittest.TestCase):
   def setUp(self):
@@ -13,6 +13,9 @@ class TestMain(unittest.TestCase):
     main.config['configfile'] = os.path.abspath('tests/tmp/digitemp.conf')
     main.config['configfile'] = os.path.abspath('tests/tmp/digitemp.conf')
     main.config['sensors']    = ['outside', 'inside']
+    # Let the mockup write the ROM serials of its sensors
+    subprocess.call([main.config['digitemp'], '-i', '-c', main.config['configfile']])
+    main._backends.clear()
 
   def test_self(self):
     self.assertIsNotNone(main.config)
@@ -42,35 +45,258 @@ class TestMain(unittest.TestCase):
     self.assertTrue(os.path.exists(path))
     os.remove(path)
 
-  def test_get_temperatures(self):
+  def test_get_readings(self):
     # The configured digitemp path must contain the word test to indicate, it's a mockup
     self.assertIn('test', main.config['digitemp'])
-    values = main.get_temperatures()
-    self.assertIn(17.5, values)
-    self.assertIn(22.5, values)
-
-  def test_send_temperatures(self):
-    # mock metricfire.send
-    with mock.patch('metricfire.send') as mf_mock:
-      # call send_temperatures with array of values
-      values = [10, 20]
-      main.send_temperatures(values)
-      # check send() was called properly
-      expected = map(mock.call, main.config['sensors'], values)
-      mf_mock.assert_has_calls(expected)
-
-  @mock.patch('main.send_temperatures')
-  @mock.patch('main.get_temperatures')
+    readings = main.get_readings()
+    self.assertEqual([(name, temp) for (name, temp, read) in readings], [('outside', 17.5), ('inside', 22.5)])
+
+  def test_stream_temperatures(self):
+    interval = main.config['interval']
+    main.config['interval'] = 0.01
+    try:
+      stream = main.stream_temperatures()
+      readings = [next(stream) for i in range(3)]
+      stream.close()
+    finally:
+      main.config['interval'] = interval
+    for timestamp, values in readings:
+      self.assertEqual([(name, temp) for (name, temp, read) in values], [('outside', 17.5), ('inside', 22.5)])
+      self.assertTrue(all(read <= timestamp for (name, temp, read) in values))
+    self.assertTrue(readings[0][0] <= readings[-1][0])
+
+  def test_digitemp_reader(self):
+    interval = main.config['interval']
+    main.config['interval'] = 0.01
+    map = {}
+    try:
+      with mock.patch('main.send_readings') as send_mock:
+        reader = main.digitemp_reader_class()(main.get_buses()[0], map)
+        while send_mock.call_count < 2:
+          asyncore.loop(timeout=1, map=map, count=1)
+        reader.handle_close()
+    finally:
+      main.config['interval'] = interval
+    args, kwargs = send_mock.call_args
+    self.assertEqual([(name, temp) for (name, temp, read) in args[0]], [('outside', 17.5), ('inside', 22.5)])
+    self.assertEqual(map, {})
+
+  def test_get_reading(self):
+    bus = main.get_buses()[0]
+    self.assertEqual(main.get_reading(bus, 0)[:2], ('outside', 17.5))
+    self.assertEqual(main.get_reading(bus, 1)[:2], ('inside', 22.5))
+
+  def test_sensor_intervals(self):
+    self.assertFalse(main.has_sensor_intervals())
+    main.config['sensors'] = ['outside', {'name': 'inside', 'interval': 600}]
+    self.assertTrue(main.has_sensor_intervals())
+    self.assertEqual(main.sensor_names(main.config['sensors']), ['outside', 'inside'])
+    self.assertEqual(main.sensor_interval(main.config['sensors'][1]), 600)
+    readings, busy = main.poll_sensors(main.get_buses()[0], [1])
+    self.assertEqual([(name, temp) for (name, temp, read) in readings], [('inside', 22.5)])
+
+  def test_send_readings(self):
+    # mock metricfire.send_many
+    with mock.patch('metricfire.send_many') as mf_mock:
+      main.send_readings([('outside', 10, 1334000000), ('inside', 20, 1334000001)])
+      # check all values were sent in one batch with the time they were read
+      expected = [('outside', 10, 1334000000), ('inside', 20, 1334000001)]
+      mf_mock.assert_called_once_with(expected)
+
+  @mock.patch('metricfire.send_many')
+  def test_send_readings_deadband(self, mf_mock):
+    main.config['deadband'] = 0.5
+    try:
+      main.send_readings([('outside', 10, None), ('inside', 20, None)], 1334000000)
+      main.send_readings([('outside', 10.2, None), ('inside', 21, None)], 1334000060)
+    finally:
+      main.config['deadband'] = None
+      main._deadband = None
+    self.assertEqual(mf_mock.call_args_list, [
+      mock.call([('outside', 10, 1334000000), ('inside', 20, 1334000000)]),
+      mock.call([('inside', 21, 1334000060)])])
+
+  @mock.patch('metricfire.wait')
+  @mock.patch('metricfire.send_many')
+  def test_send_readings_spool(self, mf_mock, wait_mock):
+    main.config['spool'] = os.path.abspath('tests/tmp/spool-main')
+    try:
+      # The first upload fails because DNS doesn't resolve
+      wait_mock.return_value = False
+      main.send_readings([('outside', 10, None), ('inside', 20, None)], 1334000000)
+      self.assertFalse(mf_mock.called)
+      # The next one uploads the backlog as well
+      wait_mock.return_value = True
+      mf_mock.return_value = True
+      main.send_readings([('outside', 11, None), ('inside', 21, None)], 1334000060)
+      mf_mock.assert_called_once_with([('outside', 10, 1334000000), ('inside', 20, 1334000000),
+                                       ('outside', 11, 1334000060), ('inside', 21, 1334000060)])
+    finally:
+      main.config['spool'] = None
+      main._spool = None
+      shutil.rmtree(os.path.abspath('tests/tmp/spool-main'))
+
+  @mock.patch('metricfire.wait')
+  @mock.patch('metricfire.send_many')
+  def test_send_readings_spool_nonblocking(self, mf_mock, wait_mock):
+    main.config['spool'] = os.path.abspath('tests/tmp/spool-main')
+    try:
+      wait_mock.return_value = False
+      main.get_spool().append([('backlog', i, 1334000000) for i in range(300)])
+      main.send_readings([('outside', 10, 1334000060)], 1334000060, block=False)
+      wait_mock.assert_called_once_with(0)
+      self.assertFalse(mf_mock.called)
+      # The backlog goes out a batch at a time
+      wait_mock.return_value = True
+      mf_mock.return_value = True
+      main.send_readings([('outside', 11, 1334000120)], 1334000120, block=False)
+      self.assertEqual(len(mf_mock.call_args[0][0]), 200)
+      main.send_readings([('outside', 12, 1334000180)], 1334000180, block=False)
+      self.assertEqual(sum(len(args[0]) for (args, kwargs) in mf_mock.call_args_list), 303)
+    finally:
+      main.config['spool'] = None
+      main._spool = None
+      shutil.rmtree(os.path.abspath('tests/tmp/spool-main'))
+
+  @mock.patch('main.send_readings')
+  @mock.patch('main.get_readings')
   def test_send_receive(self, get_mock, send_mock):
-    values = [10, 20]
-    get_mock.return_value = values
+    readings = [('outside', 10, 1334000000), ('inside', 20, 1334000001)]
+    get_mock.return_value = readings
     main.send_receive()
-    # test that get_temperatures gets called
-    get_mock.assert_called_once_with()
-    # test that send_temperatures gets called
-    send_mock.assert_called_once_with(values)
-
-  def test_main_once(self):
-    # TODO: Make main() testable
-    pass
+    # test that get_readings gets called for the only bus
+    get_mock.assert_called_once_with(main.get_buses()[0])
+    # test that send_readings gets called
+    send_mock.assert_called_once_with(readings, None)
+
+  def test_poll_buses(self):
+    main.config['buses'] = [
+      {'configfile': main.config['configfile'], 'sensors': ['a', 'b']},
+      {'configfile': main.config['configfile'], 'sensors': ['c']},
+    ]
+    try:
+      readings = main.poll_buses()
+    finally:
+      main.config['buses'] = []
+    # The second bus has more sensors than names, extra values are ignored
+    self.assertEqual([(name, temp) for (name, temp, read) in readings], [('a', 17.5), ('b', 22.5), ('c', 17.5)])
+
+  def test_poll_buses_failure(self):
+    main.config['buses'] = [
+      {'port': '/dev/ttyUSB9', 'configfile': main.config['configfile'], 'sensors': ['a', 'b']},
+      {'configfile': main.config['configfile'], 'sensors': ['c']},
+    ]
+    real = sensors.DigitempBackend.command
+    def command(self, bus, sensor=None):
+      if bus.get('port') == '/dev/ttyUSB9':
+        return ['false']
+      return real(self, bus, sensor)
+    try:
+      with mock.patch.object(sensors.DigitempBackend, 'command', command):
+        readings = main.poll_buses()
+    finally:
+      main.config['buses'] = []
+    # The bus that failed is skipped, the other one is still read
+    self.assertEqual([(name, temp) for (name, temp, read) in readings], [('c', 17.5)])
+
+  def test_missing_w1_root(self):
+    main.config['w1_devices'] = '/nonexistent/w1'
+    bus = {'backend': 'w1', 'sensors': ['attic']}
+    try:
+      # Logged and skipped, neither ends the polling loop
+      self.assertEqual(main.get_readings(bus), [])
+      self.assertIsNone(main.get_reading(bus, 0))
+    finally:
+      del main.config['w1_devices']
+      main._backends.clear()
+
+  def test_missing_digitemp(self):
+    main.config['digitemp'] = '/nonexistent/digitemp'
+    bus = main.get_buses()[0]
+    self.assertEqual(main.get_readings(bus), [])
+    self.assertIsNone(main.get_reading(bus, 0))
+
+  def test_w1_backend(self):
+    root = os.path.abspath('tests/tmp/w1-main')
+    os.makedirs(os.path.join(root, '28-000005e2fdc3'))
+    open(os.path.join(root, '28-000005e2fdc3', 'w1_slave'), 'w').write(
+      "72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n72 01 4b 46 7f ff 0e 10 57 t=23125\n")
+    main.config['w1_devices'] = root
+    main.config['buses'] = [
+      {'backend': 'w1', 'sensors': ['attic']},
+      {'configfile': main.config['configfile'], 'sensors': ['a', 'b']},
+    ]
+    try:
+      self.assertFalse(main.digitemp_only())
+      readings = main.poll_buses()
+    finally:
+      main.config['buses'] = []
+      del main.config['w1_devices']
+      main._backends.clear()
+      shutil.rmtree(root)
+    self.assertEqual([(name, temp) for (name, temp, read) in readings], [('attic', 23.125), ('a', 17.5), ('b', 22.5)])
+
+  def test_read_roms(self):
+    self.assertEqual(sensors.read_roms(main.config['configfile']), ['10E45C570108007D', '28B1C3A2040000E1'])
+
+  def test_serial_ids(self):
+    # Sensors with an id keep their names whatever the order of the config file
+    main.config['sensors'] = [{'name': 'outside', 'id': '28b1c3a2040000e1', 'interval': 600}, {'name': 'inside', 'interval': 60}]
+    bus = main.get_buses()[0]
+    index = main.get_backend(bus).sensor_index(bus)
+    # The other sensor takes the ROM line the id leaves over
+    self.assertEqual(index, {'28B1C3A2040000E1': 'outside', '10E45C570108007D': 'inside'})
+    self.assertEqual(main.get_backend(bus).sensor_numbers(bus), [1, 0])
+    self.assertEqual(main.parse_reading('28B1C3A2040000E1 1334000000 22.5', index), ('outside', 22.5, 1334000000))
+    self.assertEqual(main.parse_reading('junk', index), None)
+    self.assertEqual(main.parse_reading('1000000000000000 1334000000 20', index), (None, 20.0, 1334000000))
+    self.assertEqual([(name, temp) for (name, temp, read) in main.get_readings()], [('inside', 17.5), ('outside', 22.5)])
+    # A sensor missing from the configuration isn't sent
+    main.config['sensors'] = [{'name': 'outside', 'id': '28b1c3a2040000e1'}]
+    self.assertEqual(main.get_backend(bus).sensor_index(main.get_buses()[0]), {'28B1C3A2040000E1': 'outside', '10E45C570108007D': None})
+    self.assertEqual([(name, temp) for (name, temp, read) in main.get_readings()], [('outside', 22.5)])
+
+  def test_sensor_numbers(self):
+    # Sensors with an id are read alone by their number in the config file
+    main.config['sensors'] = [{'name': 'attic', 'id': '28B1C3A2040000E1', 'interval': 600},
+                              {'name': 'outside', 'id': '10E45C570108007D'},
+                              {'name': 'gone', 'id': '1000000000000000'}]
+    bus = main.get_buses()[0]
+    self.assertEqual(main.get_backend(bus).sensor_numbers(bus), [1, 0, None])
+    readings, busy = main.poll_sensors(bus, [0, 1, 2])
+    # The sensor missing from the config file is skipped
+    self.assertEqual([(name, temp) for (name, temp, read) in readings], [('attic', 22.5), ('outside', 17.5)])
+
+  @mock.patch('metricfire.send_many')
+  def test_send_readings(self, mf_mock):
+    readings = [('outside', 10, 1334000001), ('inside', 20, 1334000003)]
+    main.send_readings(readings, 1334000000)
+    main.config['timestamps'] = 'tick'
+    try:
+      main.send_readings(readings, 1334000060)
+    finally:
+      main.config['timestamps'] = 'read'
+    self.assertEqual(mf_mock.call_args_list, [
+      mock.call(readings),
+      mock.call([('outside', 10, 1334000060), ('inside', 20, 1334000060)])])
+
+  def test_read_timestamps(self):
+    before = int(time.time())
+    readings = main.get_readings()
+    self.assertTrue(all(before <= read <= time.time() for (name, temp, read) in readings))
+
+  @mock.patch('main.send_readings')
+  @mock.patch('metricfire.wait')
+  @mock.patch('metricfire.init')
+  def test_main_once(self, init_mock, wait_mock, send_mock):
+    wait_mock.return_value = True
+    with mock.patch.object(sys, 'argv', ['main.py', '--quiet', '--once']):
+      main.main()
+    # The server must be known before the readings are sent
+    self.assertTrue(init_mock.called)
+    self.assertEqual(init_mock.call_args[1]['dns_ttl'], main.config.get('metricfire_dns_ttl', 300))
+    wait_mock.assert_called_once_with(5)
+    readings, tick = send_mock.call_args[0]
+    self.assertEqual([(name, temp) for (name, temp, read) in readings], [('outside', 17.5), ('inside', 22.5)])
+    self.assertEqual(tick % main.config['interval'], 0)
 
@@ -0,0 +1,561 @@
+import unittest, mock, sys, os, threading, json, time, hmac, hashlib, binascii, socket, asyncore, tempfile, subprocess, errno, warnings, shutil
+
+sys.path.append(os.getcwd())
+import metricfire
+
+KEY = '00000000-0000-0000-0000-000000000000'
+
+class TestClient(unittest.TestCase):
+  def setUp(self):
+    self.client = metricfire.Client(KEY, application='test', server='127.0.0.1:6333', try_adns=False)
+    self.sent = []
+    self.client._send = lambda content, sockaddr: self.sent.append(content)
+
+  def test_format(self):
+    for i in range(3):
+      message = self.client._format([('a', 1, None)])
+      header, body = message.split('\n', 1)
+      header = json.loads(header)
+      self.assertEqual(json.loads(body), {'h': self.client._hostname, 'a': 'test', 'm': [['a', 1, None]]})
+      self.assertEqual(header['q'], i + 1)
+      self.assertEqual(header['f'], hashlib.md5(self.client._key).hexdigest())
+      # The HMAC covers the session key, the sequence number and the body
+      sessionkey = binascii.unhexlify(header['s'])
+      auth = hmac.HMAC(self.client._key, sessionkey + str(header['q']) + body, hashlib.sha256)
+      self.assertEqual(header['a'], auth.hexdigest())
+
+  def test_send_many_single_datagram(self):
+    self.client.send_many([('a', 1, None), ('b', 2.5, 1334000000)])
+    self.assertEqual(len(self.sent), 1)
+    header, body = self.sent[0].split('\n', 1)
+    self.assertEqual(json.loads(body)['m'], [['a', 1, None], ['b', 2.5, 1334000000]])
+
+  def test_send_many_splits_large_batches(self):
+    datapoints = [('some.long.metric.name.%d' % i, i * 1.5, 1334000000 + i) for i in range(500)]
+    self.client.send_many(datapoints)
+    self.assertTrue(len(self.sent) > 1)
+    received = []
+    for message in self.sent:
+      self.assertTrue(len(message) <= self.client._max_datagram)
+      received.extend(json.loads(message.split('\n', 1)[1])['m'])
+    self.assertEqual(received, [list(d) for d in datapoints])
+
+  def test_send_many_empty(self):
+    self.client.send_many([])
+    self.assertEqual(self.sent, [])
+
+class TestStats(unittest.TestCase):
+  def test_stats(self):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:%d' % server.getsockname()[1], try_adns=False)
+    client.send('a', 1)
+    client.send_many([('b', 2, None), ('c', 3, None)])
+    client.observe('work', 0.25)
+    stats = client.stats()
+    self.assertEqual(stats['packets'], 2)
+    self.assertEqual(stats['datapoints'], 3)
+    self.assertEqual(stats['bytes'], len(server.recv(65536)) + len(server.recv(65536)))
+    self.assertEqual(stats['errors'], 0)
+    self.assertEqual(stats['timings']['send']['count'], 2)
+    self.assertEqual(stats['timings']['format']['count'], 2)
+    self.assertEqual(stats['timings']['work']['max'], 0.25)
+    names = [m for (m, v, t) in client._internalDatapoints(None)]
+    self.assertIn('metricfire.internal.packets', names)
+    self.assertIn('metricfire.internal.send.p99', names)
+    server.close()
+
+  def test_internal_survives_socket_error(self):
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:6333', try_adns=False, internal_interval=0.02)
+    sent = []
+    def send(content, sockaddr):
+      if client._flush_errors < 2:
+        raise socket.error(errno.ENETUNREACH, 'Network is unreachable')
+      sent.append(content)
+    client._send = send
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore')
+      for i in range(200):
+        if sent:
+          break
+        time.sleep(0.01)
+      client.close()
+    # The thread reporting the statistics outlived the failures and reported them
+    received = dict((m, v) for (m, v, t) in json.loads(sent[0].split('\n', 1)[1])['m'])
+    self.assertEqual(received['metricfire.internal.flush_errors'], 2)
+
+  def test_stats_of_threads(self):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:%d' % server.getsockname()[1], try_adns=False)
+    def work():
+      for i in range(100):
+        client.send('a', i)
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    client.send('b', 1)
+    stats = client.stats()
+    self.assertEqual(stats['packets'], 401)
+    self.assertEqual(stats['timings']['format']['count'], 401)
+    # The exited threads are folded together
+    self.assertEqual(len(client._thread_stats), 1)
+    self.assertEqual(client.stats()['packets'], 401)
+    server.close()
+
+class TestResolver(unittest.TestCase):
+  def test_resolve(self):
+    resolver = metricfire.Resolver('localhost', 6333)
+    self.assertTrue(resolver.wait(5))
+    self.assertIn(('127.0.0.1', 6333), resolver.sockaddrs)
+
+  def test_client_resolves_in_background(self):
+    client = metricfire.Client(KEY, application='test', server='localhost:6333', try_adns=False)
+    self.assertTrue(client._resolver.wait(5))
+    self.assertTrue(client._resolved())
+    self.assertIn(('127.0.0.1', 6333), client._sockaddrs)
+
+  def test_refresh(self):
+    # Known addresses put the lookup off until they expire, or a refresh.
+    resolver = metricfire.Resolver('localhost', 6333, sockaddrs=(('10.0.0.1', 6333),), expires=time.time() + 60)
+    self.assertTrue(resolver.wait(0))
+    resolver.refresh()
+    for i in range(50):
+      if resolver.sockaddrs != (('10.0.0.1', 6333),):
+        break
+      time.sleep(0.1)
+    self.assertIn(('127.0.0.1', 6333), resolver.sockaddrs)
+
+  def test_close_stops_resolver(self):
+    def resolvers():
+      return len([thread for thread in threading.enumerate() if thread.name == 'metricfire-dns' and thread.is_alive()])
+    before = (resolvers(), len(os.listdir('/proc/self/fd')))
+    for i in range(20):
+      client = metricfire.Client(KEY, application='test', server='localhost:6333', try_adns=False)
+      client.wait(5)
+      client.close()
+    for i in range(50):
+      if resolvers() <= before[0]:
+        break
+      time.sleep(0.1)
+    self.assertEqual((resolvers(), len(os.listdir('/proc/self/fd'))), before)
+
+  def test_close_twice(self):
+    # The thread closes the pipe when it stops. A fork afterwards closes the
+    # resolver again, which must leave descriptors reused since then alone.
+    client = metricfire.Client(KEY, application='test', server='localhost:6333', try_adns=False)
+    resolver = client._resolver
+    resolver.stop()
+    resolver._thread.join(5)
+    self.assertIsNone(resolver._wakeup_read)
+    (read, write) = os.pipe()
+    try:
+      client._afterFork()
+      os.write(write, 'x')
+      self.assertEqual(os.read(read, 1), 'x')
+    finally:
+      os.close(read)
+      os.close(write)
+      client.close()
+
+  def test_wait_adns(self):
+    class NotReady(Exception):
+      pass
+    class Query:
+      checks = 0
+      def check(self):
+        Query.checks += 1
+        if Query.checks < 4:
+          raise NotReady()
+        return (0, None, time.time() + 300, ['127.0.0.1'])
+    fake = mock.Mock(NotReady=NotReady)
+    fake.init.return_value.submit.return_value = Query()
+    with mock.patch('metricfire.adns', fake), mock.patch('metricfire._loadAdns', return_value=fake):
+      client = metricfire.Client(KEY, application='test', server='localhost:6333')
+      self.assertFalse(client.wait(0))
+      # No timeout waits until the query has an answer
+      self.assertTrue(client.wait(None))
+    self.assertEqual(client._sockaddrs, (('127.0.0.1', 6333),))
+
+  def test_dns_cache(self):
+    path = tempfile.mktemp()
+    try:
+      client = metricfire.Client(KEY, application='test', server='localhost:6333', try_adns=False, dns_cache=path)
+      self.assertTrue(client.wait(5))
+      self.assertTrue(client._resolved())
+      cache = json.load(open(path))
+      self.assertEqual(cache['server'], 'localhost:6333')
+      self.assertIn(['127.0.0.1', 6333], cache['sockaddrs'])
+      # A fresh cache is used as is, without waiting for a lookup.
+      cache['sockaddrs'] = [['10.0.0.1', 6333]]
+      json.dump(cache, open(path, 'w'))
+      client = metricfire.Client(KEY, application='test', server='localhost:6333', try_adns=False, dns_cache=path)
+      self.assertEqual(client._resolver.sockaddrs, (('10.0.0.1', 6333),))
+      self.assertTrue(client._resolved())
+      # Expired entries and those of other servers are ignored.
+      for changes in ({'expires': time.time() - 1}, {'server': 'example.com:6333'}):
+        json.dump(dict(cache, **changes), open(path, 'w'))
+        client = metricfire.Client(KEY, application='test', server='localhost:6333', try_adns=False, dns_cache=path)
+        self.assertTrue(client.wait(5))
+        self.assertIn(('127.0.0.1', 6333), client._resolver.sockaddrs)
+    finally:
+      os.remove(path)
+
+class TestAtomicWrite(unittest.TestCase):
+  def test_concurrent_writers(self):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'state')
+    errors = []
+    def write(value):
+      try:
+        for i in range(200):
+          metricfire.atomicWrite(path, value * 100000)
+      except EnvironmentError, ex:
+        errors.append(ex)
+    threads = [threading.Thread(target=write, args=(value,)) for value in 'ab']
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    try:
+      # Threads of one process don't share a temporary file
+      self.assertEqual(errors, [])
+      self.assertIn(open(path).read(), ('a' * 100000, 'b' * 100000))
+      self.assertEqual(os.listdir(directory), ['state'])
+    finally:
+      shutil.rmtree(directory)
+
+class TestStartup(unittest.TestCase):
+  def test_lazy_imports(self):
+    # Modules only some programs need aren't loaded by importing metricfire.
+    out = subprocess.check_output([sys.executable, '-c',
+      'import sys, metricfire; print sorted(m for m in ("asyncore", "inspect", "ctypes", "zlib") if m in sys.modules)'])
+    self.assertEqual(out.strip(), '[]')
+    self.assertTrue(metricfire.monotonic() > 0)
+    # The clock is loaded once, also for those who imported monotonic itself
+    clock = metricfire._monotonic
+    self.assertIsNotNone(clock)
+    from metricfire import monotonic
+    monotonic()
+    self.assertIs(metricfire._monotonic, clock)
+
+  def test_monotonic_without_subprocess(self):
+    # Loading the clock doesn't run ldconfig or gcc, it happens in a timed call
+    with mock.patch('subprocess.Popen', side_effect=AssertionError('subprocess started')):
+      clock = metricfire._loadMonotonic()
+    self.assertIsNot(clock, time.time)
+    first = clock()
+    self.assertTrue(clock() >= first)
+
+class TestEndpointPool(unittest.TestCase):
+  def test_sharding(self):
+    pool = metricfire.EndpointPool()
+    sockaddrs = (('10.0.0.1', 6333), ('10.0.0.2', 6333), ('10.0.0.3', 6333))
+    pool.update(sockaddrs)
+    metrics = ['host%d.sensor%d' % (i, j) for i in range(100) for j in range(10)]
+    picked = dict((metric, pool.pick(metric)) for metric in metrics)
+    for sockaddr in sockaddrs:
+      self.assertTrue(len([m for m in metrics if picked[m] == sockaddr]) > 200)
+    # A new address only takes metrics over, the others keep theirs
+    pool.update(sockaddrs + (('10.0.0.4', 6333),))
+    for metric in metrics:
+      self.assertIn(pool.pick(metric), (picked[metric], ('10.0.0.4', 6333)))
+    groups = pool.shard([(metric, 1, None) for metric in metrics])
+    self.assertEqual(sum(len(datapoints) for (sockaddr, datapoints) in groups), len(metrics))
+
+  def test_update_closes_sockets(self):
+    pool = metricfire.EndpointPool(per_thread=True)
+    first, second = ('127.0.0.1', 6333), ('127.0.0.1', 6334)
+    pool.update((first, second))
+    kept, dropped = pool.socket(first), pool.socket(second)
+    pool.update((first,))
+    # The thread's socket of the address that went away is closed on its next send
+    self.assertIs(pool.socket(first), kept)
+    self.assertRaises(socket.error, dropped.fileno)
+    self.assertEqual(pool._local.sockets.keys(), [first])
+
+  def test_eject_refused(self):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(1)
+    # A port nobody listens on
+    closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    closed.bind(('127.0.0.1', 0))
+    dead = closed.getsockname()
+    closed.close()
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:6333', try_adns=False)
+    client._sockaddrs = (server.getsockname(), dead)
+    metrics = ['m%d' % i for i in range(20)]
+    for i in range(3):
+      for metric in metrics:
+        client.send(metric, i)
+    stats = client.stats()
+    self.assertEqual(stats['ejected'], 1)
+    self.assertTrue(stats['errors'] >= 1)
+    # Metrics of the ejected address went to the other one
+    self.assertEqual(set(client._pool.pick(metric) for metric in metrics), set([server.getsockname()]))
+    received = 0
+    try:
+      while True:
+        server.recv(65536)
+        received += 1
+    except socket.timeout:
+      pass
+    # Only messages sent before the refusal was noticed are lost
+    self.assertTrue(received >= 60 - 2)
+    server.close()
+
+  def test_all_refused(self):
+    closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    closed.bind(('127.0.0.1', 0))
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:%d' % closed.getsockname()[1], try_adns=False)
+    closed.close()
+    # Messages are dropped without raising, like with an unconnected socket
+    for i in range(5):
+      client.send('a', i)
+    self.assertTrue(client.stats()['errors'] >= 1)
+
+class TestBufferedClient(unittest.TestCase):
+  def setUp(self):
+    self.client = metricfire.Client(KEY, application='test', server='127.0.0.1:6333', try_adns=False,
+                                    buffered=True, buffer_size=4, flush_interval=60)
+    self.sent = []
+    self.client._send = lambda content, sockaddr: self.sent.append(content)
+
+  def tearDown(self):
+    self.client.close()
+
+  def test_send_is_buffered(self):
+    self.client.send('a', 1)
+    self.assertEqual(self.sent, [])
+    self.assertEqual(len(self.client._buffer), 1)
+    # The time of the measurement is recorded at send() time
+    self.assertIsNotNone(self.client._buffer[0][2])
+
+  def test_drop_oldest(self):
+    self.client.send_many([('m', i, i) for i in range(6)])
+    self.assertEqual(self.client.dropped(), 2)
+    self.assertEqual([d[1] for d in self.client._buffer], [2, 3, 4, 5])
+
+  def test_flush_batches(self):
+    self.client.send_many([('m', i, i) for i in range(3)])
+    self.assertTrue(self.client.flush())
+    self.assertEqual(len(self.sent), 1)
+    self.assertEqual(len(self.client._buffer), 0)
+
+  def test_keep_until_resolved(self):
+    self.client._sockaddrs = ()
+    self.client.send('a', 1, 1)
+    self.assertFalse(self.client.flush())
+    self.assertEqual(len(self.client._buffer), 1)
+    self.client._sockaddrs = (('127.0.0.1', 6333),)
+    self.assertTrue(self.client.flush())
+    self.assertEqual(len(self.sent), 1)
+
+  def test_forked_child_drops_buffer(self):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:%d' % server.getsockname()[1], try_adns=False,
+                               buffered=True, flush_interval=60)
+    client.send('a', 1, 1)
+    pid = os.fork()
+    if pid == 0:
+      # What the inherited atexit handler does in a child exiting normally
+      client.close()
+      os._exit(0)
+    os.waitpid(pid, 0)
+    client.close()
+    server.settimeout(5)
+    self.assertEqual(json.loads(server.recv(65536).split('\n', 1)[1])['m'], [['a', 1, 1]])
+    # Only the parent sent it
+    server.settimeout(0.2)
+    self.assertRaises(socket.timeout, server.recv, 65536)
+    server.close()
+
+class TestAggregator(unittest.TestCase):
+  def test_collect(self):
+    aggregator = metricfire.Aggregator()
+    for i in range(1, 101):
+      aggregator.add('f', i / 1000.0)
+    datapoints = dict((m, v) for (m, v, t) in aggregator.collect())
+    self.assertEqual(datapoints['f.count'], 100)
+    self.assertAlmostEqual(datapoints['f.avg'], 0.0505)
+    self.assertEqual(datapoints['f.min'], 0.001)
+    self.assertEqual(datapoints['f.max'], 0.1)
+    # Percentiles are accurate to one bucket
+    self.assertTrue(0.05 <= datapoints['f.p50'] <= 0.05 * 1.19)
+    self.assertTrue(0.095 <= datapoints['f.p95'] <= 0.1)
+    self.assertTrue(0.099 <= datapoints['f.p99'] <= 0.1)
+    # Collecting starts over
+    self.assertEqual(aggregator.collect(), [])
+
+  def test_weight(self):
+    aggregator = metricfire.Aggregator()
+    aggregator.add('f', 0.5, 10)
+    aggregator.add('f', 1.5)
+    summary = aggregator.summary()['f']
+    self.assertEqual(summary['count'], 11)
+    self.assertAlmostEqual(summary['avg'], 6.5 / 11)
+    self.assertTrue(0.5 <= summary['p50'] <= 0.5 * 1.19)
+
+  def test_client_record(self):
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:6333', try_adns=False,
+                               aggregate=True, aggregate_interval=60)
+    sent = []
+    client._send = lambda content, sockaddr: sent.append(content)
+    for i in range(1000):
+      client.record('f', 0.5)
+    self.assertEqual(sent, [])
+    client.close()
+    self.assertEqual(len(sent), 1)
+    body = json.loads(sent[0].split('\n', 1)[1])
+    self.assertIn(['f.count', 1000, body['m'][0][2]], body['m'])
+
+  def test_flush_survives_socket_error(self):
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:6333', try_adns=False,
+                               aggregate=True, aggregate_interval=0.02)
+    sent = []
+    failed = []
+    def send(content, sockaddr):
+      if not failed:
+        failed.append(content)
+        raise socket.error(errno.ENETUNREACH, 'Network is unreachable')
+      sent.append(content)
+    client._send = send
+    def counts():
+      return [value for content in sent for (metric, value, timestamp) in json.loads(content.split('\n', 1)[1])['m'] if metric == 'f.count']
+    def wait_for(total):
+      for i in range(200):
+        if sum(counts()) >= total:
+          break
+        time.sleep(0.01)
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore')
+      client.record('f', 0.5)
+      wait_for(1)
+      # The aggregates taken when sending failed went out on a later tick
+      self.assertEqual((len(failed), sum(counts())), (1, 1))
+      self.assertTrue(client._flush_thread.is_alive())
+      client.record('f', 0.5)
+      wait_for(2)
+      self.assertEqual(sum(counts()), 2)
+      self.assertEqual(client.stats()['flush_errors'], 1)
+      client.close()
+
+  def test_client_record_ints(self):
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:6333', try_adns=False,
+                               aggregate=True, aggregate_interval=60)
+    sent = []
+    client._send = lambda content, sockaddr: sent.append(content)
+    for value in (17, 18):
+      client.record('outside', value)
+    client.close()
+    body = json.loads(sent[0].split('\n', 1)[1])
+    # The average of ints isn't truncated
+    self.assertIn(['outside.avg', 17.5, body['m'][0][2]], body['m'])
+
+class TestMeasure(unittest.TestCase):
+  def setUp(self):
+    self.client = metricfire.Client(KEY, application='test', server='127.0.0.1:6333', try_adns=False,
+                                    aggregate=True, aggregate_interval=3600)
+    self.previous, metricfire._module_client = metricfire._module_client, self.client
+    self.now = 0.0
+    self.monotonic, metricfire.monotonic = metricfire.monotonic, lambda: self.now
+
+  def tearDown(self):
+    metricfire.monotonic = self.monotonic
+    metricfire._module_client = self.previous
+    self.client.close()
+
+  def test_sampling(self):
+    @metricfire.measure('test', sample=10)
+    def hot():
+      self.now += 0.001
+    for i in range(100):
+      hot()
+    stats = self.client._aggregator.summary()['test.%s.hot' % __name__]
+    # Every tenth call is timed and counted ten times
+    self.assertEqual(stats['count'], 100)
+    self.assertAlmostEqual(stats['avg'], 0.001)
+
+  def test_sampling_without_aggregation(self):
+    client = metricfire.Client(KEY, application='test', server='127.0.0.1:6333', try_adns=False)
+    sent = []
+    client._send = lambda content, sockaddr: sent.extend(json.loads(content.split('\n', 1)[1])['m'])
+    metricfire._module_client = client
+    @metricfire.measure('test', sample=10)
+    def hot():
+      self.now += 0.001
+    for i in range(100):
+      hot()
+    metric = 'test.%s.hot' % __name__
+    # Every tenth call is timed, and its weight sent along so no calls go missing
+    self.assertEqual(len([value for (name, value, timestamp) in sent if name == metric]), 10)
+    self.assertEqual(sum(value for (name, value, timestamp) in sent if name == metric + '.count'), 100)
+
+  def test_spans(self):
+    @metricfire.measure('test', sample=1000)
+    def child():
+      self.now += 0.25
+    @metricfire.measure('test', spans=True)
+    def parent():
+      self.now += 0.5
+      child()
+      child()
+    parent()
+    stats = self.client._aggregator.summary()
+    self.assertEqual(stats['test.%s.parent' % __name__]['max'], 1.0)
+    # The children are timed for the parent even though they weren't sampled
+    self.assertEqual(stats['test.%s.parent.self' % __name__]['max'], 0.5)
+    self.assertNotIn('test.%s.child' % __name__, stats)
+
+  def test_exception(self):
+    @metricfire.measure('test')
+    def failing():
+      raise ValueError()
+    self.assertRaises(ValueError, failing)
+    self.assertEqual(metricfire._spans.stack, [])
+    self.assertEqual(self.client._aggregator.summary(), {})
+
+class TestTimer(unittest.TestCase):
+  def test_caller_name(self):
+    def timed():
+      timer = metricfire.Timer('test')
+      timer.start()
+      return timer
+    def retimed(timer):
+      timer.restart()
+    def outer():
+      return timed()
+    timer = outer()
+    self.assertEqual(timer._metric, 'test.timed')
+    with mock.patch('metricfire.record'):
+      retimed(timer)
+    self.assertEqual(timer._metric, 'test.retimed')
+    timer.cancel()
+
+class TestAsyncClient(unittest.TestCase):
+  def test_send(self):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(5)
+    map = {}
+    client = metricfire.AsyncClient(KEY, map=map, application='test', server='127.0.0.1:%d' % server.getsockname()[1], try_adns=False)
+    client.send('a', 1)
+    # Nothing is written until the event loop runs
+    self.assertEqual(len(client._outgoing), 1)
+    asyncore.loop(timeout=1, map=map, count=1)
+    self.assertEqual(len(client._outgoing), 0)
+    message = server.recv(65536)
+    self.assertEqual(json.loads(message.split('\n', 1)[1])['m'], [['a', 1, None]])
+    server.close()
+
+  def test_several_clients(self):
+    map = {}
+    clients = [metricfire.AsyncClient(KEY, map=map, application='test', server='127.0.0.1:6333', try_adns=False) for i in range(2)]
+    self.assertEqual(len(map), 2)
+    self.assertIs(type(clients[0]._dispatcher), type(clients[1]._dispatcher))
+    for client in clients:
+      client.close()
@@ -0,0 +1,66 @@
+import unittest, sys, os
+
+sys.path.append(os.getcwd())
+import metricfire
+from relay import Relay
+
+class FakeClient:
+  def __init__(self):
+    self.datapoints = []
+    self.records = []
+
+  def send_many(self, datapoints):
+    self.datapoints.extend(datapoints)
+
+  def record(self, metric, value, weight=1):
+    self.records.append((metric, value))
+
+class TestRelay(unittest.TestCase):
+  def setUp(self):
+    self.path = os.path.abspath('tests/tmp/relay.sock')
+    self.client = FakeClient()
+    self.relay = Relay(self.path, self.client)
+
+  def tearDown(self):
+    self.relay.close()
+
+  def receive(self, count):
+    for i in range(count):
+      self.relay.handle(self.relay.sock.recv(65536))
+
+  def test_relay(self):
+    relay_client = metricfire.RelayClient(self.path)
+    self.assertTrue(relay_client.send('a', 1, 1334000000))
+    relay_client.send_many([('b', 2, 1334000001), ('c', 3, None)])
+    relay_client.record('f', 0.5)
+    self.receive(3)
+    self.assertEqual(self.client.datapoints[:2], [('a', 1, 1334000000), ('b', 2, 1334000001)])
+    # Missing timestamps are filled in by the sender
+    self.assertIsNotNone(self.client.datapoints[2][2])
+    self.assertEqual(self.client.records, [('f', 0.5)])
+    self.assertEqual(relay_client.stats()['packets'], 3)
+
+  def test_large_batch(self):
+    relay_client = metricfire.RelayClient(self.path)
+    name = 'sensor.' + 'x' * 120
+    datapoints = [(name + str(i), i, 1334000000) for i in range(500)]
+    self.assertTrue(relay_client.send_many(datapoints))
+    packets = relay_client.stats()['packets']
+    self.assertTrue(packets > 1)
+    self.receive(packets)
+    # Every datagram fit into the relay's receive buffer
+    self.assertEqual(self.client.datapoints, datapoints)
+    # A datapoint too large for any datagram is dropped, not reported as sent
+    self.assertFalse(relay_client.send('x' * 70000, 1, 1334000000))
+    self.assertEqual(relay_client.stats()['dropped'], 1)
+    self.assertEqual(relay_client.stats()['packets'], packets)
+
+  def test_malformed(self):
+    self.relay.handle('garbage')
+    self.relay.handle('[1, 2]')
+    self.relay.handle('{"d": 5}')
+    self.assertEqual(self.client.datapoints, [])
+    # Bad entries are skipped, the good ones of the same datagram forwarded
+    self.relay.handle('{"r": [5, ["f", "x"], ["g", 0.5]], "d": [[1], ["a", 1, null], ["b", "2", 3]]}')
+    self.assertEqual(self.client.datapoints, [('a', 1, None)])
+    self.assertEqual(self.client.records, [('g', 0.5)])
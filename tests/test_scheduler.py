@@ -0,0 +1,103 @@
+import unittest, sys, os
+
+sys.path.append(os.getcwd())
+import scheduler
+
+class FakeClock:
+  """Monotonic and wall clock, advanced only by sleep() and work()."""
+  def __init__(self, wall, offset=1000.0):
+    self.wall = wall
+    self.offset = offset
+
+  def monotonic(self):
+    return self.wall - self.offset
+
+  def wallclock(self):
+    return self.wall
+
+  def sleep(self, seconds):
+    self.wall += seconds
+
+  def work(self, seconds):
+    self.wall += seconds
+
+class TestScheduler(unittest.TestCase):
+  def make(self, clock, policy='skip'):
+    return scheduler.Scheduler(10, policy, clock=clock.monotonic, wallclock=clock.wallclock, sleep=clock.sleep)
+
+  def test_monotonic(self):
+    a = scheduler.monotonic()
+    b = scheduler.monotonic()
+    self.assertTrue(b >= a)
+
+  def test_aligned_without_drift(self):
+    clock = FakeClock(1334000003.5)
+    ticks = []
+    for tick in self.make(clock):
+      ticks.append(tick)
+      clock.work(2.7)
+      if len(ticks) == 5:
+        break
+    self.assertEqual(ticks, [1334000010, 1334000020, 1334000030, 1334000040, 1334000050])
+
+  def test_skip(self):
+    clock = FakeClock(1334000000)
+    sched = self.make(clock)
+    ticks = []
+    for tick in sched:
+      ticks.append(tick)
+      clock.work(25 if len(ticks) == 1 else 1)
+      if len(ticks) == 3:
+        break
+    self.assertEqual(ticks, [1334000000, 1334000030, 1334000040])
+    self.assertEqual(sched.overruns, 1)
+    self.assertEqual(sched.skipped, 2)
+
+  def test_catchup(self):
+    clock = FakeClock(1334000000)
+    sched = self.make(clock, 'catchup')
+    ticks = []
+    lateness = []
+    for tick in sched:
+      ticks.append(tick)
+      lateness.append(sched.lateness)
+      clock.work(25 if len(ticks) == 1 else 1)
+      if len(ticks) == 4:
+        break
+    self.assertEqual(ticks, [1334000000, 1334000010, 1334000020, 1334000030])
+    self.assertEqual(lateness, [0, 15, 6, 0])
+    self.assertEqual(sched.skipped, 0)
+
+  def test_wall_clock_step(self):
+    clock = FakeClock(1334000000)
+    ticks = []
+    for tick in self.make(clock):
+      ticks.append(tick)
+      if len(ticks) == 1:
+        # NTP steps the wall clock, but not the monotonic one
+        clock.offset += 3600
+        clock.wall += 3600
+      if len(ticks) == 3:
+        break
+    self.assertEqual(ticks[1] % 10, 0)
+    self.assertTrue(ticks[1] >= 1334003600)
+    self.assertEqual(ticks[2] - ticks[1], 10)
+
+class TestSensorSchedule(unittest.TestCase):
+  def test_intervals(self):
+    clock = FakeClock(0)
+    schedule = scheduler.SensorSchedule([('fast', 10), ('slow', 30)], clock=clock.monotonic)
+    start = clock.monotonic()
+    polled = []
+    while len(polled) < 6:
+      clock.wall += schedule.next_due() - clock.monotonic()
+      for key in schedule.pop_due(clock.monotonic()):
+        polled.append((clock.monotonic() - start, key))
+    self.assertEqual(polled, [(0, 'fast'), (0, 'slow'), (10, 'fast'), (20, 'fast'), (30, 'fast'), (30, 'slow')])
+
+  def test_utilisation(self):
+    clock = FakeClock(0)
+    schedule = scheduler.SensorSchedule([('a', 10)], buses=2, clock=clock.monotonic)
+    schedule.add_busy(0, 2.5)
+    clock.wall += 10
+    self.assertEqual(schedule.utilisation(), [0.25, 0.0])
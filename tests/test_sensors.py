@@ -0,0 +1,80 @@
+import unittest, sys, os, time, shutil
+
+sys.path.append(os.getcwd())
+from sensors import W1Backend, crc8
+
+# w1_slave contents of a DS18B20 reading 23.125 C and 85 C
+GOOD = "72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n72 01 4b 46 7f ff 0e 10 57 t=23125\n"
+HOT = "50 05 4b 46 7f ff 0c 10 1c : crc=1c YES\n50 05 4b 46 7f ff 0c 10 1c t=85000\n"
+BAD_CRC = "72 01 4b 46 7f ff 0e 10 58 : crc=58 NO\n72 01 4b 46 7f ff 0e 10 58 t=23125\n"
+
+class TestW1Backend(unittest.TestCase):
+  def setUp(self):
+    self.root = os.path.abspath('tests/tmp/w1')
+    if os.path.exists(self.root):
+      shutil.rmtree(self.root)
+    os.makedirs(os.path.join(self.root, 'w1_bus_master1'))
+    self.device('28-000005e2fdc3', GOOD)
+    self.device('28-0000061b8a21', HOT)
+    self.backend = W1Backend(self.root)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def device(self, name, contents):
+    path = os.path.join(self.root, name)
+    if not os.path.exists(path):
+      os.mkdir(path)
+    open(os.path.join(path, 'w1_slave'), 'w').write(contents)
+
+  def temps(self, bus):
+    return [(name, temp) for (name, temp, read) in self.backend.readings(bus)]
+
+  def test_crc8(self):
+    self.assertEqual(crc8([0x72, 0x01, 0x4b, 0x46, 0x7f, 0xff, 0x0e, 0x10]), 0x57)
+
+  def test_readings_by_position(self):
+    bus = {'sensors': ['outside', 'inside']}
+    self.assertEqual(self.backend.devices(), ['28-000005e2fdc3', '28-0000061b8a21'])
+    self.assertEqual(self.temps(bus), [('outside', 23.125), ('inside', 85.0)])
+    self.assertEqual(self.backend.reading(bus, 1)[:2], ('inside', 85.0))
+
+  def test_other_families(self):
+    # An ID chip and a switch on the same bus don't take sensor names
+    os.mkdir(os.path.join(self.root, '01-000012345678'))
+    os.mkdir(os.path.join(self.root, '3a-00000abcdef0'))
+    self.device('10-000801b5a7f2', GOOD)
+    self.assertEqual(self.backend.devices(), ['10-000801b5a7f2', '28-000005e2fdc3', '28-0000061b8a21'])
+    bus = {'sensors': ['a', 'b', 'c']}
+    self.assertEqual(self.temps(bus), [('a', 23.125), ('b', 23.125), ('c', 85.0)])
+
+  def test_read_by_id(self):
+    bus = {'sensors': [{'name': 'inside', 'id': '28-0000061b8a21'},
+                       {'name': 'outside', 'id': '28-000005e2fdc3'}]}
+    self.assertEqual(self.temps(bus), [('inside', 85.0), ('outside', 23.125)])
+
+  def test_readings(self):
+    bus = {'sensors': [{'name': 'inside', 'id': '28-0000061b8a21'}, 'outside']}
+    before = time.time()
+    readings = self.backend.readings(bus)
+    self.assertEqual([(name, temp) for (name, temp, read) in readings], [('inside', 85.0), ('outside', 23.125)])
+    self.assertTrue(all(before <= read <= time.time() for (name, temp, read) in readings))
+    self.assertEqual(self.backend.reading(bus, 0)[:2], ('inside', 85.0))
+    # The sensor without an id takes the device the other one leaves over
+    self.assertEqual(self.backend.device_ids(bus), ['28-0000061b8a21', '28-000005e2fdc3'])
+
+  def test_bad_crc(self):
+    self.device('28-000005e2fdc3', BAD_CRC)
+    self.assertRaises(IOError, self.backend.reading, {'sensors': ['outside']}, 0)
+    # The other sensors of the bus are still read
+    bus = {'sensors': ['outside', 'inside', 'cellar']}
+    self.assertEqual(self.temps(bus), [('inside', 85.0)])
+
+  def test_bulk_trigger(self):
+    trigger = os.path.join(self.root, 'w1_bus_master1', 'therm_bulk_read')
+    open(trigger, 'w').close()
+    self.backend.readings({'sensors': ['outside']})
+    self.assertEqual(open(trigger).read(), 'trigger\n')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+import unittest, sys, os, shutil, socket, errno
+
+sys.path.append(os.getcwd())
+from spool import Spool
+
+class TestSpool(unittest.TestCase):
+  def setUp(self):
+    self.path = os.path.abspath('tests/tmp/spool')
+    if os.path.exists(self.path):
+      shutil.rmtree(self.path)
+    self.spool = Spool(self.path, segment_bytes=100)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_append_drain(self):
+    datapoints = [('outside', i * 0.5, 1334000000 + i) for i in range(20)]
+    self.spool.append(datapoints[:10])
+    self.spool.append(datapoints[10:])
+    batches = []
+    sent = self.spool.drain(lambda batch: batches.append(batch) or True, batch_size=7)
+    self.assertEqual(sent, 20)
+    self.assertEqual(sum(batches, []), datapoints)
+    self.assertTrue(max(map(len, batches)) <= 7)
+    # Everything was uploaded
+    self.assertEqual(self.spool.pending(), 0)
+    self.assertEqual(self.spool.drain(lambda batch: True), 0)
+
+  def test_failed_send_is_kept(self):
+    datapoints = [('outside', i, 1334000000 + i) for i in range(5)]
+    self.spool.append(datapoints)
+    self.assertEqual(self.spool.drain(lambda batch: False), 0)
+    batches = []
+    self.spool.drain(lambda batch: batches.append(batch) or True)
+    self.assertEqual(sum(batches, []), datapoints)
+
+  def test_socket_error_is_kept(self):
+    datapoints = [('outside', i, 1334000000 + i) for i in range(5)]
+    self.spool.append(datapoints)
+    def send(batch):
+      raise socket.error(errno.ENETUNREACH, 'Network is unreachable')
+    self.assertEqual(self.spool.drain(send), 0)
+    batches = []
+    self.spool.drain(lambda batch: batches.append(batch) or True)
+    self.assertEqual(sum(batches, []), datapoints)
+
+  def test_resume(self):
+    datapoints = [('outside', i, 1334000000 + i) for i in range(10)]
+    self.spool.append(datapoints)
+    calls = []
+    def send(batch):
+      calls.append(batch)
+      return len(calls) == 1
+    # Only the first batch goes out
+    self.assertEqual(self.spool.drain(send, batch_size=4), 4)
+    batches = []
+    self.spool.drain(lambda batch: batches.append(batch) or True)
+    self.assertEqual(sum(batches, []), datapoints[4:])
+
+  def test_size_cap(self):
+    spool = Spool(self.path, max_bytes=300, segment_bytes=100)
+    for i in range(20):
+      spool.append([('outside', i, 1334000000 + i)])
+    self.assertTrue(spool.pending() <= 300 + 100)
+    self.assertTrue(spool.dropped > 0)
+    batches = []
+    spool.drain(lambda batch: batches.append(batch) or True)
+    # The newest readings survive
+    self.assertEqual(sum(batches, [])[-1], ('outside', 19, 1334000019))
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
-import sys, os
+import sys, os, time
+
+# ROM serials of the sensors, as digitemp's %R prints them
+roms = ["10E45C570108007D", "28B1C3A2040000E1"]
 
 if '-i' in sys.argv:
   # create config file
@@ -8,10 +11,33 @@ if '-i' in sys.argv:
     at = sys.argv.index('-c')
     path = os.path.abspath(sys.argv[at+1])
     f = open(path, 'wt')
+    f.write("TTY /dev/ttyS0\nSENSORS %d\n" % len(roms))
+    for number, rom in enumerate(roms):
+      f.write("ROM %d %s\n" % (number, ' '.join('0x' + rom[i:i+2] for i in range(0, 16, 2))))
     f.close()
   else:
     raise Exception("No config path specified")
 else:
-  # normal operation
-  print "17.5"
-  print "22.5"
+  # normal operation, looping like digitemp's -n and -d options
+  loops = 1
+  delay = 0
+  if '-n' in sys.argv:
+    loops = int(sys.argv[sys.argv.index('-n')+1])
+  if '-d' in sys.argv:
+    delay = float(sys.argv[sys.argv.index('-d')+1])
+  # output format, supporting the ROM serial, time and Celsius specifiers
+  format = "%C"
+  if '-o' in sys.argv:
+    format = sys.argv[sys.argv.index('-o')+1]
+  done = 0
+  sensors = zip(roms, ["17.5", "22.5"])
+  if '-t' in sys.argv:
+    # read a single sensor
+    sensors = [sensors[int(sys.argv[sys.argv.index('-t')+1])]]
+  while loops == 0 or done < loops:
+    if done:
+      time.sleep(delay)
+    for rom, value in sensors:
+      print format.replace('%R', rom).replace('%N', str(int(time.time()))).replace('%C', value)
+    sys.stdout.flush()
+    done += 1